@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+# MeerKAT antenna layout from data/mkat_antennas.yml
+# The antenna strings 'name=..., diameter=..., east=..., north=..., up=...' are
+# parsed once into a structured array with the ENU offsets, ITRF (ECEF) positions
+# and dish diameters, positions in m.
+# The parsed layout is kept in a binary .npz file next to the YAML file, reused
+# while the modification time or content hash of the YAML file is unchanged.
+
+import hashlib
+import numpy as np
+import os
+import yaml
+
+LAYOUT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      '..', 'data', 'mkat_antennas.yml')
+
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1. / 298.257223563
+
+ANTENNA_DTYPE = np.dtype([('name', 'U8'),
+                          ('east', np.float64),
+                          ('north', np.float64),
+                          ('up', np.float64),
+                          ('x', np.float64),
+                          ('y', np.float64),
+                          ('z', np.float64),
+                          ('diameter', np.float64),
+                          ])
+REFERENCE_DTYPE = np.dtype([('latitude', np.float64),
+                            ('longitude', np.float64),
+                            ('altitude', np.float64),
+                            ('x', np.float64),
+                            ('y', np.float64),
+                            ('z', np.float64),
+                            ])
+
+_layout_cache = {}
+
+
+def sexagesimal(value):
+    """Degrees from 'dd:mm:ss.s' or a number"""
+    if not isinstance(value, str):
+        return float(value)
+    sign = -1. if value.strip().startswith('-') else 1.
+    parts = [abs(float(part)) for part in value.split(':')]
+    return sign * sum(part / 60. ** idx for idx, part in enumerate(parts))
+
+
+def geodetic_to_ecef(latitude, longitude, height):
+    """WGS84 geodetic latitude, longitude [rad] and height [m] to ECEF x, y, z [m]"""
+    latitude = np.asarray(latitude, dtype=np.float64)
+    longitude = np.asarray(longitude, dtype=np.float64)
+    height = np.asarray(height, dtype=np.float64)
+    e2 = WGS84_F * (2. - WGS84_F)
+    sin_lat = np.sin(latitude)
+    cos_lat = np.cos(latitude)
+    radius = WGS84_A / np.sqrt(1. - e2 * sin_lat ** 2)
+    return np.stack(((radius + height) * cos_lat * np.cos(longitude),
+                     (radius + height) * cos_lat * np.sin(longitude),
+                     (radius * (1. - e2) + height) * sin_lat), axis=-1)
+
+
+def enu_to_ecef(enu, latitude, longitude, ref_xyz):
+    """ENU offsets (n, 3) [m] from a reference position to ECEF x, y, z [m]"""
+    sin_lat = np.sin(latitude)
+    cos_lat = np.cos(latitude)
+    sin_lon = np.sin(longitude)
+    cos_lon = np.cos(longitude)
+    # rows are the east, north and up unit vectors in ECEF
+    axes = np.array([[-sin_lon, cos_lon, 0.],
+                     [-sin_lat * cos_lon, -sin_lat * sin_lon, cos_lat],
+                     [cos_lat * cos_lon, cos_lat * sin_lon, sin_lat]])
+    return np.asarray(ref_xyz) + np.asarray(enu).dot(axes)
+
+
+def parse(filename=LAYOUT):
+    """Antenna and reference records of the layout file"""
+    with open(filename, 'r') as stream:
+        data = yaml.safe_load(stream)
+    ref = data['reference']
+    reference = np.zeros((), dtype=REFERENCE_DTYPE)
+    reference['latitude'] = np.radians(sexagesimal(ref['latitude']))
+    reference['longitude'] = np.radians(sexagesimal(ref['longitude']))
+    reference['altitude'] = float(ref['altitude'])
+    ref_xyz = geodetic_to_ecef(reference['latitude'],
+                               reference['longitude'],
+                               reference['altitude'])
+    reference['x'], reference['y'], reference['z'] = ref_xyz
+
+    antennas = np.zeros(len(data['antennas']), dtype=ANTENNA_DTYPE)
+    for idx, antenna in enumerate(data['antennas']):
+        items = dict(item.strip().split('=') for item in antenna.split(','))
+        antennas[idx]['name'] = items['name']
+        for key in ('east', 'north', 'up', 'diameter'):
+            antennas[idx][key] = float(items[key])
+    xyz = enu_to_ecef(enu(antennas),
+                      reference['latitude'],
+                      reference['longitude'],
+                      ref_xyz)
+    antennas['x'], antennas['y'], antennas['z'] = xyz.T
+    return antennas, reference
+
+
+def _sha1(filename):
+    with open(filename, 'rb') as fin:
+        return hashlib.sha1(fin.read()).hexdigest()
+
+
+def _cachefile(filename):
+    return os.path.splitext(filename)[0] + '.npz'
+
+
+def load(filename=LAYOUT, cache=True):
+    """
+    Antenna records (n_ants,) and the reference position of the layout,
+    parsed once per file and kept in a .npz file next to it with cache
+    """
+    filename = os.path.abspath(filename)
+    mtime = os.path.getmtime(filename)
+    if filename in _layout_cache and _layout_cache[filename][0] == mtime:
+        return _layout_cache[filename][1]
+
+    sha1 = None
+    layout = None
+    cachefile = _cachefile(filename)
+    if cache and os.path.isfile(cachefile):
+        with np.load(cachefile) as npz:
+            if float(npz['mtime']) != mtime:
+                sha1 = _sha1(filename)
+            if sha1 is None or str(npz['sha1']) == sha1:
+                layout = (npz['antennas'], npz['reference'][()])
+    if layout is None:
+        layout = parse(filename)
+    if cache and (sha1 is not None or not os.path.isfile(cachefile)):
+        # new or touched file
+        try:
+            np.savez(cachefile,
+                     antennas=layout[0],
+                     reference=layout[1],
+                     mtime=mtime,
+                     sha1=sha1 or _sha1(filename))
+        except (IOError, OSError):
+            pass
+    _layout_cache[filename] = (mtime, layout)
+    return layout
+
+
+def select(antennas, names):
+    """Subarray of antennas by name, a list or comma separated string"""
+    if isinstance(names, str):
+        names = [name.strip() for name in names.split(',') if name.strip()]
+    mask = np.isin(antennas['name'], names)
+    missing = sorted(set(names) - set(antennas['name'][mask]))
+    if missing:
+        raise KeyError('Unknown antennas {}'.format(missing))
+    return antennas[mask]
+
+
+def enu(antennas):
+    """ENU offsets [m], (n_ants, 3)"""
+    return np.column_stack((antennas['east'], antennas['north'], antennas['up']))
+
+
+def itrf(antennas):
+    """ITRF positions [m], (n_ants, 3)"""
+    return np.column_stack((antennas['x'], antennas['y'], antennas['z']))
+
+# -fin-
@@ -0,0 +1,503 @@
+#!/usr/bin/python3
+# Selection of the best N antenna MeerKAT subarray for a target and time window
+# Replaces toggling the antenna checkboxes of
+# MeerKAT_Array_UV_coverage_manual_calculations.ipynb one configuration at a time
+# with a search over subsets, scored by
+#   fill     - fraction of UV cells inside the full array UV radius that are sampled
+#   sidelobe - peak sidelobe of the PSF (minimised)
+#   longest  - longest projected baseline
+#
+# The UV cells of each baseline are gridded once, so adding or removing an
+# antenna only updates the cell counts of its baselines to the selected antennas.
+# Greedy selection with pairwise swaps, or simulated annealing chains, evaluate
+# their candidates in batches in a pool of worker processes.
+
+import argparse
+import mkat_antennas
+import multiprocessing
+import numpy as np
+import uv_psf
+import uv_tracks
+
+METRICS = ('fill', 'sidelobe', 'longest')
+
+# baseline cells of the full array, set in each worker process by the pool
+# initializer, with the fork and the spawn start methods
+_data = {}
+
+
+def _init_worker(data):
+    _data.clear()
+    _data.update(data)
+
+
+## -- baseline cells --
+def baseline_cells(uvw_m, freqs, cell, npix):
+    """
+    Sampled UV cells of each baseline, with the conjugate samples, as
+    flat cell indices and sample counts per cell, concatenated over
+    baselines with offsets (n_bl + 1)
+    """
+    freqs = np.atleast_1d(freqs)
+    scale = (freqs / (uv_tracks.C * uv_psf.uv_cell(cell, npix))).astype(np.float32)
+    centre = npix // 2
+    cells = []
+    counts = []
+    offsets = [0]
+    for bl in range(uvw_m.shape[1]):
+        u = (uvw_m[0, bl, :, np.newaxis] * scale).ravel()
+        v = (uvw_m[1, bl, :, np.newaxis] * scale).ravel()
+        col = np.rint(np.concatenate((u, -u))).astype(np.int64) + centre
+        row = np.rint(np.concatenate((v, -v))).astype(np.int64) + centre
+        valid = (col >= 0) & (col < npix) & (row >= 0) & (row < npix)
+        index, count = np.unique(row[valid] * npix + col[valid], return_counts=True)
+        cells.append(index.astype(np.int32))
+        counts.append(count.astype(np.int32))
+        offsets.append(offsets[-1] + len(index))
+    return np.concatenate(cells), np.concatenate(counts), np.array(offsets)
+
+
+def prepare(ra,
+            dec,
+            start,
+            duration,
+            dump=8.,
+            freqs=uv_psf.REF_FREQ,
+            npix=256,
+            cell=None,
+            min_elevation=uv_psf.MIN_ELEVATION):
+    """
+    Baseline cells and lengths of the full array for a target and time window,
+    over the samples with the target above min_elevation [deg]
+    """
+    uvw_m = uv_psf.tracks(ra, dec, start, duration, dump=dump,
+                          min_elevation=min_elevation)
+    if cell is None:
+        cell = uv_psf.auto_cell(uvw_m, freqs)
+    cells, counts, offsets = baseline_cells(uvw_m, freqs, cell, npix)
+    n_ants = int(round((1. + np.sqrt(1. + 8. * uvw_m.shape[1])) / 2.))
+    ant1, ant2 = uv_tracks.baseline_index(n_ants)
+    bl_index = np.full((n_ants, n_ants), -1, dtype=np.int64)
+    bl_index[ant1, ant2] = bl_index[ant2, ant1] = np.arange(len(ant1))
+    uv_length = np.sqrt(uvw_m[0] ** 2 + uvw_m[1] ** 2).max(axis=1)
+    lengths = np.zeros((n_ants, n_ants))
+    lengths[ant1, ant2] = lengths[ant2, ant1] = uv_length
+
+    # cells inside the UV radius of the full array
+    y, x = np.mgrid[:npix, :npix] - npix // 2
+    uv_max = uv_length.max() * np.max(freqs) / uv_tracks.C / uv_psf.uv_cell(cell, npix)
+    inside = (np.hypot(x, y) <= uv_max).ravel()
+    return {'cells': cells,
+            'counts': counts,
+            'offsets': offsets,
+            'bl_index': bl_index,
+            'lengths': lengths,
+            'inside': inside,
+            'n_inside': int(inside.sum()),
+            'npix': npix,
+            'cell': cell,
+            }
+## -- baseline cells --
+
+
+## -- scoring --
+class Scorer(object):
+    """UV cell counts of a selection, updated per added or removed antenna"""
+
+    def __init__(self, data, metric='fill', weighting='natural'):
+        if metric not in METRICS:
+            raise ValueError('Unknown metric {}, use one of {}'.format(metric,
+                                                                       METRICS))
+        self.data = data
+        self.metric = metric
+        self.weighting = weighting
+        n_ants = len(data['bl_index'])
+        self.selection = np.zeros(n_ants, dtype=bool)
+        self.grid = np.zeros(data['npix'] ** 2, dtype=np.int64)
+        self.n_filled = 0
+
+    def _gather(self, baselines):
+        offsets = self.data['offsets']
+        slices = [slice(offsets[bl], offsets[bl + 1]) for bl in baselines]
+        if not slices:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return (np.concatenate([self.data['cells'][sel] for sel in slices]),
+                np.concatenate([self.data['counts'][sel] for sel in slices]))
+
+    def _update(self, baselines, sign):
+        cells, counts = self._gather(baselines)
+        cells, inverse = np.unique(cells, return_inverse=True)
+        counts = np.bincount(inverse, weights=counts).astype(np.int64)
+        before = self.grid[cells] > 0
+        self.grid[cells] += sign * counts
+        after = self.grid[cells] > 0
+        inside = self.data['inside'][cells]
+        self.n_filled += int((after & ~before & inside).sum() -
+                             (before & ~after & inside).sum())
+
+    def set(self, selection):
+        self.selection = np.asarray(selection, dtype=bool).copy()
+        self.grid[:] = 0
+        self.n_filled = 0
+        ants = np.nonzero(self.selection)[0]
+        ant1, ant2 = np.triu_indices(len(ants), k=1)
+        self._update(self.data['bl_index'][ants[ant1], ants[ant2]], 1)
+
+    def add(self, ant):
+        others = np.nonzero(self.selection)[0]
+        self.selection[ant] = True
+        self._update(self.data['bl_index'][ant, others[others != ant]], 1)
+
+    def remove(self, ant):
+        self.selection[ant] = False
+        others = np.nonzero(self.selection)[0]
+        self._update(self.data['bl_index'][ant, others], -1)
+
+    def score(self):
+        """Score of the selection, higher is better"""
+        if self.metric == 'fill':
+            return self.n_filled / float(self.data['n_inside'])
+        if self.metric == 'longest':
+            ants = np.nonzero(self.selection)[0]
+            return float(self.data['lengths'][np.ix_(ants, ants)].max())
+        npix = self.data['npix']
+        counts = self.grid.reshape(npix, npix).astype(np.float64)
+        if counts.sum() < 1:
+            return -1.
+        image = uv_psf.psf(uv_psf.weights(counts, weighting=self.weighting))
+        return -uv_psf.beam(image, self.data['cell'])['peak_sidelobe']
+
+
+def _evaluate(task):
+    """Scores of moves, (antenna out, antenna in) or None, from a selection"""
+    selection, moves, metric, weighting = task
+    scorer = Scorer(_data, metric=metric, weighting=weighting)
+    scorer.set(selection)
+    scores = []
+    for out, in_ in moves:
+        if out is not None:
+            scorer.remove(out)
+        if in_ is not None:
+            scorer.add(in_)
+        scores.append(scorer.score())
+        if in_ is not None:
+            scorer.remove(in_)
+        if out is not None:
+            scorer.add(out)
+    return scores
+## -- scoring --
+
+
+## -- search --
+def _batches(moves, n_batches):
+    size = max(1, int(np.ceil(len(moves) / float(n_batches))))
+    return [moves[start:start + size] for start in range(0, len(moves), size)]
+
+
+def _check_size(n_ants, n_total, available=None, include=None):
+    """Check that n_ants is between the number of included and usable antennas"""
+    usable = np.ones(n_total, dtype=bool) if available is None else available.copy()
+    n_include = 0
+    if include is not None and len(include) > 0:
+        usable[include] = True
+        n_include = len(np.unique(include))
+    if not n_include <= n_ants <= usable.sum():
+        raise ValueError('Cannot select {} antennas with {} included and {} '
+                         'available'.format(n_ants, n_include, usable.sum()))
+
+
+def _map(pool, selection, moves, metric, weighting, workers):
+    tasks = [(selection, batch, metric, weighting)
+             for batch in _batches(moves, 4 * workers)]
+    if pool is None:
+        results = [_evaluate(task) for task in tasks]
+    else:
+        results = pool.map(_evaluate, tasks, chunksize=1)
+    return np.array([score for result in results for score in result])
+
+
+def greedy(data,
+           n_ants,
+           metric='fill',
+           weighting='natural',
+           available=None,
+           include=None,
+           workers=None,
+           max_passes=10):
+    """
+    Grow the selection one antenna at a time, then swap selected and available
+    antennas while the score improves. Returns the selection mask and score
+    """
+    n_total = len(data['bl_index'])
+    _check_size(n_ants, n_total, available, include)
+    available = np.ones(n_total, dtype=bool) if available is None else available
+    selection = np.zeros(n_total, dtype=bool)
+    if include is not None:
+        selection[include] = True
+    available = available & ~selection
+    if selection.sum() < 2:
+        # start from the baseline sampling the most cells
+        n_cells = np.diff(data['offsets'])
+        ant1, ant2 = uv_tracks.baseline_index(n_total)
+        usable = available[ant1] | selection[ant1]
+        usable &= available[ant2] | selection[ant2]
+        if selection.any():
+            usable &= selection[ant1] | selection[ant2]
+        best = np.argmax(np.where(usable, n_cells, -1))
+        selection[[ant1[best], ant2[best]]] = True
+        available &= ~selection
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    _init_worker(data)
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(processes=workers,
+                                    initializer=_init_worker,
+                                    initargs=(data, ))
+    try:
+        while selection.sum() < n_ants:
+            candidates = np.nonzero(available)[0]
+            scores = _map(pool, selection,
+                          [(None, ant) for ant in candidates],
+                          metric, weighting, workers)
+            ant = candidates[np.argmax(scores)]
+            selection[ant] = True
+            available[ant] = False
+        score = _evaluate((selection, [(None, None)], metric, weighting))[0]
+        fixed = np.zeros(n_total, dtype=bool)
+        if include is not None:
+            fixed[include] = True
+        for _ in range(max_passes):
+            moves = [(out, in_)
+                     for out in np.nonzero(selection & ~fixed)[0]
+                     for in_ in np.nonzero(available)[0]]
+            if not moves:
+                break
+            scores = _map(pool, selection, moves, metric, weighting, workers)
+            best = np.argmax(scores)
+            if scores[best] <= score:
+                break
+            out, in_ = moves[best]
+            selection[out], selection[in_] = False, True
+            available[out], available[in_] = True, False
+            score = scores[best]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return selection, float(score)
+
+
+def _anneal(task):
+    """One simulated annealing chain of random swaps"""
+    selection, available, fixed, n_iter, metric, weighting, seed = task
+    rng = np.random.RandomState(seed)
+    scorer = Scorer(_data, metric=metric, weighting=weighting)
+    scorer.set(selection)
+    score = scorer.score()
+    best = (scorer.selection.copy(), score)
+    if not (selection & ~fixed).any() or not (available & ~selection).any():
+        # no antennas to swap
+        return best
+    temp0 = 0.05 * max(abs(score), 1e-3)
+    for step in range(n_iter):
+        temp = temp0 * 1e-3 ** (step / float(max(n_iter - 1, 1)))
+        out = rng.choice(np.nonzero(scorer.selection & ~fixed)[0])
+        in_ = rng.choice(np.nonzero(available & ~scorer.selection)[0])
+        scorer.remove(out)
+        scorer.add(in_)
+        new = scorer.score()
+        if new >= score or rng.rand() < np.exp((new - score) / temp):
+            score = new
+            if score > best[1]:
+                best = (scorer.selection.copy(), score)
+        else:
+            scorer.remove(in_)
+            scorer.add(out)
+    return best
+
+
+def anneal(data,
+           n_ants,
+           metric='fill',
+           weighting='natural',
+           available=None,
+           include=None,
+           workers=None,
+           n_iter=2000,
+           n_chains=None,
+           seed=0):
+    """
+    Simulated annealing chains from random selections, run in parallel.
+    Returns the best selection mask and score
+    """
+    n_total = len(data['bl_index'])
+    _check_size(n_ants, n_total, available, include)
+    available = np.ones(n_total, dtype=bool) if available is None else available
+    fixed = np.zeros(n_total, dtype=bool)
+    if include is not None:
+        fixed[include] = True
+    available = available | fixed
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if n_chains is None:
+        n_chains = max(workers, 1)
+    rng = np.random.RandomState(seed)
+    tasks = []
+    for chain in range(n_chains):
+        selection = fixed.copy()
+        free = np.nonzero(available & ~fixed)[0]
+        selection[rng.choice(free, n_ants - fixed.sum(), replace=False)] = True
+        tasks.append((selection, available, fixed, n_iter, metric, weighting,
+                      seed + chain + 1))
+
+    _init_worker(data)
+    if workers > 1:
+        pool = multiprocessing.Pool(processes=min(workers, n_chains),
+                                    initializer=_init_worker,
+                                    initargs=(data, ))
+        try:
+            results = pool.map(_anneal, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_anneal(task) for task in tasks]
+    selection, score = max(results, key=lambda result: result[1])
+    return selection, float(score)
+## -- search --
+
+
+def optimise(ra,
+             dec,
+             start,
+             duration,
+             n_ants,
+             metric='fill',
+             method='greedy',
+             exclude=None,
+             include=None,
+             dump=8.,
+             freqs=uv_psf.REF_FREQ,
+             npix=256,
+             min_elevation=uv_psf.MIN_ELEVATION,
+             workers=None,
+             **kwargs):
+    """
+    Best subarray of n_ants antennas for a target at J2000 ra, dec [rad] from
+    start (astropy Time or UTC MJD) over duration [s], while the target is
+    above min_elevation [deg].
+    Antennas in exclude are not used, antennas in include are always used,
+    ValueError if n_ants is fewer than included or more than available.
+    Returns the antenna names and the score
+    """
+    antennas, _ = mkat_antennas.load()
+    available = ~uv_psf.antenna_mask(antennas, exclude) if exclude else None
+    fixed = None
+    if include:
+        fixed = np.nonzero(uv_psf.antenna_mask(antennas, include))[0]
+    _check_size(n_ants, len(antennas), available, fixed)
+    data = prepare(ra, dec, start, duration, dump=dump, freqs=freqs, npix=npix,
+                   min_elevation=min_elevation)
+    search = {'greedy': greedy, 'anneal': anneal}[method]
+    selection, score = search(data, n_ants,
+                              metric=metric,
+                              available=available,
+                              include=fixed,
+                              workers=workers,
+                              **kwargs)
+    return [str(name) for name in antennas['name'][selection]], score
+
+
+def cli():
+    usage = "%%prog [options]"
+    description = 'select the best MeerKAT subarray for a target and time window'
+
+    parser = argparse.ArgumentParser(
+            usage=usage,
+            description=description,
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+            '--ra',
+            type=float,
+            required=True,
+            help='target J2000 right ascension [deg]',
+            )
+    parser.add_argument(
+            '--dec',
+            type=float,
+            required=True,
+            help='target J2000 declination [deg]',
+            )
+    parser.add_argument(
+            '--start',
+            type=float,
+            required=True,
+            help='start time, UTC MJD',
+            )
+    parser.add_argument(
+            '--duration',
+            type=float,
+            default=3600.,
+            help='observation duration [s]',
+            )
+    parser.add_argument(
+            '--min-elevation',
+            type=float,
+            default=uv_psf.MIN_ELEVATION,
+            help='elevation limit [deg], time with the target below is not used',
+            )
+    parser.add_argument(
+            '-n', '--n-ants',
+            type=int,
+            default=16,
+            help='number of antennas in the subarray',
+            )
+    parser.add_argument(
+            '--metric',
+            choices=METRICS,
+            default='fill',
+            help='subarray score',
+            )
+    parser.add_argument(
+            '--method',
+            choices=('greedy', 'anneal'),
+            default='greedy',
+            help='search method',
+            )
+    parser.add_argument(
+            '--exclude',
+            type=str,
+            help='comma separated antennas that are not available, e.g. in maintenance',
+            )
+    parser.add_argument(
+            '--include',
+            type=str,
+            help='comma separated antennas that must be in the subarray',
+            )
+    parser.add_argument(
+            '-j', '--workers',
+            type=int,
+            help='number of worker processes, default the number of CPUs',
+            )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = cli()
+    names, score = optimise(np.radians(args.ra),
+                            np.radians(args.dec),
+                            args.start,
+                            args.duration,
+                            args.n_ants,
+                            metric=args.metric,
+                            method=args.method,
+                            exclude=args.exclude,
+                            include=args.include,
+                            min_elevation=args.min_elevation,
+                            workers=args.workers)
+    print('{} score {:.4f}'.format(args.metric, score))
+    print(','.join(names))
+
+# -fin-
@@ -0,0 +1,260 @@
+#!/usr/bin/python3
+# UV density and synthesized beam (PSF) of MeerKAT (sub)arrays
+# Extends the coverage() function of
+# MeerKAT_Array_UV_coverage_manual_calculations.ipynb, which sets a mask pixel
+# per UV sample of each baseline in a loop and shows the FFT as the PSF.
+# Here all samples, with their conjugates, over all channels are gridded at once
+# with np.bincount, in chunks bounded by max_mem_mb, weighted on the grid
+# (natural, uniform or Briggs robust weighting) and transformed to a PSF, and
+# the fitted beam size and peak sidelobe level are reported.
+#
+# UVW tracks in m are cached per (target, start time, duration, antenna mask),
+# so different weighting, cell size or channels reuse the geometry. The least
+# recently used tracks are dropped to keep the cache below MAX_CACHE_BYTES.
+# As get_ha_range of the notebook, which clips the hour angles to rise and set,
+# only samples with the target above the elevation limit are kept.
+
+import collections
+import mkat_antennas
+import numpy as np
+import os
+import uv_tracks
+import uvw_frames
+
+# cache size limit [bytes]
+MAX_CACHE_BYTES = 512 * 1024 ** 2
+# L-band centre frequency [Hz]
+REF_FREQ = 1.284e9
+# elevation limit [deg], the horizon as in the notebook
+MIN_ELEVATION = 0.
+WEIGHTING = ('natural', 'uniform', 'briggs')
+# PSF level above which the main lobe is fitted, the MeerKAT core sits on a
+# broad plateau from the dense central antennas at lower levels
+FIT_LEVEL = 0.5
+
+_track_cache = collections.OrderedDict()
+
+
+## -- tracks --
+def antenna_mask(antennas, select=None):
+    """Boolean mask of the selected antennas, names or mask, all if None"""
+    if select is None:
+        return np.ones(len(antennas), dtype=bool)
+    if isinstance(select, str) or np.asarray(select).dtype.kind == 'U':
+        names = mkat_antennas.select(antennas, select)['name']
+        return np.isin(antennas['name'], names)
+    mask = np.asarray(select, dtype=bool)
+    if mask.shape != (len(antennas), ):
+        raise ValueError('Antenna mask of {} values for {} antennas'.format(
+            mask.size, len(antennas)))
+    return mask
+
+
+def clear_cache():
+    _track_cache.clear()
+
+
+def cache_bytes():
+    return sum(uvw_m.nbytes for uvw_m in _track_cache.values())
+
+
+def tracks(ra,
+           dec,
+           start,
+           duration,
+           dump=8.,
+           select=None,
+           min_elevation=MIN_ELEVATION,
+           filename=uv_tracks.LAYOUT):
+    """
+    UVW [m] of the baselines of the selected antennas, (3, n_bl, n_times) float32,
+    towards J2000 ra, dec [rad] from start (astropy Time or UTC MJD) over
+    duration [s] sampled every dump [s], for the samples with the target above
+    min_elevation [deg]
+    """
+    antennas, reference = mkat_antennas.load(filename)
+    mask = antenna_mask(antennas, select)
+    start_mjd = float(uvw_frames.to_mjd(start)[0])
+    # the layout file and its modification time, as in mkat_antennas.load
+    key = (os.path.abspath(filename), os.path.getmtime(filename),
+           float(ra), float(dec), start_mjd, float(duration), float(dump),
+           float(min_elevation), np.packbits(mask).tobytes())
+    if key in _track_cache:
+        _track_cache.move_to_end(key)
+        return _track_cache[key]
+
+    n_times = max(1, int(round(duration / dump)))
+    mjd = start_mjd + (np.arange(n_times) + 0.5) * dump / 86400.
+    elevation = uvw_frames.elevation(reference['latitude'],
+                                     reference['longitude'],
+                                     ra, dec, mjd)
+    mjd = mjd[elevation >= np.radians(min_elevation)]
+    if len(mjd) < 1:
+        raise ValueError('Target below {} deg elevation during the observation'.format(
+            min_elevation))
+    uvw_m = uvw_frames.uvw_fast(mkat_antennas.enu(antennas[mask]),
+                                reference['latitude'],
+                                reference['longitude'],
+                                ra, dec, mjd,
+                                dtype=np.float32)
+    uvw_m.flags.writeable = False
+    _track_cache[key] = uvw_m
+    while cache_bytes() > MAX_CACHE_BYTES and len(_track_cache) > 1:
+        _track_cache.popitem(last=False)
+    return uvw_m
+## -- tracks --
+
+
+## -- gridding --
+def _chunks(n_bl, n_times, n_chans, max_mem_mb):
+    """Time and channel slices with at most max_mem_mb of gridding arrays"""
+    # u, v as float32 and the flat pixel index as int64, for the conjugates too
+    max_samples = max(1, int(max_mem_mb * 1024 ** 2 // (2 * 16 * n_bl)))
+    chan_step = min(n_chans, max_samples)
+    time_step = max(1, min(n_times, max_samples // chan_step))
+    for time_start in range(0, n_times, time_step):
+        for chan_start in range(0, n_chans, chan_step):
+            yield (slice(time_start, min(time_start + time_step, n_times)),
+                   slice(chan_start, min(chan_start + chan_step, n_chans)))
+
+
+def uv_cell(cell, npix):
+    """UV cell size [wavelengths] of an image of npix pixels of cell [arcsec]"""
+    return 1. / (npix * np.radians(cell / 3600.))
+
+
+def auto_cell(uvw_m, freqs):
+    """Image cell size [arcsec], 4 pixels across the longest baseline fringe"""
+    uv_max = np.sqrt(uvw_m[0] ** 2 + uvw_m[1] ** 2).max() * np.max(freqs) / uv_tracks.C
+    return np.degrees(1. / (4. * uv_max)) * 3600.
+
+
+def density(uvw_m, freqs, cell, npix=1024, max_mem_mb=256.):
+    """
+    Number of UV samples per cell, (npix, npix) with v along axis 0,
+    of UVW [m] (3, n_bl, n_times) over channel freqs [Hz],
+    for an image of npix pixels of cell [arcsec]
+    """
+    freqs = np.atleast_1d(freqs)
+    scale = (freqs / (uv_tracks.C * uv_cell(cell, npix))).astype(np.float32)
+    _, n_bl, n_times = uvw_m.shape
+    centre = npix // 2
+    counts = np.zeros(npix * npix, dtype=np.float64)
+    for time_sel, chan_sel in _chunks(n_bl, n_times, len(freqs), max_mem_mb):
+        u = uvw_m[0, :, time_sel, np.newaxis] * scale[chan_sel]
+        v = uvw_m[1, :, time_sel, np.newaxis] * scale[chan_sel]
+        for sign in (1., -1.):
+            col = np.rint(sign * u).astype(np.int64) + centre
+            row = np.rint(sign * v).astype(np.int64) + centre
+            valid = (col >= 0) & (col < npix) & (row >= 0) & (row < npix)
+            counts += np.bincount((row[valid] * npix + col[valid]),
+                                  minlength=npix * npix)
+    return counts.reshape(npix, npix)
+
+
+def weights(counts, weighting='natural', robust=0.):
+    """
+    Gridded weights from the sample counts per cell, each sample weighted
+    1 (natural), 1/count (uniform) or 1/(1 + count f**2) (Briggs)
+    """
+    if weighting == 'natural':
+        return counts
+    if weighting == 'uniform':
+        return (counts > 0).astype(np.float64)
+    if weighting == 'briggs':
+        f2 = (5. * 10. ** -robust) ** 2 / ((counts ** 2).sum() / counts.sum())
+        return counts / (1. + counts * f2)
+    raise ValueError('Unknown weighting {}, use one of {}'.format(weighting,
+                                                                  WEIGHTING))
+## -- gridding --
+
+
+## -- beam --
+def psf(grid):
+    """Synthesized beam of the gridded weights, peak normalised to 1, centred"""
+    image = np.fft.fftshift(np.fft.ifft2(np.fft.ifftshift(grid)).real)
+    return image / image.max()
+
+
+def beam(image, cell):
+    """
+    Gaussian fit to the main lobe of the PSF: FWHM major and minor axes
+    [arcsec], position angle [deg], and the peak sidelobe outside the first null
+    """
+    npix = image.shape[0]
+    centre = npix // 2
+    # main lobe extent from the first crossing of FIT_LEVEL along 8 directions
+    radius = np.arange(1, centre)
+    reach = []
+    for d_row, d_col in ((0, 1), (1, 0), (0, -1), (-1, 0),
+                         (1, 1), (1, -1), (-1, 1), (-1, -1)):
+        profile = image[centre + d_row * radius, centre + d_col * radius]
+        below = np.nonzero(profile < FIT_LEVEL)[0]
+        reach.append(radius[below[0]] * np.hypot(d_row, d_col) if len(below) else centre)
+    half = min(int(np.ceil(max(reach))) + 1, centre - 1)
+    window = image[centre - half:centre + half + 1, centre - half:centre + half + 1]
+    y, x = np.mgrid[-half:half + 1, -half:half + 1]
+    fit = (window > FIT_LEVEL) & (np.hypot(x, y) <= max(reach))
+
+    # log(psf) = -(a x**2 + 2 b x y + c y**2)
+    design = np.column_stack((x[fit] ** 2, 2 * x[fit] * y[fit], y[fit] ** 2))
+    (a, b, c), _, _, _ = np.linalg.lstsq(design, -np.log(window[fit]), rcond=None)
+    eigval, eigvec = np.linalg.eigh(np.array([[a, b], [b, c]]))
+    eigval = np.maximum(eigval, 1e-12)
+    # exp(-lambda r**2) = 0.5 at r = FWHM / 2
+    fwhm = 2. * np.sqrt(np.log(2.) / eigval) * cell
+    major = eigvec[:, 0]  # smallest curvature
+    # position angle east of north, x pixels towards -RA
+    bpa = np.degrees(np.arctan2(-major[0], major[1])) % 180.
+
+    # first null of the PSF averaged in ellipses of the fitted beam
+    y, x = np.mgrid[:npix, :npix] - centre
+    rho = np.sqrt(a * x ** 2 + 2 * b * x * y + c * y ** 2) / np.sqrt(np.log(2.))
+    bins = (rho / 0.1).astype(np.int64).ravel()
+    n_pix = np.bincount(bins)
+    filled = np.nonzero(n_pix)[0]
+    profile = np.bincount(bins, weights=image.ravel())[filled] / n_pix[filled]
+    rising = np.nonzero(np.diff(profile) > 0)[0]
+    rho_null = filled[rising[0]] * 0.1 if len(rising) else rho.max()
+    sidelobes = image[rho > rho_null]
+    return {'bmaj_arcsec': float(fwhm[0]),
+            'bmin_arcsec': float(fwhm[1]),
+            'bpa_deg': float(bpa),
+            'peak_sidelobe': float(sidelobes.max()) if sidelobes.size else 0.,
+            }
+## -- beam --
+
+
+def synthesized_beam(ra,
+                     dec,
+                     start,
+                     duration,
+                     dump=8.,
+                     select=None,
+                     min_elevation=MIN_ELEVATION,
+                     freqs=REF_FREQ,
+                     weighting='natural',
+                     robust=0.,
+                     cell=None,
+                     npix=1024,
+                     max_mem_mb=256.):
+    """
+    UV density, PSF and beam report of an observation,
+    see tracks() for the observation and density() for the gridding
+    """
+    uvw_m = tracks(ra, dec, start, duration, dump=dump, select=select,
+                   min_elevation=min_elevation)
+    if cell is None:
+        cell = auto_cell(uvw_m, freqs)
+    counts = density(uvw_m, freqs, cell, npix=npix, max_mem_mb=max_mem_mb)
+    image = psf(weights(counts, weighting=weighting, robust=robust))
+    report = beam(image, cell)
+    report.update({'cell_arcsec': float(cell),
+                   'weighting': weighting,
+                   'n_samples': int(counts.sum()),
+                   'n_times': int(uvw_m.shape[2]),
+                   'fill_fraction': float((counts > 0).mean()),
+                   })
+    return counts, image, report
+
+# -fin-
@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+# UV tracks of all MeerKAT baselines over hour angle and frequency
+# Vectorized form of the MKAT and UVplot classes of
+# MeerKAT_Array_UV_coverage_manual_calculations.ipynb and get_uvwcoverage of
+# MeerKAT_UV_coverage_with_Astropy_and_CASA.ipynb: (u, v, w) of the unique
+# baselines, no autocorrelations or mirrored pairs, for all hour angles and
+# channels in one broadcast expression.
+# Interferometry and Synthesis in Radio Astronomy, Chapter 4, Equations 4.1, 4.4
+
+import argparse
+import mkat_antennas
+import numpy as np
+import time
+
+LAYOUT = mkat_antennas.LAYOUT
+C = 299792458.  # m/s
+SIDEREAL_DAY = 86164.0905  # s
+
+
+def read_layout(filename=LAYOUT):
+    """Antenna names, ENU offsets [m] (n_ants, 3) and reference latitude [rad]"""
+    antennas, reference = mkat_antennas.load(filename)
+    return (list(antennas['name']),
+            mkat_antennas.enu(antennas),
+            float(reference['latitude']))
+
+
+def enu_to_xyz(enu, latitude):
+    """Local east, north, up offsets to equatorial X, Y, Z, (n_ants, 3)"""
+    east, north, up = np.asarray(enu).T
+    sin_lat = np.sin(latitude)
+    cos_lat = np.cos(latitude)
+    return np.column_stack((-sin_lat * north + cos_lat * up,
+                            east,
+                            cos_lat * north + sin_lat * up))
+
+
+def baseline_index(n_ants):
+    """Antenna pairs of the unique baselines, ant1 < ant2"""
+    return np.triu_indices(n_ants, k=1)
+
+
+def baselines(xyz, ant1=None, ant2=None):
+    """Baseline vectors xyz[ant2] - xyz[ant1], (n_bl, 3)"""
+    if ant1 is None:
+        ant1, ant2 = baseline_index(len(xyz))
+    return xyz[ant2] - xyz[ant1]
+
+
+def rotation(ha, dec):
+    """XYZ to UVW rotation matrices per hour angle [rad], (n_ha, 3, 3)"""
+    ha = np.atleast_1d(ha)
+    sin_h = np.sin(ha)
+    cos_h = np.cos(ha)
+    sin_d = np.sin(dec)
+    cos_d = np.cos(dec)
+    zero = np.zeros_like(ha)
+    return np.stack((np.stack((sin_h, cos_h, zero), axis=-1),
+                     np.stack((-sin_d * cos_h, sin_d * sin_h,
+                               np.full_like(ha, cos_d)), axis=-1),
+                     np.stack((cos_d * cos_h, -cos_d * sin_h,
+                               np.full_like(ha, sin_d)), axis=-1)),
+                    axis=-2)
+
+
+def uvw(bl_xyz, ha, dec, freqs=None, dtype=np.float64):
+    """
+    (u, v, w) of baselines (n_bl, 3) at hour angles [rad], (3, n_bl, n_ha) in m,
+    or (3, n_bl, n_ha, n_chans) in wavelengths for channel freqs [Hz]
+    """
+    rot = rotation(ha, dec).astype(dtype)
+    coords = np.einsum('hij,bj->ibh', rot, np.asarray(bl_xyz, dtype=dtype))
+    if freqs is None:
+        return coords
+    scale = (np.asarray(freqs) / C).astype(dtype)
+    return coords[..., np.newaxis] * scale
+
+
+def iter_uvw(bl_xyz,
+             ha,
+             dec,
+             freqs=None,
+             dtype=np.float32,
+             max_mem_mb=256.):
+    """
+    uvw in chunks of hour angles and channels limited to max_mem_mb,
+    yields (ha slice, channel slice, uvw chunk)
+    """
+    n_bl = len(bl_xyz)
+    n_ha = len(np.atleast_1d(ha))
+    n_chans = 1 if freqs is None else len(freqs)
+    itemsize = np.dtype(dtype).itemsize
+    max_values = max(1, int(max_mem_mb * 1024 ** 2 // (3 * n_bl * itemsize)))
+    chan_step = min(n_chans, max_values)
+    ha_step = max(1, min(n_ha, max_values // chan_step))
+    ha = np.atleast_1d(ha)
+    for ha_start in range(0, n_ha, ha_step):
+        ha_sel = slice(ha_start, min(ha_start + ha_step, n_ha))
+        for chan_start in range(0, n_chans, chan_step):
+            chan_sel = slice(chan_start, min(chan_start + chan_step, n_chans))
+            chunk_freqs = None if freqs is None else freqs[chan_sel]
+            yield ha_sel, chan_sel, uvw(bl_xyz, ha[ha_sel], dec,
+                                        freqs=chunk_freqs, dtype=dtype)
+
+
+def hour_angles(start_ha, duration, n_slots):
+    """Hour angles [rad] of n_slots + 1 samples from start_ha [rad] over duration [s]"""
+    dtime = np.linspace(0., duration, n_slots + 1)
+    return start_ha + 2. * np.pi * dtime / SIDEREAL_DAY
+
+
+## -- notebook implementation, for comparison --
+def _baseline_length_azimuth(enu):
+    """MKAT.baselines of the notebook, in m"""
+    n_ants = len(enu)
+    n_bl = n_ants * (n_ants - 1) // 2
+    bl_length = np.zeros((n_bl, ))
+    bl_az_angle = np.zeros((n_bl, ))
+    cnt = 0
+    for idx0 in range(n_ants):
+        for idx1 in range(idx0 + 1, n_ants):
+            d_north = enu[idx1, 1] - enu[idx0, 1]
+            d_east = enu[idx1, 0] - enu[idx0, 0]
+            bl_length[cnt] = np.sqrt(d_north ** 2 + d_east ** 2)
+            bl_az_angle[cnt] = np.arctan2(d_east, d_north)
+            cnt += 1
+    return bl_length, bl_az_angle
+
+
+def _track_uv_loop(latitude, dec, ha_range, bl_length, bl_azimuth):
+    """UVplot.track_uv of the notebook for one baseline, elevation 0"""
+    x = -np.sin(latitude) * np.cos(bl_azimuth)
+    y = np.sin(bl_azimuth)
+    z = np.cos(latitude) * np.cos(bl_azimuth)
+    xyz = bl_length * np.array([x, y, z])
+    uvw_ = np.zeros((len(ha_range), 3), dtype=float)
+    for i, ha in enumerate(ha_range):
+        rot = np.array([[np.sin(ha), np.cos(ha), 0.],
+                        [-np.sin(dec) * np.cos(ha),
+                         np.sin(dec) * np.sin(ha),
+                         np.cos(dec)],
+                        [np.cos(dec) * np.cos(ha),
+                         -np.cos(dec) * np.sin(ha),
+                         np.sin(dec)]])
+        uvw_[i, :] = np.dot(rot, xyz)
+    return uvw_
+
+
+def benchmark(n_ha=480, n_chans=4096, band=(856e6, 1712e6), dec=-1.11):
+    """Wall time [s] of the notebook loops and the vectorized tracks"""
+    _, enu, latitude = read_layout()
+    enu = enu * [1., 1., 0.]  # the notebook ignores the height offsets
+    ha = hour_angles(-np.pi / 3., 8 * 3600., n_ha - 1)
+    freqs = np.linspace(band[0], band[1], n_chans, endpoint=False)
+
+    start = time.time()
+    bl_length, bl_azimuth = _baseline_length_azimuth(enu)
+    loop = np.array([_track_uv_loop(latitude, dec, ha, length, azimuth)
+                     for length, azimuth in zip(bl_length, bl_azimuth)])
+    loop_s = time.time() - start
+
+    start = time.time()
+    bl_xyz = baselines(enu_to_xyz(enu, latitude))
+    tracks = uvw(bl_xyz, ha, dec)
+    vector_s = time.time() - start
+
+    start = time.time()
+    n_values = 0
+    for _, _, chunk in iter_uvw(bl_xyz, ha, dec, freqs=freqs):
+        n_values += chunk.size
+    band_s = time.time() - start
+
+    diff = np.abs(tracks.transpose(1, 2, 0) - loop).max()
+    return {'loop_s': loop_s,
+            'vector_s': vector_s,
+            'full_band_s': band_s,
+            'full_band_values': n_values,
+            'max_diff_m': diff,
+            }
+
+
+def cli():
+    usage = "%%prog [options]"
+    description = 'benchmark UV track computation for the MeerKAT array'
+
+    parser = argparse.ArgumentParser(
+            usage=usage,
+            description=description,
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+            '--n-ha',
+            type=int,
+            default=480,
+            help='number of hour angles over an 8 hour track',
+            )
+    parser.add_argument(
+            '--n-chans',
+            type=int,
+            default=4096,
+            help='number of channels over L-band',
+            )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = cli()
+    result = benchmark(n_ha=args.n_ha, n_chans=args.n_chans)
+    print('notebook loops: {:.3f} s'.format(result['loop_s']))
+    print('vectorized: {:.4f} s, max difference {:.2e} m'.format(
+        result['vector_s'], result['max_diff_m']))
+    print('full band, float32 chunks: {:.3f} s for {} values'.format(
+        result['full_band_s'], result['full_band_values']))
+
+# -fin-
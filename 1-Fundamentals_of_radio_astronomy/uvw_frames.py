@@ -0,0 +1,231 @@
+#!/usr/bin/python3
+# UVW of all MeerKAT baselines over an array of observation times
+# Batched form of the astropy and CASA measures calculations of
+# MeerKAT_UV_coverage_with_Astropy_and_CASA.ipynb, which transform the antenna
+# positions for a single obs_time.
+# Reference: [Interferometric UVW calculation using astropy](https://gist.github.com/demorest/8c8bca4ac5860796593ca07006cc3df6)
+#
+# All frame transforms take the full Time array at once:
+# the ITRS to GCRS rotation matrix of each time is the GCRS position of the
+# three ITRS unit vectors, and the target direction in GCRS gives the UVW axes,
+# U east, V north and W towards the target (the skyoffset_frame of the notebook).
+# The fast mode replaces the frame transforms with the analytic Earth rotation,
+# the hour angle rotation of uv_tracks.py at the local sidereal time, and the
+# IAU 1976 precession to J2000, within FAST_TOLERANCE of the baseline length.
+
+import mkat_antennas
+import numpy as np
+import uv_tracks
+
+# fast mode error relative to the baseline length, from nutation (< 17.2"),
+# annual aberration (< 20.5") and UT1 - UTC (< 0.9 s) that are ignored
+FAST_TOLERANCE = 3e-4
+_MJD_J2000 = 51544.5
+_ARCSEC = np.pi / (180. * 3600.)
+
+
+def to_mjd(times):
+    """UTC MJD of an astropy Time array, or MJD values"""
+    if hasattr(times, 'utc'):
+        return np.atleast_1d(times.utc.mjd)
+    return np.atleast_1d(np.asarray(times, dtype=np.float64))
+
+
+def gmst(mjd):
+    """Greenwich mean sidereal time [rad], IAU 1982 with UT1 = UTC"""
+    t_ut = (np.asarray(mjd) - _MJD_J2000) / 36525.
+    seconds = (67310.54841 +
+               (876600. * 3600. + 8640184.812866) * t_ut +
+               0.093104 * t_ut ** 2 -
+               6.2e-6 * t_ut ** 3)
+    return np.radians(np.mod(seconds, 86400.) / 240.)
+
+
+def _rot_z(angle):
+    """Rotations of the coordinate frame about z by angle [rad], (n, 3, 3)"""
+    angle = np.atleast_1d(angle)
+    rot = np.zeros(angle.shape + (3, 3))
+    rot[:, 0, 0] = rot[:, 1, 1] = np.cos(angle)
+    rot[:, 0, 1] = np.sin(angle)
+    rot[:, 1, 0] = -np.sin(angle)
+    rot[:, 2, 2] = 1.
+    return rot
+
+
+def _rot_y(angle):
+    """Rotations of the coordinate frame about y by angle [rad], (n, 3, 3)"""
+    angle = np.atleast_1d(angle)
+    rot = np.zeros(angle.shape + (3, 3))
+    rot[:, 0, 0] = rot[:, 2, 2] = np.cos(angle)
+    rot[:, 0, 2] = -np.sin(angle)
+    rot[:, 2, 0] = np.sin(angle)
+    rot[:, 1, 1] = 1.
+    return rot
+
+
+def precession(mjd):
+    """IAU 1976 precession matrices, J2000 to mean equator of date, (n, 3, 3)"""
+    t_tt = (np.atleast_1d(mjd) - _MJD_J2000) / 36525.
+    zeta = (2306.2181 * t_tt + 0.30188 * t_tt ** 2 + 0.017998 * t_tt ** 3) * _ARCSEC
+    z = (2306.2181 * t_tt + 1.09468 * t_tt ** 2 + 0.018203 * t_tt ** 3) * _ARCSEC
+    theta = (2004.3109 * t_tt - 0.42665 * t_tt ** 2 - 0.041833 * t_tt ** 3) * _ARCSEC
+    return np.einsum('nij,njk,nkl->nil', _rot_z(-z), _rot_y(theta), _rot_z(-zeta))
+
+
+def _target_axes(ra, dec):
+    """Rows U (east), V (north), W (target) of a direction, (3, 3)"""
+    return np.array([[-np.sin(ra), np.cos(ra), 0.],
+                     [-np.sin(dec) * np.cos(ra), -np.sin(dec) * np.sin(ra), np.cos(dec)],
+                     [np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)]])
+
+
+def itrf_positions(filename=uv_tracks.LAYOUT):
+    """Antenna names, ITRF positions [m] (n_ants, 3) and the reference EarthLocation"""
+    from astropy.coordinates import EarthLocation
+    import astropy.units as u
+
+    antennas, reference = mkat_antennas.load(filename)
+    telescope = EarthLocation.from_geocentric(reference['x'],
+                                              reference['y'],
+                                              reference['z'],
+                                              unit=u.m)
+    return list(antennas['name']), mkat_antennas.itrf(antennas), telescope
+
+
+def itrs_to_gcrs(times):
+    """ITRS to GCRS rotation matrices, (n_times, 3, 3), one batched transform"""
+    from astropy.coordinates import EarthLocation
+    import astropy.units as u
+
+    n_times = len(times)
+    axes = EarthLocation.from_geocentric(
+            *np.broadcast_to(np.eye(3), (n_times, 3, 3)).transpose(2, 0, 1),
+            unit=u.m)
+    obstime = times.reshape((n_times, 1))[:, [0, 0, 0]]
+    pos, _ = axes.get_gcrs_posvel(obstime)
+    # columns are the GCRS images of the ITRS unit vectors
+    return pos.xyz.to_value(u.m).transpose(1, 0, 2)
+
+
+def uvw_axes(target, times, telescope=None):
+    """Unit U, V, W vectors in GCRS per time, (n_times, 3, 3), rows U, V, W"""
+    from astropy.coordinates import GCRS
+
+    if telescope is None:
+        frame = GCRS(obstime=times)
+    else:
+        tel_p, tel_v = telescope.get_gcrs_posvel(times)
+        frame = GCRS(obstime=times, obsgeoloc=tel_p, obsgeovel=tel_v)
+    w = target.transform_to(frame).cartesian.xyz.value.T
+    w = w / np.linalg.norm(w, axis=-1, keepdims=True)
+    u_ = np.cross([0., 0., 1.], w)
+    u_ /= np.linalg.norm(u_, axis=-1, keepdims=True)
+    v = np.cross(w, u_)
+    return np.stack((u_, v, w), axis=1)
+
+
+def uvw_astropy(itrf, target, times, telescope=None, dtype=np.float64):
+    """
+    (u, v, w) [m] of the baselines of antennas at ITRF positions (n_ants, 3)
+    towards an astropy SkyCoord, (3, n_bl, n_times)
+    """
+    times = times.reshape(-1)
+    bl_itrf = uv_tracks.baselines(np.asarray(itrf, dtype=np.float64))
+    rot = np.einsum('tij,tjk->tik', uvw_axes(target, times, telescope),
+                    itrs_to_gcrs(times))
+    return np.einsum('tij,bj->ibt', rot, bl_itrf).astype(dtype)
+
+
+def _fast_rotation(longitude, ra, dec, mjd):
+    """Local meridian XYZ to UVW rotation matrices per time, (n_times, 3, 3)"""
+    lst = gmst(mjd) + longitude
+    # local meridian XYZ -> mean equator of date -> J2000 -> UVW
+    return np.einsum('ij,tkj,tkl->til',
+                     _target_axes(ra, dec), precession(mjd), _rot_z(-lst))
+
+
+def uvw_fast(enu, latitude, longitude, ra, dec, times, dtype=np.float64):
+    """
+    (u, v, w) [m] from the Earth rotation angle, (3, n_bl, n_times),
+    ENU offsets (n_ants, 3), site latitude and longitude [rad],
+    J2000 ra and dec [rad], astropy Time or UTC MJD values
+    """
+    rot = _fast_rotation(longitude, ra, dec, to_mjd(times))
+    bl_xyz = uv_tracks.baselines(uv_tracks.enu_to_xyz(enu, latitude))
+    return np.einsum('tij,bj->ibt', rot, bl_xyz).astype(dtype)
+
+
+def elevation(latitude, longitude, ra, dec, times):
+    """
+    Elevation [rad] of J2000 ra, dec [rad] at the site latitude and
+    longitude [rad], per time, with the fast mode Earth rotation and precession
+    """
+    rot = _fast_rotation(longitude, ra, dec, to_mjd(times))
+    # W axis in local meridian XYZ against the zenith
+    zenith = np.array([np.cos(latitude), 0., np.sin(latitude)])
+    return np.arcsin(np.clip(rot[:, 2].dot(zenith), -1., 1.))
+
+
+def uvw_casa(itrf, ra, dec, times, observatory='MeerKAT'):
+    """
+    (u, v, w) [m] from me.touvw per time, (3, n_bl, n_times),
+    for validation of the batched calculations
+    """
+    import casatools
+    me = casatools.measures()
+    qa = casatools.quanta()
+    qq = qa.quantity
+
+    itrf = np.asarray(itrf, dtype=np.float64)
+    me.doframe(me.observatory(observatory))
+    me.doframe(me.direction('J2000', qq(ra, 'rad'), qq(dec, 'rad')))
+    positions = me.position('ITRF',
+                            qq(itrf[:, 0], 'm'),
+                            qq(itrf[:, 1], 'm'),
+                            qq(itrf[:, 2], 'm'))
+    ant_uvw = []
+    for mjd in to_mjd(times):
+        me.doframe(me.epoch('UTC', qq(mjd, 'd')))
+        sph = me.touvw(me.asbaseline(positions))[0]
+        lon = qa.convert(sph['m0'], 'rad')['value']
+        lat = qa.convert(sph['m1'], 'rad')['value']
+        dist = qa.convert(sph['m2'], 'm')['value']
+        ant_uvw.append(np.column_stack((dist * np.cos(lat) * np.cos(lon),
+                                        dist * np.cos(lat) * np.sin(lon),
+                                        dist * np.sin(lat))))
+    ant_uvw = np.array(ant_uvw)
+    bl_uvw = uv_tracks.baselines(ant_uvw.transpose(1, 0, 2))
+    return bl_uvw.transpose(2, 0, 1)
+
+
+def cross_check(target, times, filename=uv_tracks.LAYOUT):
+    """
+    Largest difference of the fast and CASA calculations from the astropy
+    calculation, relative to the baseline length. CASA is skipped, None,
+    if casatools is not available
+    """
+    _, itrf, telescope = itrf_positions(filename)
+    _, enu, latitude = uv_tracks.read_layout(filename)
+    ra = target.icrs.ra.rad
+    dec = target.icrs.dec.rad
+
+    reference = uvw_astropy(itrf, target, times, telescope=telescope)
+    length = np.linalg.norm(reference, axis=0)
+    length[length == 0] = 1.
+
+    def _rel(values):
+        return float((np.linalg.norm(values - reference, axis=0) / length).max())
+
+    result = {'fast': _rel(uvw_fast(enu, latitude, telescope.lon.rad,
+                                    ra, dec, times)),
+              'fast_tolerance': FAST_TOLERANCE,
+              'casa': None,
+              }
+    try:
+        import casatools  # noqa: F401
+    except ImportError:
+        return result
+    result['casa'] = _rel(uvw_casa(itrf, ra, dec, times))
+    return result
+
+# -fin-
@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+# Automated statistical RFI detection using the SumThreshold method
+# Offringa et al. 2010, MNRAS 405, 155
+#
+# The detector works on (time, freq, pol) cubes with NumPy and can be run on
+# synthetic data; the streaming layer reads the visibilities of each baseline
+# per scan and spectral window in blocks of dumps, so that memory use is
+# bounded by the block size
+
+import numpy as np
+import warnings
+
+# robust standard deviation from the median absolute deviation
+MAD_TO_STD = 1.4826
+
+
+def _table():
+    try:
+        from casatools import table
+    except ImportError:
+        from taskinit import tbtool as table
+    return table()
+
+
+def _window_sums(values, width):
+    """Sum over all windows of width samples along the last axis"""
+    csum = np.cumsum(values, axis=-1)
+    zeros = np.zeros(values.shape[:-1] + (1,), dtype=csum.dtype)
+    csum = np.concatenate((zeros, csum), axis=-1)
+    return csum[..., width:] - csum[..., :-width]
+
+
+def _spread(windows, width, n_samples):
+    """Mark every sample covered by a selected window along the last axis"""
+    counts = np.cumsum(windows, axis=-1, dtype=np.int64)
+    zeros = np.zeros(windows.shape[:-1] + (1,), dtype=counts.dtype)
+    counts = np.concatenate((zeros, counts), axis=-1)
+    idx = np.arange(n_samples)
+    upper = np.minimum(idx + 1, windows.shape[-1])
+    lower = np.clip(idx - width + 1, 0, windows.shape[-1])
+    return (counts[..., upper] - counts[..., lower]) > 0
+
+
+def _sumthreshold_1d(values, flags, chi_1, rho, windows):
+    """SumThreshold along the last axis, for all leading axes at once"""
+    n_samples = values.shape[-1]
+    flags = flags.copy()
+    for width in windows:
+        if width > n_samples:
+            break
+        chi = chi_1 / rho ** np.log2(width)
+        # flagged samples are set to the threshold and do not add excess
+        neutral = np.where(flags, chi, values)
+        exceed = _window_sums(neutral, width) > width * chi
+        flags |= _spread(exceed, width, n_samples)
+    return flags
+
+
+def sumthreshold(values,
+                 flags,
+                 chi_1=6.,
+                 rho=1.5,
+                 windows=(1, 2, 4, 8, 16, 32, 64),
+                 axes=(0, 1)):
+    """
+    SumThreshold flagging of normalised deviations along each axis.
+    Thresholds for a window of M samples are chi_1 / rho**log2(M)
+    """
+    flags = np.asarray(flags, dtype=bool)
+    for axis in axes:
+        vals = np.moveaxis(values, axis, -1)
+        flg = np.moveaxis(flags, axis, -1)
+        flags = np.moveaxis(_sumthreshold_1d(vals, flg, chi_1, rho, windows),
+                            -1, axis)
+    return flags
+
+
+def dilate(flags, size, axis):
+    """Binary dilation of flags by size samples either side along axis"""
+    if size < 1:
+        return flags
+    flg = np.moveaxis(flags, axis, -1)
+    n_samples = flg.shape[-1]
+    width = 2 * size + 1
+    padded = np.zeros(flg.shape[:-1] + (n_samples + 2 * size,), dtype=np.int64)
+    padded[..., size:size + n_samples] = flg
+    dilated = _window_sums(padded, width) > 0
+    return np.moveaxis(dilated, -1, axis)
+
+
+def _running_median(values, width, axis):
+    """Running NaN-median over width samples along axis, edges padded"""
+    vals = np.moveaxis(values, axis, -1)
+    half = width // 2
+    padded = np.pad(vals, [(0, 0)] * (vals.ndim - 1) + [(half, half)],
+                    mode='edge')
+    windows = np.lib.stride_tricks.sliding_window_view(padded, width, axis=-1)
+    return np.moveaxis(np.nanmedian(windows, axis=-1), -1, axis)
+
+
+def robust_deviations(amp, flags, bp_width=31, gain_width=31):
+    """
+    Deviations from a smooth time-frequency background of the unflagged data,
+    normalised by the MAD of the residuals, per polarisation.
+    The background is the running median of the bandpass over bp_width
+    channels, scaled by the running median gain over gain_width dumps, so that
+    stationary narrowband RFI and short broadband bursts are not absorbed
+    into the background
+    """
+    masked = np.where(flags, np.nan, amp)
+    # fully flagged channels and dumps give all-NaN slices
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        bandpass = np.nanmedian(masked, axis=0, keepdims=True)
+        if bp_width > 1 and amp.shape[1] > bp_width:
+            bandpass = _running_median(bandpass, bp_width, axis=1)
+        gain = np.nanmedian(masked / bandpass, axis=1, keepdims=True)
+        if gain_width > 1 and amp.shape[0] > gain_width:
+            gain = _running_median(gain, gain_width, axis=0)
+        background = np.nan_to_num(bandpass * gain)
+        residual = masked - background
+        mad = np.nanmedian(np.abs(residual), axis=(0, 1), keepdims=True)
+    sigma = MAD_TO_STD * mad
+    sigma = np.where(np.isfinite(sigma) & (sigma > 0), sigma, np.inf)
+    deviation = np.nan_to_num((amp - background) / sigma)
+    # amplitudes are skewed, centre on the clipped mean rather than the
+    # median so that long windows do not accumulate a bias
+    inliers = ~flags & (np.abs(deviation) < 5.)
+    n_inliers = np.maximum(inliers.sum(axis=(0, 1), keepdims=True), 1)
+    offset = np.where(inliers, deviation, 0.).sum(axis=(0, 1), keepdims=True)
+    return deviation - offset / n_inliers
+
+
+def flag_cube(vis,
+              flags=None,
+              chi_1=6.,
+              rho=1.5,
+              n_iter=2,
+              dilate_time=1,
+              dilate_freq=2,
+              combine_pols=True):
+    """
+    Detect RFI in a (time, freq, pol) visibility cube.
+    Robust statistics are recomputed from the unflagged data for each iteration.
+    Returns the updated (time, freq, pol) flags
+    """
+    amp = np.abs(vis).astype(np.float32)
+    if flags is None:
+        flags = np.zeros(amp.shape, dtype=bool)
+    flags = np.asarray(flags, dtype=bool) | ~np.isfinite(amp)
+    new_flags = flags
+    for _ in range(n_iter):
+        deviation = robust_deviations(amp, new_flags)
+        new_flags = sumthreshold(deviation,
+                                 new_flags,
+                                 chi_1=chi_1,
+                                 rho=rho)
+    if combine_pols:
+        new_flags = np.repeat(new_flags.any(axis=-1, keepdims=True),
+                              new_flags.shape[-1], axis=-1)
+    new_flags = dilate(new_flags, dilate_time, axis=0)
+    new_flags = dilate(new_flags, dilate_freq, axis=1)
+    return flags | new_flags
+
+
+def baseline_row_ranges(ant1, ant2):
+    """Contiguous (start, stop) rows per baseline of a baseline sorted table"""
+    ant1 = np.asarray(ant1)
+    ant2 = np.asarray(ant2)
+    change = np.flatnonzero((np.diff(ant1) != 0) | (np.diff(ant2) != 0)) + 1
+    starts = np.concatenate(([0], change))
+    stops = np.concatenate((change, [len(ant1)]))
+    cross = ant1[starts] != ant2[starts]
+    return list(zip(starts[cross].tolist(), stops[cross].tolist()))
+
+
+def dumps_per_block(n_chans, n_pols, max_mem_mb=512.):
+    """Number of dumps per block to bound the memory use of one block"""
+    # complex64 data, float32 amplitudes and deviations, boolean flags
+    bytes_per_dump = n_chans * n_pols * (8 + 4 + 4 + 4 * 1)
+    return max(1, int(max_mem_mb * 1024 ** 2 // bytes_per_dump))
+
+
+def auto_flagging(msfile,
+                  datacolumn='DATA',
+                  max_mem_mb=512.,
+                  **kwargs):
+    """
+    Stream the visibilities of each baseline per scan and spectral window
+    in blocks of dumps, detect RFI and write the flags back in bulk per block.
+    Windows do not span block boundaries.
+    Returns the number of flagged and total samples
+    """
+    tb = _table()
+    tb.open(msfile, nomodify=False)
+    n_flagged = 0
+    n_total = 0
+    try:
+        # spectral windows differ in channels and have separate time axes
+        scan_spws = np.unique(np.stack((tb.getcol('SCAN_NUMBER'),
+                                        tb.getcol('DATA_DESC_ID')), axis=1),
+                              axis=0)
+        for scan, ddid in scan_spws:
+            subtb = tb.query('SCAN_NUMBER=={} && DATA_DESC_ID=={}'.format(scan,
+                                                                          ddid),
+                             sortlist='ANTENNA1,ANTENNA2,TIME')
+            try:
+                ranges = baseline_row_ranges(subtb.getcol('ANTENNA1'),
+                                             subtb.getcol('ANTENNA2'))
+                if len(ranges) < 1:
+                    continue
+                n_pols, n_chans = subtb.getcell('FLAG', 0).shape
+                block = dumps_per_block(n_chans, n_pols, max_mem_mb)
+                for start, stop in ranges:
+                    for row in range(start, stop, block):
+                        nrow = min(block, stop - row)
+                        # CASA columns are (pol, chan, row)
+                        vis = subtb.getcol(datacolumn, startrow=row, nrow=nrow).T
+                        flags = subtb.getcol('FLAG', startrow=row, nrow=nrow).T
+                        flags = flag_cube(vis, flags, **kwargs)
+                        subtb.putcol('FLAG', flags.T.copy(), startrow=row, nrow=nrow)
+                        n_flagged += int(flags.sum())
+                        n_total += flags.size
+            finally:
+                subtb.close()
+    finally:
+        tb.close()
+    return n_flagged, n_total
+
+# -fin-
@@ -0,0 +1,344 @@
+#!/usr/bin/python3
+# Batch flagging, calibration and inspection of multiple observations
+# Each observation in the manifest is processed as a job running
+# flagging_mkat_lband.py, calibrating_mkat_lband.py and inspect_cal_solutions.py
+# in turn, in its own working directory. Jobs run concurrently within limits on
+# the number of jobs, memory and scratch disk, highest priority first.
+# A job fails if its calibration solutions do not pass the QA checks.
+#
+# Example manifest
+#   casa: casa --nogui --nologger --log2term -c
+#   flagging: [--zeros, --bp, --lband, --gps, --glonass, --galileo]
+#   observations:
+#   - msfile: /data/1548939342_sdp_l0.ms
+#     fluxcal: J1939-6342
+#     gaincal: J1726-5529
+#     target: NGC3621
+#     priority: 10
+#     memory_gb: 32
+#     scratch_gb: 100
+
+import argparse
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+import yaml
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CASA = 'casa --nogui --nologger --log2term -c'
+
+
+def cli():
+    usage = "%%prog [options] --manifest <manifest.yml>"
+    description = 'flag, calibrate and inspect multiple observations'
+
+    parser = argparse.ArgumentParser(
+            usage=usage,
+            description=description,
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+            '--manifest',
+            type=str,
+            required=True,
+            help='YAML manifest of measurement sets and calibrators',
+            )
+    parser.add_argument(
+            '--max-jobs',
+            type=int,
+            default=4,
+            help='maximum number of observations processed concurrently',
+            )
+    parser.add_argument(
+            '--max-mem',
+            type=float,
+            default=64.,
+            help='total memory [GB] that running jobs may reserve',
+            )
+    parser.add_argument(
+            '--max-scratch',
+            type=float,
+            default=1000.,
+            help='total scratch disk [GB] that running jobs may reserve',
+            )
+    parser.add_argument(
+            '--max-wait',
+            type=int,
+            default=60,
+            help='polls the highest priority queued job waits before lower '
+                 'priority jobs no longer start ahead of it',
+            )
+    parser.add_argument(
+            '--scratch-dir',
+            type=str,
+            default='batch',
+            help='directory for the working directory of each job',
+            )
+    parser.add_argument(
+            '--log-dir',
+            type=str,
+            default='batch_logs',
+            help='directory for the log file of each job',
+            )
+    parser.add_argument(
+            '--status',
+            type=str,
+            default='batch_status.json',
+            help='file with the exit status of each job',
+            )
+    return parser.parse_args()
+
+
+class Job(object):
+    """
+    Observation processed as a chain of steps, each step is a command line.
+    memory_gb and scratch_gb are reserved while the job is running
+    """
+
+    def __init__(self,
+                 name,
+                 steps,
+                 priority=0,
+                 memory_gb=0.,
+                 scratch_gb=0.,
+                 workdir=None):
+        self.name = name
+        self.steps = steps
+        self.priority = priority
+        self.memory_gb = memory_gb
+        self.scratch_gb = scratch_gb
+        self.workdir = workdir
+        self.status = 'queued'
+        self.returncode = None
+        self.failed_step = None
+        self.start = None
+        self.end = None
+        self._step = 0
+        self._waited = 0
+        self._proc = None
+        self._log = None
+
+    def summary(self, log_dir):
+        wall = None
+        if self.start is not None and self.end is not None:
+            wall = round(self.end - self.start, 3)
+        log = None
+        if self.start is not None:
+            log = os.path.join(log_dir, '{}.log'.format(self.name))
+        return {'status': self.status,
+                'returncode': self.returncode,
+                'failed_step': self.failed_step,
+                'wall_s': wall,
+                'log': log,
+                }
+
+
+def _prefix(msfile):
+    return os.path.splitext(os.path.basename(msfile.rstrip('/')))[0]
+
+
+def observation_steps(obs, casa=CASA, flagging=()):
+    """Command lines to flag, calibrate and inspect one observation"""
+    casa = shlex.split(casa)
+    msfile = os.path.abspath(obs['msfile'])
+    prefix = _prefix(msfile)
+
+    flag = ([os.path.join(SCRIPT_DIR, 'flagging_mkat_lband.py'),
+             '--msfile', msfile] +
+            list(obs.get('flagging', flagging)))
+
+    calibrate = [os.path.join(SCRIPT_DIR, 'calibrating_mkat_lband.py'),
+                 '--msfile', msfile,
+                 '--fluxcal', obs['fluxcal']]
+    for key, option in (('bpcal', '--bpcal'),
+                        ('delaycal', '--delaycal'),
+                        ('gaincal', '--gaincal'),
+                        ('target', '--target'),
+                        ('ref_ant', '--ref-ant'),
+                        ('ref_chans', '--ref-chans')):
+        if obs.get(key):
+            calibrate += [option, obs[key]]
+    calibrate += list(obs.get('calibration', ['--applycal']))
+
+    inspect = [os.path.join(SCRIPT_DIR, 'inspect_cal_solutions.py'),
+               '--delaycal', prefix + '.K',
+               '--bpcal', prefix + '.B',
+               '--gaincal', prefix + '.G',
+               '--primary', obs['fluxcal'],
+               '--qa', prefix + '_qa.json']
+    if obs.get('gaincal'):
+        inspect += ['--secondary', obs['gaincal']]
+
+    return [casa + flag, casa + calibrate, casa + inspect]
+
+
+def read_manifest(filename, scratch_dir='batch'):
+    """Jobs for all observations in the manifest"""
+    with open(filename, 'r') as fin:
+        manifest = yaml.safe_load(fin)
+    casa = manifest.get('casa', CASA)
+    flagging = manifest.get('flagging', [])
+    jobs = []
+    for obs in manifest['observations']:
+        name = obs.get('name', _prefix(obs['msfile']))
+        steps = obs.get('steps')
+        if steps is None:
+            steps = observation_steps(obs, casa=casa, flagging=flagging)
+        jobs.append(Job(name,
+                        steps,
+                        priority=obs.get('priority', 0),
+                        memory_gb=obs.get('memory_gb', 0.),
+                        scratch_gb=obs.get('scratch_gb', 0.),
+                        workdir=os.path.join(scratch_dir, name)))
+    return jobs
+
+
+def _free_gb(path):
+    while not os.path.exists(path):
+        path = os.path.dirname(os.path.abspath(path))
+    return shutil.disk_usage(path).free / 1024. ** 3
+
+
+class Scheduler(object):
+    """
+    Run jobs concurrently within limits on the number of running jobs and
+    the memory and scratch disk they reserve.
+    Queued jobs start in order of priority, lower priority jobs that fit
+    within the remaining resources start ahead of a larger job that does not,
+    until that job has waited max_wait polls. Resources freed after that are
+    kept for it
+    """
+
+    def __init__(self,
+                 jobs,
+                 max_jobs=4,
+                 max_mem_gb=64.,
+                 max_scratch_gb=1000.,
+                 log_dir='batch_logs',
+                 poll=1.,
+                 max_wait=60):
+        self.jobs = jobs
+        self.max_jobs = max_jobs
+        self.max_mem_gb = max_mem_gb
+        self.max_scratch_gb = max_scratch_gb
+        self.log_dir = log_dir
+        self.poll = poll
+        self.max_wait = max_wait
+        # stable sort, manifest order within a priority
+        self.queue = sorted(jobs, key=lambda job: -job.priority)
+        self.running = []
+
+    def _reserved(self):
+        return (sum(job.memory_gb for job in self.running),
+                sum(job.scratch_gb for job in self.running))
+
+    def _fits(self, job):
+        mem, scratch = self._reserved()
+        if len(self.running) >= self.max_jobs:
+            return False
+        if mem + job.memory_gb > self.max_mem_gb:
+            return False
+        if scratch + job.scratch_gb > self.max_scratch_gb:
+            return False
+        if job.workdir is not None and job.scratch_gb > 0:
+            # other processes may also be using the scratch disk
+            if _free_gb(job.workdir) < job.scratch_gb:
+                return False
+        return True
+
+    def _start_step(self, job):
+        cmd = job.steps[job._step]
+        job._log.write('### step {}: {}\n'.format(job._step + 1, ' '.join(cmd)))
+        job._log.flush()
+        job._proc = subprocess.Popen(cmd,
+                                     cwd=job.workdir,
+                                     stdout=job._log,
+                                     stderr=subprocess.STDOUT)
+
+    def _start(self, job):
+        if job.workdir is not None and not os.path.isdir(job.workdir):
+            os.makedirs(job.workdir)
+        job._log = open(os.path.join(self.log_dir, '{}.log'.format(job.name)), 'w')
+        job.status = 'running'
+        job.start = time.time()
+        self.running.append(job)
+        print('Starting {}'.format(job.name))
+        self._start_step(job)
+
+    def _finish(self, job, status):
+        job.status = status
+        job.end = time.time()
+        job._log.write('### {}, exit status {}\n'.format(status, job.returncode))
+        job._log.close()
+        self.running.remove(job)
+        print('{} {} ({:.1f} s)'.format(job.name, status, job.end - job.start))
+
+    def _check(self, job):
+        returncode = job._proc.poll()
+        if returncode is None:
+            return
+        job.returncode = returncode
+        if returncode != 0:
+            job.failed_step = job._step + 1
+            self._finish(job, 'failed')
+        elif job._step + 1 < len(job.steps):
+            job._step += 1
+            self._start_step(job)
+        else:
+            self._finish(job, 'done')
+
+    def run(self):
+        """Process all jobs, returns the exit status per job"""
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        for job in list(self.queue):
+            if (job.memory_gb > self.max_mem_gb or
+                    job.scratch_gb > self.max_scratch_gb):
+                print('{} exceeds the resource limits, skipping'.format(job.name))
+                job.status = 'rejected'
+                self.queue.remove(job)
+        while self.queue or self.running:
+            blocked = None
+            for job in list(self.queue):
+                if self._fits(job):
+                    self.queue.remove(job)
+                    self._start(job)
+                elif blocked is None:
+                    # highest priority job that does not fit
+                    blocked = job
+                    job._waited += 1
+                    if job._waited > self.max_wait:
+                        break
+            if self.queue and not self.running:
+                # nothing running, so nothing will free the scratch disk
+                for job in self.queue:
+                    job.status = 'rejected'
+                    print('{}: not enough free scratch disk'.format(job.name))
+                self.queue = []
+            time.sleep(self.poll)
+            for job in list(self.running):
+                self._check(job)
+        return dict((job.name, job.summary(self.log_dir)) for job in self.jobs)
+
+
+if __name__ == '__main__':
+    args = cli()
+    jobs = read_manifest(args.manifest, scratch_dir=args.scratch_dir)
+    scheduler = Scheduler(jobs,
+                          max_jobs=args.max_jobs,
+                          max_mem_gb=args.max_mem,
+                          max_scratch_gb=args.max_scratch,
+                          log_dir=args.log_dir,
+                          max_wait=args.max_wait)
+    status = scheduler.run()
+    with open(args.status, 'w') as fout:
+        json.dump(status, fout, indent=1, sort_keys=True)
+    n_failed = sum(1 for job in status.values() if job['status'] != 'done')
+    print('{} of {} observations processed'.format(len(status) - n_failed,
+                                                   len(status)))
+    sys.exit(1 if n_failed > 0 else 0)
+
+# -fin-
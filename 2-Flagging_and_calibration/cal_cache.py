@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+# Content addressed cache of calibration tables
+# Tables are stored under a key derived from the task parameters, the keys of
+# the upstream tables and a fingerprint of the MS, so a solve is only repeated
+# when something it depends on has changed.
+# The least recently used entries are evicted to bound the disk usage
+
+import json
+import os
+import shutil
+import time
+
+INDEX = 'index.json'
+
+
+def _du(path):
+    """Disk usage of a table directory in bytes"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        for file_ in files:
+            size += os.path.getsize(os.path.join(root, file_))
+    return size
+
+
+def _copy(src, dst):
+    if os.path.isdir(dst):
+        shutil.rmtree(dst)
+    elif os.path.exists(dst):
+        os.remove(dst)
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, symlinks=True)
+    else:
+        shutil.copy2(src, dst)
+
+
+class TableCache(object):
+    """
+    Calibration tables stored per key in cachedir/<key>/,
+    with total size limited to max_bytes
+    """
+
+    def __init__(self, cachedir, max_bytes=50 * 1024 ** 3):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        self._index = self._load_index()
+
+    def _load_index(self):
+        filename = os.path.join(self.cachedir, INDEX)
+        if not os.path.isfile(filename):
+            return {}
+        with open(filename, 'r') as fin:
+            index = json.load(fin)
+        # drop entries removed from disk
+        return dict((key, entry) for key, entry in index.items()
+                    if os.path.isdir(os.path.join(self.cachedir, key)))
+
+    def _save_index(self):
+        filename = os.path.join(self.cachedir, INDEX)
+        tmpfile = filename + '.tmp'
+        with open(tmpfile, 'w') as fout:
+            json.dump(self._index, fout, indent=1, sort_keys=True)
+        os.rename(tmpfile, filename)
+
+    def size(self):
+        return sum(entry['size'] for entry in self._index.values())
+
+    def has(self, key, tables):
+        """True if all tables are cached under key"""
+        entry = self._index.get(key)
+        if entry is None:
+            return False
+        return all(os.path.basename(table) in entry['tables']
+                   for table in tables)
+
+    def restore(self, key, tables):
+        """Copy the cached tables to their working location"""
+        for table in tables:
+            _copy(os.path.join(self.cachedir, key, os.path.basename(table)),
+                  table)
+        self._index[key]['last_used'] = time.time()
+        self._save_index()
+
+    def store(self, key, tables):
+        """Add copies of the tables to the cache under key"""
+        entrydir = os.path.join(self.cachedir, key)
+        if os.path.isdir(entrydir):
+            shutil.rmtree(entrydir)
+        os.makedirs(entrydir)
+        for table in tables:
+            _copy(table, os.path.join(entrydir, os.path.basename(table)))
+        self._index[key] = {'tables': [os.path.basename(table)
+                                       for table in tables],
+                            'size': _du(entrydir),
+                            'last_used': time.time(),
+                            }
+        self.evict(keep=key)
+        self._save_index()
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until within max_bytes"""
+        entries = sorted(self._index.items(),
+                         key=lambda item: item[1]['last_used'])
+        total = self.size()
+        for key, entry in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.cachedir, key), ignore_errors=True)
+            del self._index[key]
+            total -= entry['size']
+
+# -fin-
@@ -0,0 +1,436 @@
+#!/usr/bin/python3
+# Calibration pipeline as a graph of CASA task nodes
+# Each node declares the tables it reads and writes, dependencies follow from
+# the order in which nodes are added to the graph. Independent nodes can run
+# concurrently and nodes with valid outputs from a previous run are skipped.
+#
+# Resources with '::' in their name, e.g. '<msfile>::MODEL_DATA', are MS
+# columns rather than tables and are only used to order the nodes.
+# Nodes writing to the same table, e.g. applycal of different fields of one MS,
+# are independent but never run at the same time.
+# Nodes with reuse set, e.g. averaged copies of the MS, keep their outputs
+# between runs for as long as their content key is unchanged
+
+import datetime
+import hashlib
+import importlib
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import task_log
+
+STATE_VERSION = 2
+# solves whose output tables can be restored from a table cache
+CACHEABLE_TASKS = ('gaincal', 'bandpass', 'fluxscale')
+# tasks of this package run as graph nodes, task name: (module, function)
+LOCAL_TASKS = {'merge_columns': ('parallel_flagging', 'merge_columns')}
+
+
+def _isfile(resource):
+    return '::' not in resource
+
+
+class Node(object):
+    """
+    CASA task invocation with declared inputs and outputs.
+    outputs are created by the node, modifies are existing resources that
+    the node updates in place, e.g. gaincal with append=True.
+    Outputs of reuse nodes are not recreated when a run starts afresh
+    """
+
+    def __init__(self,
+                 name,
+                 task,
+                 params,
+                 inputs=(),
+                 outputs=(),
+                 modifies=(),
+                 msg=None,
+                 reuse=False):
+        self.name = name
+        self.task = task
+        self.params = params
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.modifies = list(modifies)
+        self.msg = msg
+        self.reuse = reuse
+        self.deps = []
+
+    def cmd(self):
+        """CASA command string for display"""
+        params = ', '.join('{}={!r}'.format(key, self.params[key])
+                           for key in sorted(self.params))
+        return '{}({})'.format(self.task, params)
+
+    def key(self):
+        """Hash of the task, its parameters and declared resources"""
+        ident = [self.task,
+                 sorted(self.params.items()),
+                 self.inputs,
+                 self.outputs,
+                 self.modifies]
+        return hashlib.sha1(repr(ident).encode('utf-8')).hexdigest()
+
+
+class Graph(object):
+    """Calibration nodes in order of addition, with derived dependencies"""
+
+    def __init__(self):
+        self.nodes = []
+        self._names = {}
+        self._writer = {}
+        self._creator = {}
+
+    def __getitem__(self, name):
+        return self._names[name]
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def add(self, node):
+        if node.name in self._names:
+            raise ValueError('Duplicate calibration node {}'.format(node.name))
+        # a node depends on the latest writer of every resource it uses
+        deps = []
+        for resource in node.inputs + node.modifies:
+            writer = self._writer.get(resource)
+            if writer is not None and writer not in deps:
+                deps.append(writer)
+        node.deps = deps
+        for resource in node.outputs:
+            self._creator[resource] = node.name
+        for resource in node.outputs + node.modifies:
+            self._writer[resource] = node.name
+        self.nodes.append(node)
+        self._names[node.name] = node
+        return node
+
+    def creator(self, resource):
+        return self._creator.get(resource)
+
+    def writer(self, resource):
+        """Last node to write the resource"""
+        return self._writer.get(resource)
+
+    def downstream(self, names):
+        """Names of all nodes depending, directly or not, on the given nodes"""
+        names = set(names)
+        for node in self.nodes:
+            if any(dep in names for dep in node.deps):
+                names.add(node.name)
+        return names
+
+
+def content_keys(graph, fingerprint=''):
+    """
+    Key per node from its parameters, the keys of the nodes it depends on
+    and a fingerprint of the data, identifying the contents of its outputs
+    """
+    keys = {}
+    for node in graph.nodes:
+        ident = [fingerprint, node.key()] + [keys[dep] for dep in node.deps]
+        keys[node.name] = hashlib.sha1(
+                repr(ident).encode('utf-8')).hexdigest()
+    return keys
+
+
+def _cached_tables(node):
+    """Tables written by the node that can be restored from a cache"""
+    if node.task not in CACHEABLE_TASKS:
+        return []
+    return _tables(node)
+
+
+def load_state(statefile):
+    if statefile is None or not os.path.isfile(statefile):
+        return {}
+    with open(statefile, 'r') as fin:
+        state = json.load(fin)
+    if state.get('version') != STATE_VERSION:
+        return {}
+    return state.get('nodes', {})
+
+
+def save_state(statefile, nodes):
+    if statefile is None:
+        return
+    tmpfile = statefile + '.tmp'
+    with open(tmpfile, 'w') as fout:
+        json.dump({'version': STATE_VERSION, 'nodes': nodes},
+                  fout, indent=1, sort_keys=True)
+    os.rename(tmpfile, statefile)
+
+
+def _outputs_exist(node):
+    return all(os.path.exists(out) for out in node.outputs if _isfile(out))
+
+
+def _tables(node):
+    return [table for table in node.outputs + node.modifies if _isfile(table)]
+
+
+def _written(node):
+    """Tables written by the node, a column resource counts as its MS"""
+    return set(resource.split('::')[0]
+               for resource in node.outputs + node.modifies)
+
+
+def signature(path):
+    """Number of files, total size and latest modification time of a table"""
+    if not os.path.exists(path):
+        return None
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return [1, stat.st_size, int(stat.st_mtime)]
+    n_files = 0
+    size = 0
+    mtime = 0
+    for root, _, files in os.walk(path):
+        for file_ in files:
+            stat = os.stat(os.path.join(root, file_))
+            n_files += 1
+            size += stat.st_size
+            mtime = max(mtime, int(stat.st_mtime))
+    return [n_files, size, mtime]
+
+
+def record(node, content_key=None):
+    """State of a completed node: parameters and signatures of its tables"""
+    return {'key': node.key(),
+            'content_key': content_key,
+            'task': node.task,
+            'cmd': node.cmd(),
+            'tables': dict((table, signature(table))
+                           for table in _tables(node)),
+            'completed': datetime.datetime.utcnow().isoformat(),
+            }
+
+
+def _completed(graph, node, entry, content_key=None):
+    """
+    Node recorded as completed with the same parameters and its tables
+    unchanged since. Tables modified later on by other nodes need only exist.
+    """
+    if entry is None or entry.get('key') != node.key():
+        return False
+    if content_key is not None and entry.get('content_key') != content_key:
+        return False
+    if not _outputs_exist(node):
+        return False
+    for table in _tables(node):
+        if graph.writer(table) != node.name:
+            continue
+        if entry['tables'].get(table) != signature(table):
+            return False
+    return True
+
+
+def stale_nodes(graph, state, force=False, keys=None):
+    """
+    Nodes that have to run: no record of a completed run with the same
+    parameters, missing or changed tables, or a stale upstream node.
+    A table modified in place cannot be updated on its own, e.g. appended
+    gain solutions, so its creator is re-run as well.
+    With force all nodes run, except reuse nodes completed with the same
+    content key
+    """
+    if keys is None:
+        keys = {}
+
+    def _stale(node):
+        if node.reuse:
+            content_key = keys.get(node.name, '')
+            return not _completed(graph, node, state.get(node.name),
+                                  content_key=content_key)
+        if force:
+            return True
+        return not _completed(graph, node, state.get(node.name))
+
+    stale = set(node.name for node in graph.nodes if _stale(node))
+    while True:
+        stale = graph.downstream(stale)
+        creators = set(graph.creator(resource)
+                       for name in stale
+                       for resource in graph[name].modifies)
+        creators.discard(None)
+        if creators.issubset(stale):
+            return stale
+        stale |= creators
+
+
+def _import_task(task):
+    if task in LOCAL_TASKS:
+        module, function = LOCAL_TASKS[task]
+        return getattr(importlib.import_module(module), function)
+    try:
+        import casatasks as tasks
+    except ImportError:
+        import tasks
+    return getattr(tasks, task)
+
+
+def casa_backend(task, params):
+    """Run the named CASA task"""
+    return _import_task(task)(**params)
+
+
+def placeholder_backend(task, params):
+    """
+    Stand-in for CASA that only creates placeholder tables and figure files,
+    to check the graph and scheduling without CASA
+    """
+    if task == 'rmtables':
+        shutil.rmtree(params['tablenames'], ignore_errors=True)
+        return
+    for key in ('caltable', 'fluxtable', 'outputvis'):
+        if key in params and not os.path.isdir(params[key]):
+            os.makedirs(params[key])
+    if 'figfile' in params:
+        open(params['figfile'], 'a').close()
+
+
+def _clear_outputs(node, backend):
+    # remove existing tables before re-solving
+    for out in node.outputs:
+        if _isfile(out) and os.path.isdir(out):
+            print('Deleting {} before cal\n'.format(out))
+            backend('rmtables', {'tablenames': out})
+
+
+def _run_node(backend, node):
+    _clear_outputs(node, backend)
+    _, timing = task_log.measure(backend, node.task, node.params)
+    return node.name, timing
+
+
+def _announce(node, verbose):
+    if node.msg is not None:
+        border = '#' * (23)
+        print('\n{}### {} ###{}\n'.format(border, node.msg, border))
+    if verbose:
+        print(node.cmd())
+
+
+def _check_outputs(node):
+    if not _outputs_exist(node):
+        raise RuntimeError('No {} solution, exiting...'.format(node.name))
+
+
+def run(graph,
+        backend=casa_backend,
+        workers=1,
+        statefile=None,
+        force=False,
+        dry_run=False,
+        verbose=False,
+        log=None,
+        cache=None,
+        fingerprint=''):
+    """
+    Execute the stale nodes of the graph, with at most workers nodes
+    running concurrently in separate processes, and one node at a time
+    writing to any table.
+    Solutions found in the table cache are restored instead of solved.
+    Returns (name, timing) of the nodes that were run, in order of completion
+    """
+    keys = content_keys(graph, fingerprint)
+    state = load_state(statefile)
+    stale = stale_nodes(graph, state, force=force, keys=keys)
+    todo = [node for node in graph.nodes if node.name in stale]
+    for node in graph.nodes:
+        if node.name not in stale:
+            print('Skipping {}, completed in a previous run'.format(node.name))
+    if not force and todo and len(todo) < len(graph.nodes):
+        print('Resuming from {}'.format(todo[0].name))
+
+    if dry_run:
+        for node in todo:
+            _announce(node, True)
+        return [(node.name, None) for node in todo]
+
+    restored = set()
+    completed = []
+
+    def _start(node):
+        # forget the previous run until this one completes
+        if state.pop(node.name, None) is not None:
+            save_state(statefile, state)
+        _announce(node, verbose)
+        tables = _cached_tables(node)
+        if cache is None or not tables or not cache.has(keys[node.name], tables):
+            return None
+        # restore the solution instead of solving
+        print('Restoring {} from cache'.format(', '.join(tables)))
+        _, timing = task_log.measure(cache.restore, keys[node.name], tables)
+        restored.add(node.name)
+        return node.name, timing
+
+    def _done(name, timing):
+        node = graph[name]
+        _check_outputs(node)
+        tables = _cached_tables(node)
+        if cache is not None and tables and name not in restored:
+            cache.store(keys[name], tables)
+        state[name] = record(node, content_key=keys[name])
+        save_state(statefile, state)
+        completed.append((name, timing))
+        if log is not None:
+            log.record(node.task, timing, {'node': name,
+                                           'cmd': node.cmd(),
+                                           'cached': name in restored})
+
+    if workers < 2:
+        for node in todo:
+            result = _start(node)
+            if result is None:
+                result = _run_node(backend, node)
+            _done(*result)
+        return completed
+
+    # dependency driven scheduling over a process pool
+    pending = dict((node.name, set(node.deps) & stale) for node in todo)
+    finished = queue.Queue()
+    pool = multiprocessing.Pool(processes=workers)
+    running = 0
+    # tables written by the running nodes
+    busy = {}
+    try:
+        while pending or running:
+            ready = [node for node in todo
+                     if node.name in pending and not pending[node.name]]
+            for node in ready:
+                tables = _written(node)
+                if any(tables & other for other in busy.values()):
+                    continue
+                busy[node.name] = tables
+                del pending[node.name]
+                result = _start(node)
+                if result is None:
+                    pool.apply_async(_run_node,
+                                     (backend, node),
+                                     callback=finished.put,
+                                     error_callback=finished.put)
+                else:
+                    finished.put(result)
+                running += 1
+            if running < 1:
+                raise RuntimeError('Unresolved calibration dependencies: '
+                                   '{}'.format(sorted(pending)))
+            result = finished.get()
+            running -= 1
+            if isinstance(result, Exception):
+                raise result
+            name, timing = result
+            del busy[name]
+            _done(name, timing)
+            for deps in pending.values():
+                deps.discard(name)
+    finally:
+        pool.terminate()
+        pool.join()
+    return completed
+
+# -fin-
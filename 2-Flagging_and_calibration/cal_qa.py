@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+# Numeric quality checks of calibration solutions
+# The advice printed by inspect_cal_solutions.py, delays of a few nanoseconds,
+# bandpass phase around 0 and amplitude around 1, gain phases in a straight
+# line, is computed per antenna and polarisation and compared to thresholds.
+# The report is written as JSON with a pass/fail flag per check.
+
+import cal_solutions
+import json
+import numpy as np
+import yaml
+
+# metric name: maximum allowed value
+THRESHOLDS = {'delay_ns': 5.,
+              'delay_spread_ns': 3.,
+              'bp_phase_rms_deg': 15.,
+              'bp_amp_dev': 0.3,
+              'gain_phase_slope_deg_per_hr': 60.,
+              'gain_phase_scatter_deg': 15.,
+              'flagged_fraction': 0.5,
+              }
+
+
+def load_thresholds(filename=None):
+    """Default thresholds, updated from a YAML or JSON file"""
+    thresholds = dict(THRESHOLDS)
+    if filename is not None:
+        with open(filename, 'r') as fin:
+            thresholds.update(yaml.safe_load(fin))
+    return thresholds
+
+
+def _nan(values, flags):
+    return np.where(flags, np.nan, values)
+
+
+def flagged_fraction(sols):
+    """Fraction of flagged solutions per antenna and polarisation"""
+    flags = sols['flags']
+    return flags.reshape(-1, *flags.shape[2:]).mean(axis=0)
+
+
+def delay_metrics(sols):
+    """Delay [ns] per antenna and polarisation, averaged over solutions"""
+    delays = _nan(np.real(sols['solutions']), sols['flags'])
+    with np.errstate(invalid='ignore'):
+        delays = np.nanmean(delays.reshape(-1, *delays.shape[2:]), axis=0)
+    return {'delay_ns': np.abs(delays),
+            'flagged_fraction': flagged_fraction(sols),
+            }, {'delay_spread_ns': np.nanstd(delays, axis=0)}
+
+
+def bandpass_metrics(sols):
+    """
+    RMS of the bandpass phase [deg] about its mean and RMS deviation of
+    the amplitude from 1, over channels and solutions
+    """
+    gains = sols['solutions']
+    flags = sols['flags'] | (gains == 0)
+    weight = (~flags).astype(np.float64)
+    n_valid = weight.sum(axis=(0, 1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # phase about the mean phasor of each antenna
+        mean = (gains * weight).sum(axis=(0, 1))
+        phase = np.angle(gains * np.conj(mean))
+        phase_rms = np.sqrt((weight * phase ** 2).sum(axis=(0, 1)) / n_valid)
+        amp_dev = np.sqrt((weight * (np.abs(gains) - 1.) ** 2).sum(axis=(0, 1)) /
+                          n_valid)
+    return {'bp_phase_rms_deg': np.degrees(phase_rms),
+            'bp_amp_dev': amp_dev,
+            'flagged_fraction': flagged_fraction(sols),
+            }, {}
+
+
+def _fill_forward(values, flags):
+    """Replace flagged values with the last unflagged value along axis 0"""
+    index = np.where(flags, 0, np.arange(len(values)).reshape(
+        (-1,) + (1,) * (values.ndim - 1)))
+    index = np.maximum.accumulate(index, axis=0)
+    return np.take_along_axis(values, index, axis=0)
+
+
+def _field_solutions(sols, field=None):
+    """Selection of the solutions of the fields, all solutions without field"""
+    if not field:
+        return np.ones(len(sols['times']), dtype=bool)
+    return np.isin(sols['fields'], field.split(','))
+
+
+def gain_metrics(sols, field=None):
+    """
+    Slope [deg/hr] and scatter [deg] about a straight line fit of the
+    unwrapped gain phase over time, for the solutions of field
+    """
+    sel = _field_solutions(sols, field)
+    if not sel.any():
+        raise ValueError('No solutions for field {}'.format(field))
+    gains = sols['solutions'][sel, 0]
+    flags = sols['flags'][sel, 0] | (gains == 0)
+    hours = (sols['times'][sel] - sols['times'][sel].min()) / 3600.
+    phase = np.degrees(np.unwrap(np.angle(_fill_forward(gains, flags)), axis=0))
+
+    # weighted least squares per antenna and polarisation
+    weight = (~flags).astype(np.float64)
+    x = hours[:, None, None]
+    s_w = weight.sum(axis=0)
+    s_x = (weight * x).sum(axis=0)
+    s_y = (weight * phase).sum(axis=0)
+    s_xx = (weight * x ** 2).sum(axis=0)
+    s_xy = (weight * x * phase).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        det = s_w * s_xx - s_x ** 2
+        slope = np.where(det > 0, (s_w * s_xy - s_x * s_y) / det, 0.)
+        offset = (s_y - slope * s_x) / s_w
+        residual = phase - (offset + slope * x)
+        scatter = np.sqrt((weight * residual ** 2).sum(axis=0) / s_w)
+    return {'gain_phase_slope_deg_per_hr': np.abs(slope),
+            'gain_phase_scatter_deg': scatter,
+            'flagged_fraction': flags.mean(axis=0),
+            }, {}
+
+
+def check(sols, metrics, summary, thresholds):
+    """Compare metrics to thresholds, NaN values of fully flagged data pass"""
+    antennas = [str(ant) for ant in sols['antennas']]
+    pols = [str(pol) for pol in sols['pols']]
+    result = {'antennas': dict((ant, dict((pol, {}) for pol in pols))
+                               for ant in antennas),
+              'summary': {},
+              'failed': [],
+              }
+    for metric, values in sorted(metrics.items()):
+        limit = thresholds.get(metric)
+        for ant_idx, ant in enumerate(antennas):
+            for pol_idx, pol in enumerate(pols):
+                value = float(values[ant_idx, pol_idx])
+                result['antennas'][ant][pol][metric] = (
+                        None if np.isnan(value) else round(value, 4))
+                if limit is not None and value > limit:
+                    result['failed'].append(
+                            '{} {} {}: {:.3f} > {}'.format(ant, pol, metric,
+                                                           value, limit))
+    for metric, values in sorted(summary.items()):
+        limit = thresholds.get(metric)
+        for pol_idx, pol in enumerate(pols):
+            value = float(values[pol_idx])
+            result['summary'].setdefault(pol, {})[metric] = (
+                    None if np.isnan(value) else round(value, 4))
+            if limit is not None and value > limit:
+                result['failed'].append(
+                        '{} {}: {:.3f} > {}'.format(pol, metric, value, limit))
+    result['passed'] = len(result['failed']) < 1
+    return result
+
+
+def qa_report(ktable=None,
+              btable=None,
+              gtable=None,
+              fields=(),
+              thresholds=None):
+    """Checks of the delay, bandpass and gain solutions, gain solutions per field"""
+    if thresholds is None:
+        thresholds = THRESHOLDS
+    checks = {}
+    if ktable:
+        sols = cal_solutions.load(ktable)
+        checks['delay'] = check(sols, *delay_metrics(sols),
+                                thresholds=thresholds)
+        checks['delay']['table'] = ktable
+    if btable:
+        sols = cal_solutions.load(btable)
+        checks['bandpass'] = check(sols, *bandpass_metrics(sols),
+                                   thresholds=thresholds)
+        checks['bandpass']['table'] = btable
+    if gtable:
+        sols = cal_solutions.load(gtable)
+        for field in fields:
+            if not field:
+                continue
+            name = 'gain {}'.format(field)
+            if _field_solutions(sols, field).any():
+                checks[name] = check(sols, *gain_metrics(sols, field),
+                                     thresholds=thresholds)
+            else:
+                checks[name] = {'antennas': {},
+                                'summary': {},
+                                'failed': ['no solutions for field {}'.format(field)],
+                                'passed': False,
+                                }
+            checks[name]['table'] = gtable
+    return {'passed': all(chk['passed'] for chk in checks.values()),
+            'thresholds': thresholds,
+            'checks': checks,
+            }
+
+
+def write_report(report, filename):
+    with open(filename, 'w') as fout:
+        json.dump(report, fout, indent=1, sort_keys=True)
+
+# -fin-
@@ -0,0 +1,275 @@
+#!/usr/bin/python3
+# Calibration solutions as NumPy arrays, and figures rendered without CASA
+# CASA calibration tables are read once, with python-casacore if available or
+# the CASA table tool otherwise, into the arrays of the quick-look solutions of
+# stefcal.py, so that both can be plotted and checked in the same way.
+# Figures are drawn with the Agg backend in a pool of worker processes.
+
+import multiprocessing
+import numpy as np
+import os
+import stefcal
+import task_log
+
+## -- reading --
+# VisCal keyword of the table to solution type
+_VISCAL = {'K Jones': 'K',
+           'B Jones': 'B',
+           'G Jones': 'G',
+           'T Jones': 'G',
+           }
+
+
+class _Table(object):
+    """Read-only table access returning columns with the row axis first"""
+
+    def __init__(self, name):
+        try:
+            from casacore.tables import table
+            self._tb = table(name, ack=False)
+            self._casacore = True
+        except ImportError:
+            try:
+                from casatools import table
+            except ImportError:
+                from taskinit import tbtool as table
+            self._tb = table()
+            self._tb.open(name)
+            self._casacore = False
+
+    def colnames(self):
+        return list(self._tb.colnames())
+
+    def keyword(self, name, default=None):
+        try:
+            return self._tb.getkeyword(name)
+        except Exception:
+            return default
+
+    def getcol(self, column):
+        values = np.asarray(self._tb.getcol(column))
+        if not self._casacore:
+            # CASA table tool columns are (..., row)
+            values = values.T
+        return values
+
+    def close(self):
+        self._tb.close()
+
+
+def _column(name, column):
+    tb = _Table(name)
+    try:
+        return tb.getcol(column)
+    finally:
+        tb.close()
+
+
+def read_caltable(caltable):
+    """
+    Solutions of a CASA calibration table, as returned by stefcal.load_solutions,
+    with arrays (n_sol, n_chans, n_ants, n_pols) over unique (time, field)
+    """
+    tb = _Table(caltable)
+    try:
+        columns = tb.colnames()
+        viscal = tb.keyword('VisCal', '')
+        times = tb.getcol('TIME')
+        field_ids = tb.getcol('FIELD_ID')
+        ants = tb.getcol('ANTENNA1')
+        if 'CPARAM' in columns:
+            values = tb.getcol('CPARAM')
+        else:
+            values = tb.getcol('FPARAM')
+        flags = tb.getcol('FLAG')
+    finally:
+        tb.close()
+    sol_type = _VISCAL.get(viscal, 'K' if 'CPARAM' not in columns else 'G')
+    antennas = _column(os.path.join(caltable, 'ANTENNA'), 'NAME')
+    field_names = _column(os.path.join(caltable, 'FIELD'), 'NAME')
+    freqs = np.array([])
+    if sol_type == 'B':
+        freqs = np.asarray(_column(os.path.join(caltable, 'SPECTRAL_WINDOW'),
+                                   'CHAN_FREQ'))[0]
+
+    # rows of (time, field) solutions per antenna
+    ident, sol_index = np.unique(np.column_stack((times, field_ids)),
+                                 axis=0, return_inverse=True)
+    sol_index = sol_index.ravel()
+    n_rows, n_chans, n_pols = values.shape
+    shape = (len(ident), n_chans, len(antennas), n_pols)
+    solutions = np.zeros(shape, dtype=values.dtype)
+    sol_flags = np.ones(shape, dtype=bool)
+    solutions[sol_index, :, ants] = values
+    sol_flags[sol_index, :, ants] = flags
+    return {'type': np.array(sol_type),
+            'antennas': np.asarray(antennas),
+            'pols': np.array(['X', 'Y'][:n_pols]),
+            'times': ident[:, 0],
+            'fields': np.asarray([field_names[int(idx)] for idx in ident[:, 1]]),
+            'freqs': freqs,
+            'solutions': solutions,
+            'flags': sol_flags,
+            }
+
+
+def load(caltable):
+    """Solutions from a CASA calibration table or NumPy quick-look file"""
+    if caltable.endswith('.npz'):
+        return stefcal.load_solutions(caltable)
+    return read_caltable(caltable)
+## -- reading --
+
+
+## -- plotting --
+def _yvalues(sols, yaxis):
+    values = sols['solutions']
+    if yaxis == 'phase':
+        data = np.degrees(np.angle(values))
+    elif yaxis == 'amp':
+        data = np.abs(values)
+    else:
+        data = np.real(values)
+    return np.ma.masked_array(data, mask=sols['flags'])
+
+
+def minmax(x, y, n_bins):
+    """
+    Minimum and maximum of each curve, y (n_points, n_curves), in n_bins
+    bins along x, in the order they occur. Flagged (NaN) points are ignored.
+    Returns x and y of (2 * n_bins, n_curves) points, NaN for empty bins
+    """
+    n_points, n_curves = y.shape
+    if n_points <= 2 * n_bins:
+        return np.repeat(x[:, None], n_curves, axis=1), y
+    width = int(np.ceil(n_points / float(n_bins)))
+    n_bins = int(np.ceil(n_points / float(width)))
+    pad = n_bins * width - n_points
+    y = np.concatenate((y, np.full((pad, n_curves), np.nan)))
+    x = np.concatenate((x, np.full(pad, x[-1])))
+    bins = y.reshape(n_bins, width, n_curves)
+    valid = ~np.isnan(bins)
+    lo = np.argmin(np.where(valid, bins, np.inf), axis=1)
+    hi = np.argmax(np.where(valid, bins, -np.inf), axis=1)
+    empty = ~valid.any(axis=1)
+    # first and second point of each bin, keeping the order along x
+    first = np.minimum(lo, hi)
+    second = np.maximum(lo, hi)
+    offset = (np.arange(n_bins) * width)[:, None]
+    index = np.stack((first + offset, second + offset), axis=1).reshape(
+            2 * n_bins, n_curves)
+    y_dec = np.take_along_axis(y, index, axis=0)
+    y_dec[np.repeat(empty, 2, axis=0)] = np.nan
+    return x[index], y_dec
+
+
+def plot_figure(sols,
+                xaxis,
+                yaxis,
+                figfile,
+                field=None,
+                plotrange=None,
+                title='',
+                decimate=True):
+    """
+    plotcal style figure of solutions, drawn with the Agg backend.
+    With decimate, curves are reduced to the minimum and maximum per pixel
+    column, so outliers are kept
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    values = _yvalues(sols, yaxis)
+    sel = np.ones(values.shape[0], dtype=bool)
+    if field:
+        sel = np.isin(sols['fields'], field.split(','))
+    values = values[sel].filled(np.nan)
+
+    fig, ax = plt.subplots(figsize=(10, 6))
+    n_pixels = int(fig.get_figwidth() * fig.dpi)
+
+    def _plot(x, y, marker):
+        # all antennas at once, y (n_points, n_ants)
+        if decimate:
+            x, y = minmax(x, y, n_pixels)
+        ax.plot(x, y, marker)
+
+    for pol, name in enumerate(sols['pols']):
+        if xaxis == 'antenna':
+            ax.plot(np.arange(len(sols['antennas'])),
+                    values[0, 0, :, pol], 'o', label=name)
+        elif xaxis == 'chan':
+            for sol in range(values.shape[0]):
+                _plot(np.arange(values.shape[1]), values[sol, :, :, pol], ',')
+        else:
+            _plot(sols['times'][sel], values[:, 0, :, pol], '.')
+    if xaxis == 'antenna':
+        ax.set_xticks(np.arange(len(sols['antennas'])))
+        ax.set_xticklabels(sols['antennas'], rotation=90)
+        ax.legend()
+    if plotrange is not None:
+        ax.set_ylim(plotrange[2], plotrange[3])
+    ax.set_xlabel(xaxis)
+    ax.set_ylabel(yaxis)
+    ax.set_title(title)
+    fig.savefig(figfile)
+    plt.close(fig)
+    return figfile
+
+
+# solutions read once by the parent, and set in each worker process by
+# the pool initializer, with the fork and the spawn start methods
+_tables = {}
+
+
+def _init_worker(tables):
+    _tables.update(tables)
+
+
+def _render(figure):
+    caltable, kwargs = figure
+    return plot_figure(_tables[caltable],
+                       title=os.path.basename(caltable),
+                       **kwargs)
+
+
+def benchmark(figures):
+    """Render time and file size [s, bytes] of each figure, full resolution and decimated"""
+    results = []
+    for caltable, kwargs in figures:
+        if caltable not in _tables:
+            _tables[caltable] = load(caltable)
+        result = {'figfile': kwargs['figfile']}
+        for label, decimate in (('full', False), ('decimated', True)):
+            kwargs_ = dict(kwargs, decimate=decimate)
+            _, timing = task_log.measure(_render, (caltable, kwargs_))
+            result[label] = (timing['wall_s'], os.path.getsize(kwargs['figfile']))
+        results.append(result)
+    return results
+
+
+def render(figures, workers=None):
+    """
+    Draw figures, a list of (caltable, plot_figure keyword arguments),
+    with each table read once. Returns the figure files
+    """
+    for caltable, _ in figures:
+        if caltable not in _tables:
+            _tables[caltable] = load(caltable)
+    if workers is None:
+        workers = min(len(figures), multiprocessing.cpu_count())
+    if workers < 2:
+        return [_render(figure) for figure in figures]
+    tables = dict((caltable, _tables[caltable]) for caltable, _ in figures)
+    pool = multiprocessing.Pool(processes=workers,
+                                initializer=_init_worker,
+                                initargs=(tables, ))
+    try:
+        return pool.map(_render, figures, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+## -- plotting --
+
+# -fin-
@@ -8,21 +8,35 @@
 # https://casa.nrao.edu/docs/TaskRef/fluxscale-task.html
 # https://casa.nrao.edu/docs/TaskRef/applycal-task.html
 
-from os import F_OK
 from taskinit import *
 from tasks import *
 
 import argparse
+import cal_cache
+import cal_graph
 import casac
+import flag_state
+import flux_models
 import os
+import parallel_flagging
+import stefcal
+import sys
+import task_log
 
 ## -- global parameters for script --
 DEBUG = False
 VERBOSE = False
+TASK_LOG = None
 flux_calibrators = {'J0408-6545': [17.1, 0, 0, 0],
                     'J1939-6342': 'Stevens-Reynolds 2016',
                     'J1331+3030': 'Perley-Butler 2013',
                     }
+# channel width and time bin of the averaged calibrator copies per solve,
+# the bandpass is not channel averaged so that it applies to the full MS
+cal_averaging = {'delay': (8, '16s'),
+                 'bandpass': (1, '0s'),
+                 'gain': (64, '0s'),
+                 }
 ## -- global parameters for script --
 
 
@@ -56,18 +70,21 @@ def _print_msg(msg):
     print(msg_text)
 
 
-def _run_cmd(cmd, table=None):
-    if DEBUG or VERBOSE:
-        print(cmd)
-        if DEBUG:
-            return None
+def _ms_fingerprint(msfile):
+    """Identify the MS and the flagging rules applied to it"""
+    manifest = flag_state.load(msfile)
+    return '{}:{}'.format(manifest['fingerprint'],
+                          ','.join(sorted(manifest['rules'])))
 
-    if table is not None:
-        if os.access(table, F_OK):
-            print('Deleting {} before cal\n'.format(table))
-            rmtables(table)
 
-    exec(cmd)
+def _model(msfile):
+    """Model visibility column of the MS, as a graph resource"""
+    return '{}::MODEL_DATA'.format(msfile)
+
+
+def _corrected(msfile, field):
+    """Corrected visibilities of a field in the MS, as a graph resource"""
+    return '{}::CORRECTED_DATA::{}'.format(msfile, field)
 
 
 ## -- utility functions --
@@ -91,6 +108,52 @@ def cli():
             action='store_true',
             help='output of casa commands for debugging without execution',
             )
+    parser.add_argument(
+            '--task-log',
+            type=str,
+            help='JSON lines file recording wall time, CPU time and peak '
+                 'memory of each CASA task',
+            )
+    parser.add_argument(
+            '--chrome-trace',
+            type=str,
+            help='Chrome trace format file of the CASA tasks',
+            )
+    parser.add_argument(
+            '-j', '--workers',
+            type=int,
+            default=1,
+            help='number of CASA tasks to run concurrently, '
+                 'independent tasks such as plots and applycal per sub-MS '
+                 'run in parallel',
+            )
+    parser.add_argument(
+            '--resume',
+            action='store_true',
+            help='continue from the first incomplete calibration step of a '
+                 'previous run, steps are recorded in <prefix>.calgraph.json',
+            )
+    parser.add_argument(
+            '--cache-dir',
+            type=str,
+            help='directory for cached calibration tables, solutions are '
+                 'reused while the MS, flags and solve parameters are unchanged',
+            )
+    parser.add_argument(
+            '--cache-size',
+            type=float,
+            default=50.,
+            help='maximum disk usage of the calibration table cache [GB], '
+                 'least recently used tables are removed first',
+            )
+    parser.add_argument(
+            '--engine',
+            type=str,
+            default='casa',
+            choices=['casa', 'numpy'],
+            help='solve with the CASA tasks, or a quick-look NumPy solver '
+                 'for delay, bandpass and per scan gain solutions only',
+            )
     group = parser.add_argument_group(
             title="required arguments",
             description="arguments required by the script to run")
@@ -122,6 +185,12 @@ def cli():
             help='standard flux model to apply, '
                  'leave blank to apply MeerKAT standard if available',
             )
+    group.add_argument(
+            '--flux-model',
+            action='store_true',
+            help='set the flux calibrator model from the spectral models in '
+                 'flux_models.py, with setjy standard=\'manual\'',
+            )
     group.add_argument(
             '-b', '--bpcal',
             type=str,
@@ -159,10 +228,33 @@ def cli():
             action='store_true',
             help='apply calibration solution to measurement set',
             )
+    group.add_argument(
+            '--apply-mode',
+            type=str,
+            default='field',
+            choices=['field', 'mms', 'grouped'],
+            help='apply calibration per field, per field in each sub-MS of a '
+                 'multi-MS partitioned by scan (<prefix>_cal.mms, merged back into '
+                 'the MS), or in a single '
+                 'pass over all fields using the nearest gain calibrator',
+            )
+    group.add_argument(
+            '--average-cals',
+            action='store_true',
+            help='solve on copies of the calibrator fields, channel and time '
+                 'averaged per solve, solutions are applied to the full MS',
+            )
+    group.add_argument(
+            '--plots',
+            action='store_true',
+            help='plot calibration solutions once the tables are available',
+            )
     args = parser.parse_args()
 
     # set defaults for optional parameters
-    if args.standard is None:
+    if args.flux_model:
+        args.standard = flux_models.setjy_params(args.fluxcal)
+    elif args.standard is None:
         if args.fluxcal in flux_cals:
             args.standard = flux_calibrators[args.fluxcal]
         else:
@@ -187,139 +279,385 @@ def cli():
         global VERBOSE
         VERBOSE = True
 
+    if args.task_log is not None or args.chrome_trace is not None:
+        global TASK_LOG
+        TASK_LOG = task_log.TaskLog(logfile=args.task_log,
+                                    tracefile=args.chrome_trace)
+
     return args
 
 
-def primary_calibrators(msfile,
+def primary_calibrators(graph,
+                        msfile,
                         f_cal,
                         bp_cal,
                         delay_cal,
                         ref_ant='',
                         prelim_gcal=False,
                         ref_chans='',
+                        solve_vis=None,
                         ):
 
     prefix = _get_prefix(msfile)
-    _print_msg('Delay calibration')
+    if solve_vis is None:
+        solve_vis = {}
+    vis = solve_vis.get('delay', msfile)
     ktable = prefix + '.K'
-    cmd = ("gaincal(vis='{}', caltable='{}', field='{}', "
-           "gaintype='K', solint='inf', refant='{}', "
-           "combine='scan,field', solnorm=False, minsnr=3.0, "
-           "gaintable=[])".format(msfile, ktable, delay_cal, ref_ant))
-    _run_cmd(cmd, table=ktable)
-    gaintable_list=[ktable]
-
+    graph.add(cal_graph.Node(
+        'delay', 'gaincal',
+        dict(vis=vis, caltable=ktable, field=delay_cal,
+             gaintype='K', solint='inf', refant=ref_ant,
+             combine='scan,field', solnorm=False, minsnr=3.0,
+             gaintable=[]),
+        inputs=[vis, _model(vis)],
+        outputs=[ktable],
+        msg='Delay calibration'))
+    gaintable_list = [ktable]
+
+    # on the bandpass data, where ref_chans channel numbers hold
+    vis = solve_vis.get('bandpass', msfile)
     if prelim_gcal:
-        _print_msg('Preliminary gain calibration')
         gtable0 = prefix + '.G0'
-        cmd = ("gaincal(vis='{}', caltable='{}', field='{}', "
-               "gaintype='G', solint='inf', refant='{}', spw='{}', "
-               "calmode='p', minsnr=3.0, solnorm=True, "
-               "gaintable={})".format(
-                    msfile, gtable0, f_cal, ref_ant, ref_chans, [ktable]))
-        _run_cmd(cmd, table=gtable0)
+        graph.add(cal_graph.Node(
+            'preliminary gain', 'gaincal',
+            dict(vis=vis, caltable=gtable0, field=f_cal,
+                 gaintype='G', solint='inf', refant=ref_ant, spw=ref_chans,
+                 calmode='p', minsnr=3.0, solnorm=True,
+                 gaintable=[ktable]),
+            inputs=[vis, _model(vis), ktable],
+            outputs=[gtable0],
+            msg='Preliminary gain calibration'))
         gaintable_list.insert(0, gtable0)
 
-    _print_msg('Bandpass calibration')
     btable = prefix + '.B'
-    cmd = ("bandpass(vis='{}', caltable='{}', field='{}', "
-           "bandtype='B', solint='inf', refant='{}', "
-           "combine='scan', solnorm=True, minsnr=3.0, "
-           "gaintable={})".format(
-               msfile, btable, bp_cal, ref_ant, gaintable_list))
-    _run_cmd(cmd, table=btable)
-
-    _print_msg('Gain calibration for flux calibrators')
+    graph.add(cal_graph.Node(
+        'bandpass', 'bandpass',
+        dict(vis=vis, caltable=btable, field=bp_cal,
+             bandtype='B', solint='inf', refant=ref_ant,
+             combine='scan', solnorm=True, minsnr=3.0,
+             gaintable=gaintable_list),
+        inputs=[vis, _model(vis)] + gaintable_list,
+        outputs=[btable],
+        msg='Bandpass calibration'))
+
+    vis = solve_vis.get('gain', msfile)
     gtable = prefix + '.G'
-    cmd = ("gaincal(vis='{}', caltable='{}', field='{}', "
-           "gaintype='G', calmode='ap', solint='int', "
-           "refant='{}', combine='spw', solnorm=False, minsnr=1.0, "
-           "gaintable={})".format(
-               msfile, gtable, f_cal, ref_ant, [btable, ktable]))
-    _run_cmd(cmd, table=gtable)
+    graph.add(cal_graph.Node(
+        'gain', 'gaincal',
+        dict(vis=vis, caltable=gtable, field=f_cal,
+             gaintype='G', calmode='ap', solint='int',
+             refant=ref_ant, combine='spw', solnorm=False, minsnr=1.0,
+             gaintable=[btable, ktable]),
+        inputs=[vis, _model(vis), btable, ktable],
+        outputs=[gtable],
+        msg='Gain calibration for flux calibrators'))
 
     return [ktable, btable, gtable]
 
 
-def secondary_calibrators(msfile,
+def secondary_calibrators(graph,
+                          msfile,
                           ktable,
                           btable,
                           gtable,
                           g_cal,
                           ref_ant='',
+                          vis=None,
                           ):
 
-    prefix = _get_prefix(msfile)
-    _print_msg('Gain calibration for remaining calibrators')
-    cmd = ("gaincal(vis='{}', caltable='{}', field='{}', "
-           "gaintype='G', calmode='ap', solint='int', refant='{}', "
-           "combine='spw', solnorm=False, minsnr=1.0, append=True, "
-           "gaintable={})".format(
-               msfile, gtable, g_cal, ref_ant, [btable, ktable]))
-    _run_cmd(cmd)
+    if vis is None:
+        vis = msfile
+    # solutions are appended to the gain table of the flux calibrators
+    graph.add(cal_graph.Node(
+        'secondary gain', 'gaincal',
+        dict(vis=vis, caltable=gtable, field=g_cal,
+             gaintype='G', calmode='ap', solint='int', refant=ref_ant,
+             combine='spw', solnorm=False, minsnr=1.0, append=True,
+             gaintable=[btable, ktable]),
+        inputs=[vis, _model(vis), btable, ktable],
+        modifies=[gtable],
+        msg='Gain calibration for remaining calibrators'))
 
     return gtable
 
 
-def flux_calibration(msfile,
+def flux_calibration(graph,
+                     msfile,
                      ftable,
                      gtable,
                      f_cal,
                      g_cal,
+                     vis=None,
                      ):
     prefix = _get_prefix(msfile)
-    _print_msg('Fluxscale calibration for secondary cal')
+    if vis is None:
+        vis = msfile
     ftable = prefix + '.flux'
-    cmd = ("fluxscale(vis='{}', caltable='{}', fluxtable='{}', "
-           "reference='{}', transfer='{}')".format(
-               msfile, gtable, ftable, f_cal, g_cal))
-    _run_cmd(cmd, table=ftable)
+    graph.add(cal_graph.Node(
+        'flux', 'fluxscale',
+        dict(vis=vis, caltable=gtable, fluxtable=ftable,
+             reference=f_cal, transfer=g_cal),
+        inputs=[vis, gtable],
+        outputs=[ftable],
+        msg='Fluxscale calibration for secondary cal'))
     return ftable
 
 
-def apply_calibration(msfile,
+def average_calibrators(graph,
+                        msfile,
+                        cals,
+                        averaging=None,
+                        ):
+    """
+    Channel and time averaged copies of the calibrator fields, one per
+    averaging setting in cal_averaging. Field and spw ids are not reindexed,
+    so solutions from the copies apply to the full resolution MS.
+    Copies are kept between runs while the MS and settings are unchanged.
+    Returns the MS to use per solve
+    """
+    if averaging is None:
+        averaging = cal_averaging
+    if averaging.get('bandpass', (1, '0s'))[0] != 1:
+        raise ValueError('Bandpass solutions from channel averaged data '
+                         'cannot be applied to the full resolution MS')
+    prefix = _get_prefix(msfile)
+    field = ','.join(sorted(set(cals)))
+    solve_vis = {}
+    for solve in ('delay', 'bandpass', 'gain'):
+        if solve not in averaging:
+            continue
+        width, timebin = averaging[solve]
+        timeaverage = timebin not in ('', '0s')
+        suffix = ''
+        if width > 1:
+            suffix += '_{}ch'.format(width)
+        if timeaverage:
+            suffix += '_{}'.format(timebin)
+        vis = '{}_cal{}.ms'.format(prefix, suffix)
+        solve_vis[solve] = vis
+        if graph.creator(vis) is not None:
+            continue
+        graph.add(cal_graph.Node(
+            'average {}'.format(solve), 'mstransform',
+            dict(vis=msfile, outputvis=vis, field=field,
+                 datacolumn='data', reindex=False,
+                 chanaverage=width > 1, chanbin=width,
+                 timeaverage=timeaverage, timebin=timebin),
+            inputs=[msfile],
+            outputs=[vis],
+            msg='Averaged calibrator data for {} calibration'.format(solve),
+            reuse=True))
+    return solve_vis
+
+
+def _flux_model(graph, msfile, f_cal, standard, label=''):
+    """clearcal and setjy nodes initialising the model column of the MS"""
+    model = _model(msfile)
+    graph.add(cal_graph.Node(
+        'clearcal' + label, 'clearcal',
+        dict(vis=msfile),
+        inputs=[msfile],
+        modifies=[model],
+        msg='Clear existing calibration results'))
+
+    # To convert correlation coefficients to absolute flux densities
+    if type(standard) is dict:
+        params = dict(vis=msfile, field=f_cal, scalebychan=True)
+        params.update(standard)
+    elif type(standard) is list:
+        params = dict(vis=msfile, field=f_cal,
+                      scalebychan=True, standard='manual',
+                      fluxdensity=standard)
+    else:
+        params = dict(vis=msfile, field=f_cal,
+                      scalebychan=True,
+                      standard=standard, fluxdensity=-1)
+    graph.add(cal_graph.Node(
+        'setjy' + label, 'setjy', params,
+        inputs=[msfile],
+        modifies=[model],
+        msg='Apply flux model to flux calibrator'))
+
+
+def _subms_fields(subms):
+    """Names of the fields with data in a sub-MS"""
+    tb.open(subms)
+    field_ids = set(tb.getcol('FIELD_ID'))
+    tb.close()
+    tb.open(os.path.join(subms, 'FIELD'))
+    names = tb.getcol('NAME')
+    tb.close()
+    return set(names[field_id] for field_id in field_ids)
+
+
+def _scan_fields(msfile):
+    """Names of the fields with data in each scan of an MS, in scan order"""
+    tb.open(msfile)
+    scans = tb.getcol('SCAN_NUMBER')
+    field_ids = tb.getcol('FIELD_ID')
+    tb.close()
+    tb.open(os.path.join(msfile, 'FIELD'))
+    names = tb.getcol('NAME')
+    tb.close()
+    fields = {}
+    for scan, field_id in set(zip(scans, field_ids)):
+        fields.setdefault(scan, set()).add(names[field_id])
+    return [fields[scan] for scan in sorted(fields)]
+
+
+def apply_calibration(graph,
+                      msfile,
                       cals,
                       gaintables,
                       g_cal,
                       bp_cal,
                       delay_cal,
                       targets=None,
+                      mode='field',
                       ):
+    """
+    Calibration is applied to each field separately, mode='field',
+    to each field in each sub-MS of a multi-MS partitioned by scan, mode='mms',
+    or in a single pass over all fields, mode='grouped', where each field
+    uses the gain solutions of the nearest calibrator.
+    Fields of one MS are applied in turn, since applycal writes the
+    CORRECTED_DATA column of the MS, only sub-MSs are applied concurrently.
+    The sub-MSs of an MS partitioned for mode='mms' are merged back into the MS
+    """
 
-    _print_msg('Apply calibration results')
     if not DEBUG:
         clearstat()
 
-    def _build_cmd(msfile, gaintables, target, g_cal, bp_cal, delay_cal):
-        cmd = ("applycal(vis='{}', field ='{}', gaintable={}, gainfield={}, "
-               "interp=['', 'nearest', ''], calwt=False, "
-               "applymode='calflag')".format(
-                    msfile, target, gaintables, [g_cal, bp_cal, delay_cal]))
-        return cmd
-
-    # apply calibration to calibrators
-    for cal in cals:
-        cmd = _build_cmd(msfile,
-                         gaintables,
-                         cal,
-                         cal,
-                         bp_cal,
-                         delay_cal)
-        _run_cmd(cmd)
-
-    # apply calibration to targets
-    if targets is not None:
-        for tgt in targets:
-            cmd = _build_cmd(msfile,
-                             gaintables,
-                             tgt,
-                             g_cal,
-                             bp_cal,
-                             delay_cal)
-            _run_cmd(cmd)
-
-
-def calibrate(msfile,
+    def _add_node(msfile, gaintables, target, g_cal, bp_cal, delay_cal,
+                  name=None, inputs=()):
+        if name is None:
+            name = 'applycal {}'.format(target)
+        graph.add(cal_graph.Node(
+            name, 'applycal',
+            dict(vis=msfile, field=target, gaintable=gaintables,
+                 gainfield=[g_cal, bp_cal, delay_cal],
+                 interp=['', 'nearest', ''], calwt=False,
+                 applymode='calflag'),
+            inputs=[msfile] + list(inputs) + gaintables,
+            modifies=[_corrected(msfile, target)],
+            msg='Apply calibration results to {}'.format(target)))
+
+    if targets is None:
+        targets = []
+    if mode == 'grouped':
+        _add_node(msfile,
+                  gaintables,
+                  _list2str(cals + targets),
+                  'nearest',
+                  bp_cal,
+                  delay_cal,
+                  name='applycal')
+        return
+
+    partitions = [(msfile, None)]
+    mms = None
+    if mode == 'mms':
+        if parallel_flagging.is_mms(msfile):
+            partitions = [(vis, _subms_fields(vis))
+                          for vis in parallel_flagging.sub_ms(msfile)]
+        else:
+            # one sub-MS per scan, numbered in scan order, named apart from
+            # the flagged multi-MS of flagging_mkat_lband.py --parallel
+            scan_fields = _scan_fields(msfile)
+            mms = _get_prefix(msfile) + '_cal.mms'
+            graph.add(cal_graph.Node(
+                'partition', 'partition',
+                dict(vis=msfile, outputvis=mms, createmms=True,
+                     separationaxis='scan', numsubms=len(scan_fields),
+                     datacolumn='data', flagbackup=False),
+                inputs=[msfile, _model(msfile)],
+                outputs=[mms],
+                msg='Partition the MS by scan'))
+            partitions = [(parallel_flagging.sub_ms_name(mms, idx), fields)
+                          for idx, fields in enumerate(scan_fields)]
+
+    applied = []
+    for vis, fields in partitions:
+        suffix = '' if vis == msfile else ' {}'.format(os.path.basename(vis))
+        # calibrators use their own gain solutions, targets those of g_cal
+        for field, gainfield in ([(cal, cal) for cal in cals] +
+                                 [(tgt, g_cal) for tgt in targets]):
+            if fields is not None and field not in fields:
+                continue
+            _add_node(vis,
+                      gaintables,
+                      field,
+                      gainfield,
+                      bp_cal,
+                      delay_cal,
+                      name='applycal {}{}'.format(field, suffix),
+                      inputs=[mms] if mms is not None else [])
+            applied.append(_corrected(vis, field))
+
+    if mms is not None:
+        graph.add(cal_graph.Node(
+            'merge mms', 'merge_columns',
+            dict(vis=mms, outputvis=msfile,
+                 columns=['CORRECTED_DATA', 'FLAG']),
+            inputs=[mms] + applied,
+            modifies=['{}::CORRECTED_DATA'.format(msfile),
+                      '{}::FLAG'.format(msfile)],
+            msg='Merge calibrated sub-MSs into {}'.format(msfile)))
+
+
+def _print_apply_timing(graph, completed):
+    """Wall time of applycal per field"""
+    timing = {}
+    for name, timing_ in completed:
+        node = graph[name]
+        if node.task != 'applycal' or timing_ is None:
+            continue
+        field = node.params['field']
+        timing[field] = timing.get(field, 0.) + timing_['wall_s']
+    if len(timing) < 1:
+        return
+    _print_msg('Apply calibration timing')
+    for field in sorted(timing):
+        print('  {}: {:.1f} s'.format(field, timing[field]))
+
+
+# diagnostic figures as produced by inspect_cal_solutions.py
+def plot_solutions(graph,
+                   ktable,
+                   btable,
+                   gtable,
+                   primary=None,
+                   secondary=None,
+                   ):
+
+    def _add_node(name, caltable, figfile, **kwargs):
+        params = dict(caltable=caltable, showgui=False, figfile=figfile)
+        params.update(kwargs)
+        graph.add(cal_graph.Node(
+            'plot {}'.format(name), 'plotcal', params,
+            inputs=[caltable],
+            outputs=[figfile]))
+
+    _add_node('delay', ktable, 'delay_solutions.png',
+              xaxis='antenna', yaxis='delay')
+    _add_node('bandpass phase', btable, 'bandpass_phase_solutions.png',
+              xaxis='chan', yaxis='phase')
+    _add_node('bandpass amp', btable, 'bandpass_amp_solutions.png',
+              xaxis='chan', yaxis='amp')
+    for label, fields, suffix in (('primary', primary, 'solutions'),
+                                  ('secondary', secondary, 'solution')):
+        if fields:
+            _add_node('{} gain phase'.format(label), gtable,
+                      '{}_gain_phase_{}.png'.format(label, suffix),
+                      xaxis='time', yaxis='phase', field=fields,
+                      plotrange=[-1, -1, -180, 180])
+            _add_node('{} gain amp'.format(label), gtable,
+                      '{}_gain_amp_solutions.png'.format(label),
+                      xaxis='time', yaxis='amp', field=fields)
+
+
+def calibrate(graph,
+              msfile,
               f_cal,
               bp_cal,
               delay_cal,
@@ -328,46 +666,42 @@ def calibrate(msfile,
               standard=None,
               prelim_gcal=False,
               ref_chans='',
+              average_cals=False,
               ):
 
-    _print_msg('Clear existing calibration results')
-    cmd = "clearcal('{}')".format(msfile)
-    _run_cmd(cmd)
-
     ktable = ''
     btable = ''
     gtable = ''
     ftable = ''
 
-    # To convert correlation coefficients to absolute flux densities
-    _print_msg('Apply flux model to flux calibrator')
-    if type(standard) is list:
-        cmd = ("setjy(vis='{}', field='{}', "
-               "scalebychan=True, standard='manual', "
-               "fluxdensity={})".format(
-                      msfile, f_cal, standard))
+    solve_vis = {}
+    if average_cals:
+        # solves use averaged copies of the calibrators, each with its own model
+        graph.add(cal_graph.Node(
+            'clearcal', 'clearcal',
+            dict(vis=msfile),
+            inputs=[msfile],
+            modifies=[_model(msfile)],
+            msg='Clear existing calibration results'))
+        cals = _str2list(','.join(cal for cal in (f_cal, bp_cal, delay_cal, g_cal)
+                                  if cal))
+        solve_vis = average_calibrators(graph, msfile, cals)
+        for vis in sorted(set(solve_vis.values())):
+            _flux_model(graph, vis, f_cal, standard,
+                        label=' {}'.format(os.path.basename(vis)))
     else:
-        cmd = ("setjy(vis='{}', field='{}', "
-              "scalebychan=True, "
-              "standard='{}', fluxdensity=-1)".format(
-                      msfile, f_cal, standard))
-    _run_cmd(cmd)
+        _flux_model(graph, msfile, f_cal, standard)
 
-    [ktable, btable, gtable] = primary_calibrators(msfile,
+    [ktable, btable, gtable] = primary_calibrators(graph,
+                                                   msfile,
                                                    f_cal,
                                                    bp_cal,
                                                    delay_cal,
                                                    ref_ant=ref_ant,
                                                    prelim_gcal=prelim_gcal,
                                                    ref_chans=ref_chans,
+                                                   solve_vis=solve_vis,
                                                    )
-    msg = lambda str_ : 'No {} solution, exiting...'.format(str_)
-    if not os.path.isdir(ktable) and not DEBUG:
-        raise RuntimeError(msg('delay'))
-    if not os.path.isdir(btable) and not DEBUG:
-        raise RuntimeError(msg('bandpass'))
-    if not os.path.isdir(gtable) and not DEBUG:
-        raise RuntimeError(msg('gain'))
 
     cal_tables = [gtable, btable, ktable]
 
@@ -380,21 +714,23 @@ def calibrate(msfile,
         cals += _str2list(g_cal)
     g_cal = _list2str(cals)
     if g_cal:
-        gtable = secondary_calibrators(msfile,
+        gtable = secondary_calibrators(graph,
+                                       msfile,
                                        ktable,
                                        btable,
                                        gtable,
                                        g_cal=g_cal,
                                        ref_ant=ref_ant,
+                                       vis=solve_vis.get('gain'),
                                        )
 
-        ftable = flux_calibration(msfile,
+        ftable = flux_calibration(graph,
+                                  msfile,
                                   ftable,
                                   gtable,
                                   f_cal,
-                                  g_cal)
-        if not os.path.isdir(ftable) and not DEBUG:
-            raise RuntimeError(msg('flux'))
+                                  g_cal,
+                                  vis=solve_vis.get('gain'))
         cal_tables = [ftable, btable, ktable]
 
     return cal_tables
@@ -423,17 +759,35 @@ if __name__ == '__main__':
     if ref_ant is not None:
         print("  ref_ant='{}'".format(ref_ant))
 
+    prefix = _get_prefix(msfile)
+    if args.engine == 'numpy':
+        _print_msg("Quick-look solutions with NumPy")
+        if args.fixvis or args.applycal:
+            print('--fixvis and --applycal need the CASA engine, ignored')
+        for table in stefcal.quicklook(msfile,
+                                       f_cal,
+                                       bp_cal,
+                                       delay_cal,
+                                       g_cal=g_cal,
+                                       ref_ant=ref_ant,
+                                       prefix=prefix):
+            print('  {}'.format(table))
+        sys.exit(0)
+
+    graph = cal_graph.Graph()
     if args.fixvis:
-        prefix = _get_prefix(msfile)
-        _print_msg('Correct phase center with fixvis')
-        cmd = "fixvis(vis='{}', outputvis='{}')".format(
-                msfile, prefix+'_fixvis.ms')
-        _run_cmd(cmd)
+        graph.add(cal_graph.Node(
+            'fixvis', 'fixvis',
+            dict(vis=msfile, outputvis=prefix+'_fixvis.ms'),
+            inputs=[msfile],
+            outputs=[prefix+'_fixvis.ms'],
+            msg='Correct phase center with fixvis'))
         msfile = prefix+'_fixvis.ms'
         print('Phase center correction')
         print("  msfile='{}'".format(msfile))
 
-    cal_tables = calibrate(msfile,
+    cal_tables = calibrate(graph,
+                           msfile,
                            f_cal,
                            bp_cal,
                            delay_cal,
@@ -442,18 +796,54 @@ if __name__ == '__main__':
                            standard=args.standard,
                            prelim_gcal=True,
                            ref_chans=args.ref_chans,
+                           average_cals=args.average_cals,
                            )
 
+    if args.plots:
+        ktable, btable, gtable = [_get_prefix(msfile) + ext
+                                  for ext in ('.K', '.B', '.G')]
+        plot_solutions(graph,
+                       ktable,
+                       btable,
+                       gtable,
+                       primary=f_cal,
+                       secondary=g_cal,
+                       )
+
     if args.applycal:
         cals = _str2list(','.join((f_cal, bp_cal, g_cal)))
         if target is not None:
             targets = _str2list(target)
-            apply_calibration(msfile,
+            apply_calibration(graph,
+                              msfile,
                               cals,
                               cal_tables,
                               g_cal,
                               bp_cal,
                               delay_cal,
-                              targets)
+                              targets,
+                              mode=args.apply_mode)
+
+    cache = None
+    fingerprint = ''
+    if args.cache_dir is not None and not DEBUG:
+        cache = cal_cache.TableCache(args.cache_dir,
+                                     max_bytes=args.cache_size * 1024 ** 3)
+    if (args.cache_dir is not None or args.average_cals) and not DEBUG:
+        fingerprint = _ms_fingerprint(args.msfile)
+
+    completed = cal_graph.run(graph,
+                              workers=args.workers,
+                              statefile=prefix + '.calgraph.json',
+                              force=not args.resume,
+                              dry_run=DEBUG,
+                              verbose=VERBOSE,
+                              log=TASK_LOG,
+                              cache=cache,
+                              fingerprint=fingerprint)
+    _print_apply_timing(graph, completed)
+
+    if TASK_LOG is not None:
+        TASK_LOG.close()
 
 # -fin-
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+# Manifest of flagging rules already applied to a measurement set
+# The manifest is stored beside the MS, <msfile>.flagstate.json, and holds a
+# fingerprint of the MS main table, a hash of each applied flag command and a
+# signature of the FLAG column after the last applied command.
+# Flags reset outside the manifest, by flagmanager restore, unflagging or a new
+# split, change the signature, so the manifest is reset and all rules apply again
+
+import datetime
+import hashlib
+import json
+import numpy as np
+import os
+
+MANIFEST_VERSION = 2
+# rows of the FLAG column sampled for its signature, evenly spread over the MS
+FLAG_SAMPLE_ROWS = 64
+
+
+def _table():
+    try:
+        from casatools import table
+    except ImportError:
+        from taskinit import tbtool as table
+    return table()
+
+
+def _hash(value):
+    return hashlib.sha1(str(value).encode('utf-8')).hexdigest()
+
+
+def manifest_name(msfile):
+    return msfile.rstrip('/') + '.flagstate.json'
+
+
+def ms_fingerprint(msfile):
+    """
+    Identify the observation and layout of the MS without reading the data:
+    shape of the main table, first and last timestamps, antennas and channels
+    """
+    tb = _table()
+    tb.open(msfile)
+    try:
+        nrows = tb.nrows()
+        ident = [nrows, sorted(tb.colnames())]
+        if nrows > 0:
+            ident += [tb.getcell('TIME', 0), tb.getcell('TIME', nrows - 1)]
+    finally:
+        tb.close()
+    tb.open(os.path.join(msfile, 'ANTENNA'))
+    try:
+        ident.append(list(tb.getcol('NAME')))
+    finally:
+        tb.close()
+    tb.open(os.path.join(msfile, 'SPECTRAL_WINDOW'))
+    try:
+        for spw in range(tb.nrows()):
+            ident.append(list(tb.getcell('CHAN_FREQ', spw)))
+    finally:
+        tb.close()
+    return _hash(ident)
+
+
+def flag_signature(msfile, n_rows=FLAG_SAMPLE_ROWS):
+    """
+    Hash of the FLAG column of n_rows rows spread over the main table.
+    Channel, baseline and time range flags show in every sample, flags
+    confined to rows between the samples may not
+    """
+    tb = _table()
+    tb.open(msfile)
+    try:
+        nrows = tb.nrows()
+        if nrows < 1:
+            return _hash([])
+        step = max(1, nrows // n_rows)
+        flags = tb.getcol('FLAG', startrow=0, nrow=-1, rowincr=step)
+    finally:
+        tb.close()
+    flags = np.asarray(flags, dtype=bool)
+    return hashlib.sha1(np.packbits(flags).tobytes() +
+                        str(flags.shape).encode('utf-8')).hexdigest()
+
+
+def rule_hash(cmd):
+    """Hash of a flagdata list command, independent of parameter order"""
+    return _hash(' '.join(sorted(cmd.split())))
+
+
+def load(msfile, fingerprint=None):
+    """
+    Manifest for the MS, reset if the MS no longer matches its fingerprint
+    or its flags changed since the manifest was saved
+    """
+    if fingerprint is None:
+        fingerprint = ms_fingerprint(msfile)
+    flags = flag_signature(msfile)
+    manifest = {'version': MANIFEST_VERSION,
+                'fingerprint': fingerprint,
+                'flags': flags,
+                'rules': {},
+                }
+    filename = manifest_name(msfile)
+    if os.path.isfile(filename):
+        with open(filename, 'r') as fin:
+            stored = json.load(fin)
+        if (stored.get('version') == MANIFEST_VERSION and
+                stored.get('fingerprint') == fingerprint and
+                stored.get('flags') == flags):
+            manifest = stored
+        elif stored.get('rules'):
+            print('Flags of {} changed since the last flagging run, '
+                  'applying all rules'.format(msfile))
+    return manifest
+
+
+def save(msfile, manifest):
+    """Save the manifest with the signature of the current flags"""
+    manifest['flags'] = flag_signature(msfile)
+    filename = manifest_name(msfile)
+    tmpfile = filename + '.tmp'
+    with open(tmpfile, 'w') as fout:
+        json.dump(manifest, fout, indent=1, sort_keys=True)
+    os.rename(tmpfile, filename)
+
+
+def pending(manifest, cmds):
+    """Flag commands not yet applied to the MS"""
+    return [cmd for cmd in cmds if rule_hash(cmd) not in manifest['rules']]
+
+
+def record(manifest, cmds):
+    """Mark flag commands as applied"""
+    applied = datetime.datetime.utcnow().isoformat()
+    for cmd in cmds:
+        manifest['rules'][rule_hash(cmd)] = {'cmd': cmd,
+                                             'applied': applied}
+    return manifest
+
+# -fin-
@@ -6,7 +6,24 @@ from taskinit import *
 from tasks import *
 
 import argparse
+import ast
+import auto_flagging
 import casac
+import flag_state
+import mkat_channels
+import numpy as np
+import os
+import parallel_flagging
+import rfi_bands
+import task_log
+import time
+
+# re-runs only apply flagging rules not yet recorded in the MS manifest
+INCREMENTAL = True
+_manifests = {}
+# task timing log, and flagged fraction before and after each flagdata call
+TASK_LOG = None
+FLAG_SUMMARY = False
 
 
 def cli():
@@ -73,125 +90,547 @@ def cli():
             action='store_true',
             help='Flag out Inmarsat 1526-1554 [MHz]',
             )
+    parser.add_argument(
+            '--band',
+            type=str,
+            choices=sorted(rfi_bands.BANDS),
+            help='Receiver band of the RFI catalogue ranges, '
+                 'default from the frequencies of the MS',
+            )
+    parser.add_argument(
+            '--rfi-catalogue',
+            type=str,
+            default=rfi_bands.CATALOGUE,
+            help='Catalogue of known RFI frequency ranges',
+            )
+    parser.add_argument(
+            '--date',
+            type=str,
+            help='Observation date, YYYY-MM-DD, to select RFI ranges '
+                 'valid at the time of observation',
+            )
+    parser.add_argument(
+            '--single-pass',
+            action='store_true',
+            help='Gather all selected flagging rules into a single '
+                 'flagdata list command, reading the MS only once',
+            )
+    parser.add_argument(
+            '--auto',
+            action='store_true',
+            help='Automated statistical RFI detection (SumThreshold) '
+                 'after applying the flagging rules',
+            )
+    parser.add_argument(
+            '--auto-threshold',
+            type=float,
+            default=6.,
+            help='SumThreshold detection threshold for single samples, '
+                 'in units of the robust standard deviation',
+            )
+    parser.add_argument(
+            '--max-mem',
+            type=float,
+            default=512.,
+            help='Memory limit [MB] for each block of visibilities read '
+                 'during automated RFI detection',
+            )
+    parser.add_argument(
+            '--parallel',
+            type=int,
+            default=0,
+            metavar='N',
+            help='Partition the MS into a multi-MS and flag the sub-MSs '
+                 'using a pool of N processes',
+            )
+    parser.add_argument(
+            '--separationaxis',
+            type=str,
+            default='scan',
+            choices=['scan', 'spw'],
+            help='Axis along which to partition the MS for parallel flagging',
+            )
+    parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Apply all flagging rules, also those already applied '
+                 'according to the flag state manifest of the MS',
+            )
+    parser.add_argument(
+            '--task-log',
+            type=str,
+            help='JSON lines file recording wall time, CPU time and peak '
+                 'memory of each flagging task',
+            )
+    parser.add_argument(
+            '--chrome-trace',
+            type=str,
+            help='Chrome trace format file of the flagging tasks',
+            )
+    parser.add_argument(
+            '--flag-summary',
+            action='store_true',
+            help='Record the flagged fraction before and after each flagdata '
+                 'call in the task log, requires extra passes through the data',
+            )
+    parser.add_argument(
+            '--benchmark',
+            action='store_true',
+            help='Run the per rule and the single pass flagging, each '
+                 'starting from the same flags, and report the wall-clock '
+                 'time of each',
+            )
+    parser.add_argument(
+            '--benchmark-rounds',
+            type=int,
+            default=2,
+            help='Benchmark rounds, alternating which mode runs first',
+            )
     return parser.parse_args()
 
 
+def _print_msg(msg):
+    msg_text = '\n###\t{}\t###\n'.format(msg)
+    print(msg_text)
+
+
+# apply a list of flagdata commands in a single pass through the data
+def _apply_flags(msfile, cmds):
+    cmds = _pending_cmds(msfile, cmds)
+    if len(cmds) < 1:
+        return
+    _flagdata(msfile,
+              mode='list',
+              inpfile=cmds,
+              flagbackup=False)
+    _record_cmds(msfile, cmds)
+
+
+# flagged fraction of the MS, an additional pass through the data
+def _flag_fraction(msfile):
+    summary = flagdata(vis=msfile, mode='summary')
+    return float(summary['flagged']) / summary['total']
+
+
+# flagdata call recorded in the task log
+def _flagdata(msfile, **kwargs):
+    if TASK_LOG is None:
+        return flagdata(vis=msfile, **kwargs)
+    extra = {'vis': msfile,
+             'mode': kwargs.get('mode'),
+             }
+    if 'inpfile' in kwargs:
+        extra['n_cmds'] = len(kwargs['inpfile'])
+    if FLAG_SUMMARY:
+        extra['flagged_before'] = _flag_fraction(msfile)
+    result, timing = TASK_LOG.measure(flagdata, vis=msfile, **kwargs)
+    if FLAG_SUMMARY:
+        extra['flagged_after'] = _flag_fraction(msfile)
+    TASK_LOG.record('flagdata', timing, extra)
+    return result
+
+
+def _manifest(msfile):
+    if msfile not in _manifests:
+        _manifests[msfile] = flag_state.load(msfile)
+    return _manifests[msfile]
+
+
+# flag commands not yet applied to the MS
+def _pending_cmds(msfile, cmds):
+    if not INCREMENTAL:
+        return cmds
+    pending = flag_state.pending(_manifest(msfile), cmds)
+    if len(pending) < len(cmds):
+        print('Skipping {} flagging rules already applied to {}'.format(
+            len(cmds) - len(pending), msfile))
+    return pending
+
+
+# record applied flag commands in the manifest beside the MS
+def _record_cmds(msfile, cmds):
+    if not INCREMENTAL or len(cmds) < 1:
+        return
+    manifest = flag_state.record(_manifest(msfile), cmds)
+    flag_state.save(msfile, manifest)
+
+
+# flagdata keyword arguments of a list command, "mode='clip' clipzeros=True"
+def _cmd_kwargs(cmd):
+    kwargs = {}
+    for param in cmd.split():
+        key, value = param.split('=', 1)
+        kwargs[key] = ast.literal_eval(value)
+    return kwargs
+
+
+# apply each flagdata command as a separate pass through the data,
+# with a flagdata call per rule as before the single pass mode
+def _apply_flags_per_cmd(msfile, cmds):
+    for cmd in _pending_cmds(msfile, cmds):
+        _flagdata(msfile,
+                  flagbackup=False,
+                  **_cmd_kwargs(cmd))
+        _record_cmds(msfile, [cmd])
+
+
+def _manual_cmd(spw):
+    return "mode='manual' spw='{}'".format(spw)
+
+
+# flag commands for catalogue frequency ranges, merged to the fewest ranges
+def _catalogue_cmds(categories,
+                    band='l',
+                    date=None,
+                    catalogue=None):
+    intervals = rfi_bands.select_intervals(categories,
+                                           band=band,
+                                           date=date,
+                                           catalogue=catalogue)
+    if len(intervals) < 1:
+        return []
+    return [_manual_cmd(rfi_bands.intervals2spw(intervals))]
+
+
+# channel frequencies [MHz] per spectral window
+def _ms_freqs(msfile):
+    msmd = casac.casac.msmetadata()
+    msmd.open(msfile)
+    freqs = [np.asarray(msmd.chanfreqs(spw)) / 1e6 for spw in range(msmd.nspw())]
+    msmd.close()
+    return freqs
+
+
+# band covering the first spectral window of the MS, nearest band start
+def _ms_band(msfile):
+    freqs = _ms_freqs(msfile)[0]
+    centre = freqs.mean()
+    bands = [band for band, (f_start, bandwidth) in rfi_bands.BANDS.items()
+             if f_start <= centre < f_start + bandwidth]
+    if len(bands) < 1:
+        raise ValueError('No band covers {:.1f} MHz of {}, known bands {}'.format(
+            centre, msfile, sorted(rfi_bands.BANDS)))
+    return min(bands, key=lambda band: abs(rfi_bands.BANDS[band][0] - freqs[0]))
+
+
+# number of channels if the spectral window is the full channel grid of the band
+def _band_nchans(freqs, band):
+    grid = mkat_channels.channel_freqs(band, len(freqs))
+    width = grid[1] - grid[0] if len(grid) > 1 else 0.
+    if np.allclose(freqs, grid, rtol=0., atol=0.01 * width):
+        return len(freqs)
+    return None
+
+
+# shadowing, low elevation and extreme outliers
+def basic_flagging_cmds(zeros=False):  # clip zero value data
+    cmds = ["mode='shadow'",
+            "mode='elevation' lowerlimit=15",
+            "mode='clip' clipminmax=[1e-5,1000.0]",
+            ]
+    if zeros:
+        cmds.append("mode='clip' field='' clipzeros=True")
+    return cmds
+
+
 def basic_flagging(msfile,
                    zeros=False):  # clip zero value data
-    flagdata(vis=msfile,
-             mode='shadow',
-             flagbackup=False)
-    flagdata(vis=msfile,
-             mode='elevation',
-             lowerlimit=15,
-             flagbackup=False)
-    flagdata(vis=msfile,
-             mode='clip',
-             clipminmax=[1e-5, 1000.0],
-             flagbackup=False)
-    if zeros:
-        flagdata(vis=msfile,
-                 mode='clip',
-                 field='',
-                 clipzeros=True,
-                 flagbackup=False)
+    _apply_flags_per_cmd(msfile, basic_flagging_cmds(zeros=zeros))
 
 
 # flag bandpass edges
+def bp_edges_flagging_cmds(band='l',
+                           date=None,
+                           catalogue=None):
+    return _catalogue_cmds(['bp'],
+                           band=band,
+                           date=date,
+                           catalogue=catalogue)
+
+
 def bp_edges_flagging(msfile,
-                      band='l'):
-    if str.lower(band) == 'l':
-        flagdata(vis=msfile,
-                 mode='manual',
-                 spw='*:856MHZ~880MHZ;1658MHZ~1800MHZ',
-                 flagbackup=False)
+                      band='l',
+                      date=None):
+    _apply_flags_per_cmd(msfile, bp_edges_flagging_cmds(band=band, date=date))
 
 
 # flag Milky Way
-def mw_flagging(msfile):
-    flagdata(vis=msfile,
-             mode='manual',
-             spw='*:1420.0MHZ~1421.3MHZ',
-             flagbackup=False)
+def mw_flagging_cmds(band='l',
+                     date=None,
+                     catalogue=None):
+    return _catalogue_cmds(['mw'],
+                           band=band,
+                           date=date,
+                           catalogue=catalogue)
 
 
-# flag out known satellite RFI frequencies
-def lband_env_flagging(msfile,
-                       ligo_freq=None):
+def mw_flagging(msfile,
+                date=None):
+    _apply_flags_per_cmd(msfile, mw_flagging_cmds(date=date))
+
+
+# flag out known environmental RFI frequencies
+def lband_env_flagging_cmds(ligo_freq=None,
+                            band='l',
+                            date=None,
+                            catalogue=None):
+    # GSM and Alkantpan from the catalogue
+    cmds = _catalogue_cmds(['lband'],
+                           band=band,
+                           date=date,
+                           catalogue=catalogue)
     # flag out aviation channels
     if ligo_freq is None:
-        ligo_freq = '*:1080MHZ~1095MHZ'
-    flagdata(vis=msfile,
-             mode='manual',
-             spw=ligo_freq,
-             flagbackup=False)
-    # GSM
-    flagdata(vis=msfile,
-             mode='manual',
-             spw='*:900MHZ~915MHZ;925MHZ~960MHZ',
-             flagbackup=False)
-    # Alkantpan
-    flagdata(vis=msfile,
-             mode='manual',
-             spw='*:1600MHZ',
-             flagbackup=False)
+        cmds = _catalogue_cmds(['aviation'],
+                               band=band,
+                               date=date,
+                               catalogue=catalogue) + cmds
+    else:
+        cmds.insert(0, _manual_cmd(ligo_freq))
+    return cmds
+
+
+def lband_env_flagging(msfile,
+                       ligo_freq=None,
+                       date=None):
+    _apply_flags_per_cmd(msfile,
+                         lband_env_flagging_cmds(ligo_freq=ligo_freq,
+                                                 date=date))
+
+
+SATELLITES = ['gps', 'glonass', 'galileo', 'afristar', 'iridium', 'inmarsat']
 
 
 # flag out known satellite RFI frequencies
+def sat_rfi_flagging_cmds(gps=False,
+                          glonass=False,
+                          galileo=False,
+                          afristar=False,
+                          iridium=False,
+                          inmarsat=False,
+                          band='l',
+                          date=None,
+                          catalogue=None):
+    selected = {'gps': gps,
+                'glonass': glonass,
+                'galileo': galileo,
+                'afristar': afristar,
+                'iridium': iridium,
+                'inmarsat': inmarsat,
+                }
+    cmds = []
+    for satellite in SATELLITES:
+        if selected[satellite]:
+            cmds += _catalogue_cmds([satellite],
+                                    band=band,
+                                    date=date,
+                                    catalogue=catalogue)
+    return cmds
+
+
 def sat_rfi_flagging(msfile,
                      gps=False,
                      glonass=False,
                      galileo=False,
                      afristar=False,
                      iridium=False,
-                     inmarsat=False):
-    if gps:  # GPS
-        flagdata(vis=msfile,
-                 mode='manual',
-                 spw='*:1565MHZ~1585MHZ;1217MHZ~1237MHZ;1375MHZ~1387MHZ;1166MHZ~1186MHZ',
-                 flagbackup=False)
-    if glonass:  # GLONASS
-        flagdata(vis=msfile,
-                 mode='manual',
-                 spw='*:1592MHZ~1610MHZ;1242MHZ~1249MHZ',
-                 flagbackup=False)
-    if galileo:  # Galileo
-        flagdata(vis=msfile,
-                 mode='manual',
-                 spw='*:1191MHZ~1217MHZ;1260MHZ~1300MHZ',
-                 flagbackup=False)
-    if afristar:  # Afristar
-        flagdata(vis=msfile,
-                 mode='manual',
-                 spw='*:1453MHZ~1490MHZ',
-                 flagbackup=False)
-    if iridium:  # IRIDIUM
-        flagdata(vis=msfile,
-                 mode='manual',
-                 spw='*:1616MHZ~1626MHZ',
-                 flagbackup=False)
-    if inmarsat:  # Inmarsat
-        flagdata(vis=msfile,
-                 mode='manual',
-                 spw='*:1526MHZ~1554MHZ',
-                 flagbackup=False)
+                     inmarsat=False,
+                     date=None):
+    cmds = sat_rfi_flagging_cmds(gps=gps,
+                                 glonass=glonass,
+                                 galileo=galileo,
+                                 afristar=afristar,
+                                 iridium=iridium,
+                                 inmarsat=inmarsat,
+                                 date=date)
+    _apply_flags_per_cmd(msfile, cmds)
 
 
-if __name__ == '__main__':
-    args = cli()
-    basic_flagging(args.msfile,
-                   zeros=args.zeros)
+# catalogue categories selected on the command line
+def _categories(args):
+    categories = [category
+                  for category in ['bp', 'mw', 'lband'] + SATELLITES
+                  if getattr(args, category)]
+    if args.lband:
+        categories.append('aviation')
+    return categories
+
+
+# flagdata commands for each rule group, as applied one pass per command
+def per_rule_cmds(args):
+    catalogue = rfi_bands.load_catalogue(args.rfi_catalogue)
+    cmds = basic_flagging_cmds(zeros=args.zeros)
     if args.bp:
-        bp_edges_flagging(args.msfile)
+        cmds += bp_edges_flagging_cmds(band=args.band, date=args.date,
+                                       catalogue=catalogue)
     if args.mw:
-        mw_flagging(args.msfile)
+        cmds += mw_flagging_cmds(band=args.band, date=args.date,
+                                 catalogue=catalogue)
     if args.lband:
-        lband_env_flagging(args.msfile)
-    sat_rfi_flagging(args.msfile,
-                 gps=args.gps,
-                 glonass=args.glonass,
-                 galileo=args.galileo,
-                 afristar=args.afristar,
-                 iridium=args.iridium)
+        cmds += lband_env_flagging_cmds(band=args.band, date=args.date,
+                                        catalogue=catalogue)
+    cmds += sat_rfi_flagging_cmds(gps=args.gps,
+                                  glonass=args.glonass,
+                                  galileo=args.galileo,
+                                  afristar=args.afristar,
+                                  iridium=args.iridium,
+                                  inmarsat=args.inmarsat,
+                                  band=args.band,
+                                  date=args.date,
+                                  catalogue=catalogue)
+    return cmds
+
+
+# gather all selected flagging rules into one flagdata command list,
+# with all frequency ranges merged into a single manual selection
+def flagging_cmds(args, n_chans=None):
+    catalogue = rfi_bands.load_catalogue(args.rfi_catalogue)
+    cmds = basic_flagging_cmds(zeros=args.zeros)
+    intervals = rfi_bands.select_intervals(_categories(args),
+                                           band=args.band,
+                                           date=args.date,
+                                           catalogue=catalogue)
+    if len(intervals) < 1:
+        return cmds
+    spw = rfi_bands.intervals2spw(intervals)
+    if n_chans is not None:
+        # use the compiled channel mask if it gives a shorter selection
+        mask = rfi_bands.channel_mask(intervals, args.band, n_chans)
+        if not mask.any():
+            return cmds
+        chan_spw = rfi_bands.mask2spw(mask)
+        if len(chan_spw) < len(spw):
+            spw = chan_spw
+    cmds.append(_manual_cmd(spw))
+    return cmds
+
+
+# all selected rules applied with a single read/write of the FLAG column
+def single_pass_flagging(msfile, args):
+    freqs = _ms_freqs(msfile)
+    if len(freqs) == 1:
+        cmds = flagging_cmds(args, n_chans=_band_nchans(freqs[0], args.band))
+    else:
+        cmds = flagging_cmds(args)
+    _apply_flags(msfile, cmds)
+
+
+# each rule applied with a separate read/write of the FLAG column
+def per_rule_flagging(msfile, args):
+    _apply_flags_per_cmd(msfile, per_rule_cmds(args))
+
+
+# all selected rules applied to each partition of a multi-MS in parallel
+def partitioned_flagging(msfile, args):
+    mms = parallel_flagging.partition_ms(msfile,
+                                         separationaxis=args.separationaxis)
+    partitions = parallel_flagging.sub_ms(mms)
+    cmds = _pending_cmds(mms, flagging_cmds(args))
+    print('Flagging {} partitions of {} with {} processes'.format(
+        len(partitions), mms, args.parallel))
+    summary, per_partition = parallel_flagging.parallel_flagging(
+            partitions,
+            cmds,
+            args.parallel)
+    _record_cmds(mms, cmds)
+    for part in partitions:
+        part_summary = per_partition[part]
+        print('  {}: {:.2f}% flagged'.format(
+            os.path.basename(part),
+            100. * part_summary['flagged'] / part_summary['total']))
+    print('Total: {:.2f}% flagged'.format(
+        100. * summary['flagged'] / summary['total']))
+    return summary
+
+
+# statistical RFI detection streamed over baselines and scans
+def auto_rfi_flagging(msfile, args):
+    cmd = "mode='auto' chi_1={} max_mem_mb={}".format(args.auto_threshold,
+                                                      args.max_mem)
+    if len(_pending_cmds(msfile, [cmd])) < 1:
+        return
+    n_flagged, n_total = auto_flagging.auto_flagging(
+            msfile,
+            max_mem_mb=args.max_mem,
+            chi_1=args.auto_threshold)
+    _record_cmds(msfile, [cmd])
+    if n_total > 0:
+        print('Automated RFI detection: {:.2f}% flagged'.format(
+            100. * n_flagged / n_total))
+
+
+def _timed(func, *args):
+    start = time.time()
+    if TASK_LOG is None:
+        func(*args)
+    else:
+        TASK_LOG.run(func.__name__, func, *args)
+    return time.time() - start
+
+
+# per rule and single pass flagging, each run starting from the flags of the
+# MS before the benchmark, alternating which mode runs first in each round
+def benchmark(msfile, args, rounds=2):
+    version = 'benchmark_start'
+    flagmanager(vis=msfile, mode='save', versionname=version,
+                comment='flags before flagging_mkat_lband.py --benchmark')
+    modes = [('per rule', per_rule_flagging),
+             ('single pass', single_pass_flagging)]
+    timing = dict((name, []) for name, _ in modes)
+    try:
+        for round_ in range(rounds):
+            for name, func in (modes if round_ % 2 == 0 else modes[::-1]):
+                flagmanager(vis=msfile, mode='restore', versionname=version)
+                _print_msg('{} flagging, round {}'.format(name.capitalize(),
+                                                          round_ + 1))
+                timing[name].append(_timed(func, msfile, args))
+    finally:
+        flagmanager(vis=msfile, mode='delete', versionname=version)
+    return timing
+
+
+if __name__ == '__main__':
+    args = cli()
+    if args.band is None:
+        args.band = _ms_band(args.msfile)
+    # benchmark timings require every rule to be applied in both runs
+    if args.force or args.benchmark:
+        INCREMENTAL = False
+    if args.task_log is not None or args.chrome_trace is not None:
+        TASK_LOG = task_log.TaskLog(logfile=args.task_log,
+                                    tracefile=args.chrome_trace)
+        FLAG_SUMMARY = args.flag_summary
+    n_passes = len(per_rule_cmds(args))
+    if args.benchmark:
+        timing = benchmark(args.msfile, args, rounds=args.benchmark_rounds)
+        t_per_rule = sum(timing['per rule']) / len(timing['per rule'])
+        t_single = sum(timing['single pass']) / len(timing['single pass'])
+        print('Mean wall-clock time over {} rounds'.format(args.benchmark_rounds))
+        print('  per rule:    {:8.1f} s ({} passes)'.format(t_per_rule, n_passes))
+        print('  single pass: {:8.1f} s (1 pass)'.format(t_single))
+        if t_single > 0:
+            print('  speedup:     {:8.2f}x'.format(t_per_rule / t_single))
+    elif args.parallel > 0:
+        elapsed = _timed(partitioned_flagging, args.msfile, args)
+        print('Applied {} flagging rules in parallel: {:.1f} s'.format(
+            n_passes, elapsed))
+    elif args.single_pass:
+        elapsed = _timed(single_pass_flagging, args.msfile, args)
+        print('Applied {} flagging rules in a single pass: {:.1f} s'.format(
+            n_passes, elapsed))
+    else:
+        per_rule_flagging(args.msfile, args)
+
+    if args.auto:
+        msfile = args.msfile
+        if args.parallel > 0:
+            msfile = parallel_flagging.partition_ms(
+                    msfile, separationaxis=args.separationaxis)
+        _print_msg('Automated RFI detection')
+        elapsed = _timed(auto_rfi_flagging, msfile, args)
+        print('Automated RFI detection: {:.1f} s'.format(elapsed))
+
+    if TASK_LOG is not None:
+        TASK_LOG.close()
 
 # -fin-
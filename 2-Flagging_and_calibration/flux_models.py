@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+# Spectral flux density models of the MeerKAT flux calibrators
+# log10(S) = a + b*log10(f) + c*log10(f)**2 + d*log10(f)**3, S in Jy
+# Coefficients for J1939-6342 and J0408-6545 as in Standard_flux_calibrators.ipynb,
+# J1331+3030 (3C286) from Perley & Butler 2013, ApJS 204, 19
+#
+# Models are evaluated over all channel frequencies at once, memoized per
+# source and channel grid, and converted to setjy(standard='manual') parameters
+# https://casa.nrao.edu/docs/TaskRef/setjy-task.html
+
+import hashlib
+import numpy as np
+
+# polynomial coefficients [a, b, c, d] and frequency unit [Hz] of f
+MODELS = {'J1939-6342': ([-30.7667, 26.4908, -7.0977, 0.605334], 1e6),
+          'J0408-6545': ([-0.9790, 3.3662, -1.1216, 0.0861], 1e6),
+          'J1331+3030': ([1.2481, -0.4507, -0.1798, 0.0357], 1e9),
+          }
+# alternative names of the calibrators
+ALIASES = {'PKS1934-63': 'J1939-6342',
+           'PKS1934-638': 'J1939-6342',
+           '1934-638': 'J1939-6342',
+           'PKS0408-65': 'J0408-6545',
+           '0408-65': 'J0408-6545',
+           '3C286': 'J1331+3030',
+           }
+# L-band centre frequency [Hz]
+REF_FREQ = 1.284e9
+
+_flux_cache = {}
+
+
+def model_name(source):
+    """Registry name of a calibrator, KeyError if there is no model"""
+    name = ALIASES.get(source, source)
+    if name not in MODELS:
+        raise KeyError('No flux model for {}, known calibrators {}'.format(
+            source, sorted(MODELS)))
+    return name
+
+
+def _grid_key(freqs):
+    return hashlib.sha1(np.ascontiguousarray(freqs, dtype=np.float64)).hexdigest()
+
+
+def stokes_i(source, freqs):
+    """
+    Stokes I flux density [Jy] at the frequencies [Hz], evaluated once per
+    source and channel grid, the returned array is read-only
+    """
+    name = model_name(source)
+    freqs = np.asarray(freqs, dtype=np.float64)
+    key = (name, freqs.shape, _grid_key(freqs))
+    if key not in _flux_cache:
+        coeffs, unit = MODELS[name]
+        log_s = np.polynomial.polynomial.polyval(np.log10(freqs / unit), coeffs)
+        flux = 10. ** log_s
+        flux.flags.writeable = False
+        _flux_cache[key] = flux
+    return _flux_cache[key]
+
+
+def spectral_terms(source, ref_freq=REF_FREQ):
+    """
+    Flux density at ref_freq and spectral index terms as used by setjy,
+    S = S0 * (f/f0)**(spix[0] + spix[1]*ln(f/f0) + spix[2]*ln(f/f0)**2)
+    """
+    coeffs, unit = MODELS[model_name(source)]
+    # re-centre the polynomial on log10(ref_freq)
+    poly = np.polynomial.Polynomial(coeffs)
+    shifted = poly(np.polynomial.Polynomial([np.log10(ref_freq / unit), 1.])).coef
+    shifted = np.pad(shifted, (0, len(coeffs) - len(shifted)), 'constant')
+    flux = 10. ** shifted[0]
+    # 10**(b*x + c*x**2 + ...) = (f/f0)**(b + c*x + ...) with x = log10(f/f0)
+    spix = [term / np.log(10.) ** order
+            for order, term in enumerate(shifted[1:])]
+    return float(flux), [float(term) for term in spix]
+
+
+def setjy_params(source, ref_freq=REF_FREQ):
+    """setjy parameters for the model with standard='manual'"""
+    flux, spix = spectral_terms(source, ref_freq=ref_freq)
+    return dict(standard='manual',
+                fluxdensity=[flux, 0, 0, 0],
+                spix=spix,
+                reffreq='{}MHz'.format(ref_freq / 1e6))
+
+
+def model_data(source, freqs, n_corr=4):
+    """
+    MODEL_DATA values of the unpolarised calibrator at the phase centre,
+    (n_corr, n_chans), for linear feeds XX = YY = I
+    """
+    flux = stokes_i(source, freqs)
+    model = np.zeros((n_corr, len(flux)), dtype=np.complex64)
+    model[0] = flux
+    model[n_corr - 1] = flux
+    return model
+
+
+def write_model(msfile, field, source, rows_per_chunk=10000):
+    """Write the model of the calibrator to the MODEL_DATA column of its field"""
+    try:
+        from casatools import table
+    except ImportError:
+        from taskinit import tbtool as table
+    tb = table()
+    tb.open(msfile + '/FIELD')
+    field_id = list(tb.getcol('NAME')).index(field)
+    tb.close()
+    tb.open(msfile + '/SPECTRAL_WINDOW')
+    freqs = tb.getcell('CHAN_FREQ', 0)
+    tb.close()
+
+    tb.open(msfile, nomodify=False)
+    subtb = tb.query('FIELD_ID=={}'.format(field_id))
+    try:
+        n_corr = subtb.getcell('DATA', 0).shape[0]
+        model = model_data(source, freqs, n_corr=n_corr)
+        n_rows = subtb.nrows()
+        for start in range(0, n_rows, rows_per_chunk):
+            nrow = min(rows_per_chunk, n_rows - start)
+            subtb.putcol('MODEL_DATA',
+                         np.repeat(model[:, :, np.newaxis], nrow, axis=2),
+                         startrow=start, nrow=nrow)
+    finally:
+        subtb.close()
+        tb.close()
+
+# -fin-
@@ -2,12 +2,19 @@
 # https://casa.nrao.edu/docs/TaskRef/plotcal-task.html
 
 from os import F_OK
-from taskinit import *
-from tasks import *
+try:
+    from taskinit import *
+    from tasks import *
+    import casac
+except ImportError:
+    # headless rendering does not need CASA
+    pass
 
 import argparse
-import casac
+import cal_qa
+import cal_solutions
 import os
+import sys
 
 
 def print_msg(msg):
@@ -15,6 +22,17 @@ def print_msg(msg):
     print(msg_text)
 
 
+def plot_solutions(caltable, **kwargs):
+    """plotcal for CASA tables, cal_solutions for NumPy solutions"""
+    if caltable.endswith('.npz'):
+        kwargs.pop('showgui', None)
+        cal_solutions.plot_figure(cal_solutions.load(caltable),
+                                  title=os.path.basename(caltable),
+                                  **kwargs)
+    else:
+        plotcal(caltable=caltable, **kwargs)
+
+
 def cli():
     usage = "%%prog [options]"
     description = 'antenna based calibration solutions'
@@ -28,7 +46,8 @@ def cli():
             dest='ktable',
             metavar='ktable',
             type=str,
-            help="CASA delay calibration solution table name, 'K'",
+            help="CASA delay calibration solution table name, 'K', "
+                 "or NumPy quick-look solutions, 'K.npz'",
             )
     parser.add_argument(
             '--prelim',
@@ -63,6 +82,40 @@ def cli():
             help="comma separated list of gain calibrators "
                  "for gain calibration solution displays",
             )
+    parser.add_argument(
+            '--headless',
+            action='store_true',
+            help='read each table once and draw all figures without CASA, '
+                 'using python-casacore or the CASA table tool',
+            )
+    parser.add_argument(
+            '-j', '--workers',
+            type=int,
+            help='number of processes drawing figures with --headless, '
+                 'default one per figure up to the number of CPUs',
+            )
+    parser.add_argument(
+            '--full-resolution',
+            action='store_true',
+            help='with --headless, draw every solution instead of the minimum '
+                 'and maximum per pixel column',
+            )
+    parser.add_argument(
+            '--benchmark',
+            action='store_true',
+            help='time drawing each figure at full resolution and decimated',
+            )
+    parser.add_argument(
+            '--qa',
+            type=str,
+            help='JSON report of numeric checks of the solutions per antenna, '
+                 'exit status 1 if any check fails',
+            )
+    parser.add_argument(
+            '--qa-thresholds',
+            type=str,
+            help='YAML file of QA thresholds replacing the defaults in cal_qa.py',
+            )
     parser.add_argument(
             '-v', '--verbose',
             action='store_true',
@@ -71,65 +124,110 @@ def cli():
     return parser.parse_args()
 
 
-if __name__ == '__main__':
-    args = cli()
-
+def figures(args):
+    """Advice and plotcal parameters of each diagnostic figure"""
+    figs = []
     if args.ktable:
-        print_msg("Delays after calibration should be no more than "
-                  "a few nanoseconds and spread around/close to zero.")
-        plotcal(caltable=args.ktable,
-                xaxis='antenna', yaxis='delay',
-                showgui=args.verbose, figfile='delay_solutions.png')
+        figs.append(("Delays after calibration should be no more than "
+                     "a few nanoseconds and spread around/close to zero.",
+                     args.ktable,
+                     dict(xaxis='antenna', yaxis='delay',
+                          figfile='delay_solutions.png')))
 
     if args.gtable0:
-        print_msg("Through away phase calibration to stabilize "
-                  "time varying components")
-        plotcal(caltable=args.gtable0,
-                xaxis='time', yaxis='phase',
-                plotrange=[-1, -1, -180, 180],
-                showgui=args.verbose, figfile='prelim_phase_solutions.png')
+        figs.append(("Through away phase calibration to stabilize "
+                     "time varying components",
+                     args.gtable0,
+                     dict(xaxis='time', yaxis='phase',
+                          plotrange=[-1, -1, -180, 180],
+                          figfile='prelim_phase_solutions.png')))
 
     if args.btable:
-        print_msg("Phase solutions should be around 0")
-        plotcal(caltable=args.btable,
-                xaxis='chan', yaxis='phase',
-                showgui=args.verbose, figfile='bandpass_phase_solutions.png')
-        print_msg("Passband amp around 1. and consistent with bandpass shape.")
-        plotcal(caltable=args.btable,
-                xaxis='chan', yaxis='amp',
-                showgui=args.verbose, figfile='bandpass_amp_solutions.png')
+        figs.append(("Phase solutions should be around 0",
+                     args.btable,
+                     dict(xaxis='chan', yaxis='phase',
+                          figfile='bandpass_phase_solutions.png')))
+        figs.append(("Passband amp around 1. and consistent with bandpass shape.",
+                     args.btable,
+                     dict(xaxis='chan', yaxis='amp',
+                          figfile='bandpass_amp_solutions.png')))
 
     if args.gtable:
-        print_msg("Phase solutions should be in a straight line")
+        msg = "Phase solutions should be in a straight line"
         if args.primary:
-            plotcal(caltable=args.gtable,
-                    xaxis='time', yaxis='phase',
-                    field=args.primary,
-                    plotrange=[-1, -1, -180, 180],
-                    showgui=args.verbose,
-                    figfile='primary_gain_phase_solutions.png')
+            figs.append((msg,
+                         args.gtable,
+                         dict(xaxis='time', yaxis='phase',
+                              field=args.primary,
+                              plotrange=[-1, -1, -180, 180],
+                              figfile='primary_gain_phase_solutions.png')))
         if args.secondary:
-            plotcal(caltable=args.gtable,
-                    xaxis='time', yaxis='phase',
-                    field=args.secondary,
-                    plotrange=[-1, -1, -180, 180],
-                    showgui=args.verbose,
-                    figfile='secondary_gain_phase_solution.png')
-        print_msg("Flux density for the flux calibrator, if corrected, "
-                  "should lie close to or around 1"
-                  "Fluxes for secondary calibrators have not been corrected yet "
-                  "and are offset")
+            figs.append((msg,
+                         args.gtable,
+                         dict(xaxis='time', yaxis='phase',
+                              field=args.secondary,
+                              plotrange=[-1, -1, -180, 180],
+                              figfile='secondary_gain_phase_solution.png')))
+        msg = ("Flux density for the flux calibrator, if corrected, "
+               "should lie close to or around 1"
+               "Fluxes for secondary calibrators have not been corrected yet "
+               "and are offset")
         if args.primary:
-            plotcal(caltable=args.gtable,
-                    xaxis='time', yaxis='amp',
-                    field=args.primary,
-                    showgui=args.verbose,
-                    figfile='primary_gain_amp_solutions.png')
+            figs.append((msg,
+                         args.gtable,
+                         dict(xaxis='time', yaxis='amp',
+                              field=args.primary,
+                              figfile='primary_gain_amp_solutions.png')))
         if args.secondary:
-            plotcal(caltable=args.gtable,
-                    xaxis='time', yaxis='amp',
-                    field=args.secondary,
-                    showgui=args.verbose,
-                    figfile='secondary_gain_amp_solutions.png')
+            figs.append((msg,
+                         args.gtable,
+                         dict(xaxis='time', yaxis='amp',
+                              field=args.secondary,
+                              figfile='secondary_gain_amp_solutions.png')))
+    return figs
+
+
+if __name__ == '__main__':
+    args = cli()
+
+    figs = figures(args)
+    if args.benchmark:
+        print_msg('Render time [s] and file size [kB], full resolution and decimated')
+        for result in cal_solutions.benchmark([(caltable, kwargs)
+                                               for _, caltable, kwargs in figs]):
+            full = result['full']
+            dec = result['decimated']
+            print('{}: {:.2f} s {:.0f} kB, {:.2f} s {:.0f} kB'.format(
+                result['figfile'], full[0], full[1] / 1024., dec[0], dec[1] / 1024.))
+    elif args.headless:
+        # each table is read once, figures are drawn concurrently
+        for figfile in cal_solutions.render(
+                [(caltable, dict(kwargs, decimate=not args.full_resolution))
+                 for _, caltable, kwargs in figs],
+                workers=args.workers):
+            print(figfile)
+    else:
+        msg = None
+        for msg_, caltable, kwargs in figs:
+            if msg_ != msg:
+                print_msg(msg_)
+                msg = msg_
+            plot_solutions(caltable, showgui=args.verbose, **kwargs)
+
+    if args.qa:
+        report = cal_qa.qa_report(ktable=args.ktable,
+                                  btable=args.btable,
+                                  gtable=args.gtable,
+                                  fields=[args.primary, args.secondary],
+                                  thresholds=cal_qa.load_thresholds(
+                                      args.qa_thresholds))
+        cal_qa.write_report(report, args.qa)
+        for name in sorted(report['checks']):
+            check = report['checks'][name]
+            print('{}: {}'.format(name, 'pass' if check['passed'] else 'FAIL'))
+            for failed in check['failed']:
+                print('  {}'.format(failed))
+        if not report['passed']:
+            sys.exit(1)
 
 # -fin-
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+# Mapping between MeerKAT channel numbers and frequencies
+# Array versions of freq2chan, chan2bbfreq and chan2freq of
+# utils/MeerKAT_frequency_to_channel_mapping.ipynb, and channel grids of the
+# correlator modes, computed once per (band, bandwidth, n_chans).
+# Frequency ranges [MHz] are converted to channel ranges and masks in bulk.
+#
+# Channel k of a band covers start + k * width +/- width / 2, with
+# width = bandwidth / n_chans, so channel n_chans / 2 is at the band centre.
+
+import numpy as np
+import time
+
+# band start frequency and bandwidth [MHz]
+BANDS = {'l': (856.0, 856.0),
+         'uhf': (544.0, 544.0),
+         's0': (1750.0, 875.0),
+         's1': (1968.75, 875.0),
+         's2': (2187.5, 875.0),
+         's3': (2406.25, 875.0),
+         's4': (2625.0, 875.0),
+         }
+# wideband correlator modes
+N_CHANS = (1024, 4096, 32768)
+
+_grid_cache = {}
+
+
+## -- notebook functions --
+def freq2chan(frequency, bandwidth, n_chans):
+    """Frequency (in Hz) to channel number"""
+    frequency = np.asarray(frequency, dtype=np.float64)
+    return (np.rint(frequency / float(bandwidth) * n_chans) % n_chans).astype(int)
+
+
+def chan2bbfreq(channel_nr, bandwidth, n_chans):
+    """Channel number to baseband frequency (in Hz)"""
+    channel_nr = np.asarray(channel_nr, dtype=np.float64)
+    return np.rint(channel_nr / float(n_chans) * float(bandwidth)) % bandwidth
+
+
+def chan2freq(channel_nr, bandwidth, channel_freqs):
+    """Channel number to frequency (in Hz)"""
+    channel_freqs = np.asarray(channel_freqs)
+    frequency = chan2bbfreq(channel_nr, bandwidth, len(channel_freqs))
+    c_width = float(bandwidth) / len(channel_freqs)
+    return channel_freqs[0] + frequency - c_width / 2.
+## -- notebook functions --
+
+
+## -- channel grids --
+def band_params(band, bandwidth=None):
+    """Start frequency and bandwidth [MHz] of a band"""
+    try:
+        f_start, band_width = BANDS[str.lower(band)]
+    except KeyError:
+        raise KeyError('Unknown band {}, known bands {}'.format(band,
+                                                                sorted(BANDS)))
+    if bandwidth is not None:
+        # narrower bandwidth around the band centre
+        f_start += (band_width - bandwidth) / 2.
+        band_width = bandwidth
+    return f_start, band_width
+
+
+def channel_freqs(band, n_chans, bandwidth=None):
+    """
+    Channel centre frequencies [MHz], computed once per
+    (band, bandwidth, n_chans), the returned array is read-only
+    """
+    key = (str.lower(band), bandwidth, int(n_chans))
+    if key not in _grid_cache:
+        f_start, band_width = band_params(band, bandwidth)
+        freqs = f_start + np.arange(n_chans) * (band_width / n_chans)
+        freqs.setflags(write=False)
+        _grid_cache[key] = freqs
+    return _grid_cache[key]
+
+
+def freqs2channels(freqs, band, n_chans, bandwidth=None):
+    """Channel numbers of frequencies [MHz], -1 outside the band"""
+    f_start, band_width = band_params(band, bandwidth)
+    width = band_width / n_chans
+    channels = np.rint((np.asarray(freqs, dtype=np.float64) - f_start) / width)
+    channels = channels.astype(int)
+    channels[(channels < 0) | (channels >= n_chans)] = -1
+    return channels
+
+
+def intervals2ranges(intervals, band, n_chans, bandwidth=None):
+    """
+    First and last + 1 channel overlapping each frequency range [MHz],
+    arrays of len(intervals), empty ranges have start == stop
+    """
+    intervals = np.asarray(intervals, dtype=np.float64).reshape(-1, 2)
+    freqs = channel_freqs(band, n_chans, bandwidth)
+    half_width = (freqs[1] - freqs[0]) / 2. if n_chans > 1 else 0.
+    starts = np.searchsorted(freqs + half_width, intervals[:, 0], side='right')
+    stops = np.searchsorted(freqs - half_width, intervals[:, 1], side='right')
+    return starts, np.maximum(starts, stops)
+
+
+def intervals2mask(intervals, band, n_chans, bandwidth=None):
+    """Boolean mask of channels overlapping any of the frequency ranges [MHz]"""
+    starts, stops = intervals2ranges(intervals, band, n_chans, bandwidth)
+    edges = np.zeros(n_chans + 1, dtype=int)
+    np.add.at(edges, starts, 1)
+    np.add.at(edges, stops, -1)
+    return np.cumsum(edges[:-1]) > 0
+## -- channel grids --
+
+
+def benchmark(n_values=100000, n_intervals=5000, band='l', n_chans=32768):
+    """Wall time [s] of the notebook functions in a loop and the array versions"""
+    f_start, band_width = band_params(band)
+    rng = np.random.RandomState(0)
+    freqs_hz = (f_start + rng.rand(n_values) * band_width) * 1e6
+    lows = f_start + rng.rand(n_intervals) * band_width
+    intervals = np.column_stack((lows, lows + rng.rand(n_intervals) * 5.))
+    bandwidth = band_width * 1e6
+    grid_hz = channel_freqs(band, n_chans) * 1e6
+
+    def _freq2chan(frequency):
+        return int(round(float(frequency) / float(bandwidth) * n_chans) % n_chans)
+
+    def _chan2freq(channel_nr):
+        frequency = round(float(channel_nr) / float(n_chans) * float(bandwidth)) % bandwidth
+        c_width = np.mean(np.diff(grid_hz))
+        return grid_hz[0] + frequency - c_width / 2.
+
+    result = {}
+    start = time.time()
+    loop_chans = [_freq2chan(freq) for freq in freqs_hz]
+    loop_freqs = [_chan2freq(chan) for chan in loop_chans[:n_values // 10]]
+    loop_mask = np.zeros(n_chans, dtype=bool)
+    for low, high in intervals:
+        loop_mask[_freq2chan(low * 1e6):_freq2chan(high * 1e6) + 1] = True
+    result['loop_s'] = time.time() - start
+
+    start = time.time()
+    chans = freq2chan(freqs_hz, bandwidth, n_chans)
+    freqs = chan2freq(chans[:n_values // 10], bandwidth, grid_hz)
+    mask = intervals2mask(intervals, band, n_chans)
+    result['array_s'] = time.time() - start
+    result['channels_equal'] = bool(np.array_equal(chans, loop_chans))
+    result['max_freq_diff_hz'] = float(np.abs(freqs - loop_freqs).max())
+    # the loop selects the nearest channels, the mask the overlapping channels
+    result['mask_diff_chans'] = int((mask != loop_mask).sum())
+    return result
+
+
+if __name__ == '__main__':
+    for n_chans in N_CHANS:
+        result = benchmark(n_chans=n_chans)
+        print('{} channels: loops {:.3f} s, arrays {:.4f} s, '
+              'channels equal {}, max frequency difference {:.2e} Hz'.format(
+                  n_chans, result['loop_s'], result['array_s'],
+                  result['channels_equal'], result['max_freq_diff_hz']))
+
+# -fin-
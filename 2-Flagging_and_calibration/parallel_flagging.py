@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+# Parallel flagging over the sub-MSs of a multi-MS (MMS)
+# Columns written to the sub-MSs are merged back into the partitioned MS
+# https://casa.nrao.edu/docs/TaskRef/partition-task.html
+# https://casa.nrao.edu/docs/TaskRef/flagdata-task.html
+#
+# The scheduling layer only needs a flagdata callable, so that partitioning
+# and load balancing can be checked with a stub without CASA
+
+import glob
+import multiprocessing
+import os
+
+
+def _casa_flagdata():
+    try:
+        from casatasks import flagdata
+    except ImportError:
+        from tasks import flagdata
+    return flagdata
+
+
+def _table():
+    try:
+        from casatools import table
+    except ImportError:
+        from taskinit import tbtool as table
+    return table()
+
+
+def _du(path):
+    """Disk usage of a table directory in bytes"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        for file_ in files:
+            size += os.path.getsize(os.path.join(root, file_))
+    return size
+
+
+def is_mms(vis):
+    return os.path.isdir(os.path.join(vis, 'SUBMSS'))
+
+
+def sub_ms(vis):
+    """Sub-MS tables of a multi-MS, or the MS itself if not partitioned"""
+    if not is_mms(vis):
+        return [vis]
+    return sorted(glob.glob(os.path.join(vis, 'SUBMSS', '*.ms')))
+
+
+def partition_ms(msfile,
+                 outputvis=None,
+                 separationaxis='scan',
+                 numsubms='auto'):
+    """Split an MS into a multi-MS along scan or spw, reusing an existing MMS"""
+    if is_mms(msfile):
+        return msfile
+    if outputvis is None:
+        outputvis = os.path.splitext(msfile.rstrip('/'))[0] + '.mms'
+    if not is_mms(outputvis):
+        try:
+            from casatasks import partition
+        except ImportError:
+            from tasks import partition
+        partition(vis=msfile,
+                  outputvis=outputvis,
+                  createmms=True,
+                  separationaxis=separationaxis,
+                  numsubms=numsubms,
+                  flagbackup=False)
+    return outputvis
+
+
+def sub_ms_name(mms, index):
+    """Name partition gives the sub-MS of number index"""
+    return os.path.join(mms, 'SUBMSS',
+                        '{}.{:04d}.ms'.format(os.path.basename(mms.rstrip('/')), index))
+
+
+def merge_columns(vis,
+                  outputvis,
+                  columns=('CORRECTED_DATA', 'FLAG'),
+                  max_rows=100000):
+    """
+    Copy columns of the sub-MSs of a multi-MS partitioned by scan into
+    the rows of the same scans of the partitioned MS, outputvis.
+    Rows are matched in (TIME, ANTENNA1, ANTENNA2, DATA_DESC_ID) order
+    """
+    sortlist = 'TIME,ANTENNA1,ANTENNA2,DATA_DESC_ID'
+    out = _table()
+    out.open(outputvis, nomodify=False)
+    sub = _table()
+    try:
+        for part in sub_ms(vis):
+            sub.open(part)
+            missing = [column for column in columns
+                       if column not in out.colnames()]
+            if missing:
+                out.addcols(dict((column, sub.getcoldesc(column))
+                                 for column in missing))
+            scans = sorted(set(sub.getcol('SCAN_NUMBER')))
+            query = 'SCAN_NUMBER IN [{}]'.format(','.join(str(scan) for scan in scans))
+            src = sub.query('', sortlist=sortlist)
+            dst = out.query(query, sortlist=sortlist)
+            try:
+                n_rows = src.nrows()
+                if dst.nrows() != n_rows:
+                    raise RuntimeError('{} has {} rows, scans {} of {} have {}'.format(
+                        part, n_rows, scans, outputvis, dst.nrows()))
+                for start in range(0, n_rows, max_rows):
+                    nrow = min(max_rows, n_rows - start)
+                    for column in columns:
+                        dst.putcol(column,
+                                   src.getcol(column, startrow=start, nrow=nrow),
+                                   startrow=start, nrow=nrow)
+            finally:
+                src.close()
+                dst.close()
+                sub.close()
+    finally:
+        out.close()
+
+
+def _by_size(partitions, sizes=None):
+    """Partitions with their sizes, largest first"""
+    if sizes is None:
+        sizes = [_du(part) for part in partitions]
+    return sorted(zip(sizes, partitions), reverse=True)
+
+
+def flag_partition(vis, cmds, flagdata=None):
+    """Apply the flag commands to one partition and return its flag summary"""
+    if flagdata is None:
+        flagdata = _casa_flagdata()
+    if len(cmds) > 0:
+        flagdata(vis=vis,
+                 mode='list',
+                 inpfile=cmds,
+                 flagbackup=False)
+    return flagdata(vis=vis,
+                    mode='summary')
+
+
+def _flag_worker(task):
+    vis, cmds, flagdata = task
+    return vis, flag_partition(vis, cmds, flagdata=flagdata)
+
+
+def merge_summaries(summaries):
+    """Sum flagged and total counts over per-partition flag summaries"""
+    merged = {}
+    for summary in summaries:
+        if not summary:
+            continue
+        for key, value in summary.items():
+            if isinstance(value, dict):
+                merged[key] = merge_summaries([merged.get(key, {}), value])
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                merged[key] = merged.get(key, 0) + value
+            else:
+                merged.setdefault(key, value)
+    return merged
+
+
+def parallel_flagging(partitions,
+                      cmds,
+                      n_workers,
+                      flagdata=None,
+                      sizes=None):
+    """
+    Flag partitions in a process pool, largest partitions are submitted first
+    so that the smaller ones fill in behind them.
+    Returns the merged flag summary and the summary per partition.
+    """
+    order = [part for _, part in _by_size(partitions, sizes=sizes)]
+    tasks = [(part, cmds, flagdata) for part in order]
+    if n_workers < 2 or len(tasks) < 2:
+        results = [_flag_worker(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes=min(n_workers, len(tasks)))
+        try:
+            results = pool.map(_flag_worker, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    per_partition = dict(results)
+    merged = merge_summaries([per_partition[part] for part in order])
+    return merged, per_partition
+
+# -fin-
@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+# Catalogue of known RFI frequency ranges for MeerKAT flagging
+# Enabled ranges are merged into the fewest non-overlapping intervals and
+# compiled to channel masks and spw selection strings for flagdata
+
+import datetime
+import mkat_channels
+import numpy as np
+import os
+import yaml
+
+CATALOGUE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '..', 'data', 'rfi_bands.yml')
+
+# band start frequency and bandwidth [MHz]
+BANDS = mkat_channels.BANDS
+
+_catalogue_cache = {}
+_mask_cache = {}
+
+
+def load_catalogue(filename=CATALOGUE):
+    """Read the RFI catalogue, parsed once per file"""
+    filename = os.path.abspath(filename)
+    if filename not in _catalogue_cache:
+        with open(filename, 'r') as fin:
+            _catalogue_cache[filename] = yaml.safe_load(fin)
+    return _catalogue_cache[filename]
+
+
+def _isvalid(entry, date):
+    if date is None:
+        return True
+    valid_from = entry.get('valid_from')
+    valid_to = entry.get('valid_to')
+    if valid_from is not None and date < _todate(valid_from):
+        return False
+    if valid_to is not None and date > _todate(valid_to):
+        return False
+    return True
+
+
+def _todate(date):
+    if isinstance(date, datetime.date):
+        return date
+    return datetime.datetime.strptime(str(date), '%Y-%m-%d').date()
+
+
+def select_intervals(categories,
+                     band='l',
+                     date=None,
+                     catalogue=None):
+    """Frequency ranges [MHz] for the enabled categories, valid at date"""
+    if catalogue is None:
+        catalogue = load_catalogue()
+    if date is not None:
+        date = _todate(date)
+    intervals = []
+    for entry in catalogue['bands']:
+        if str.lower(entry['band']) != str.lower(band):
+            continue
+        if entry['category'] not in categories:
+            continue
+        if not _isvalid(entry, date):
+            continue
+        intervals.append((float(entry['low_mhz']), float(entry['high_mhz'])))
+    return intervals
+
+
+def merge_intervals(intervals):
+    """Merge overlapping and touching ranges into sorted disjoint ranges"""
+    merged = []
+    for low, high in sorted(set(intervals)):
+        if merged and low <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+        else:
+            merged.append((low, high))
+    return merged
+
+
+def _fmt_mhz(freq):
+    return '{:g}MHZ'.format(freq)
+
+
+def intervals2spw(intervals, spw='*'):
+    """Frequency selection string for merged ranges"""
+    ranges = []
+    for low, high in merge_intervals(intervals):
+        if low == high:
+            ranges.append(_fmt_mhz(low))
+        else:
+            ranges.append('{}~{}'.format(_fmt_mhz(low), _fmt_mhz(high)))
+    if len(ranges) < 1:
+        return ''
+    return '{}:{}'.format(spw, ';'.join(ranges))
+
+
+def channel_freqs(band, n_chans):
+    """Channel centre frequencies [MHz] for the band, read-only"""
+    return mkat_channels.channel_freqs(band, n_chans)
+
+
+def channel_mask(intervals, band, n_chans):
+    """
+    Boolean mask of channels overlapping any of the ranges.
+    Masks are compiled once per (band, n_chans, ranges) and cached,
+    the returned array is read-only.
+    """
+    merged = tuple(merge_intervals(intervals))
+    key = (str.lower(band), int(n_chans), merged)
+    if key in _mask_cache:
+        return _mask_cache[key]
+
+    mask = np.zeros(n_chans, dtype=bool)
+    if len(merged) > 0:
+        mask = mkat_channels.intervals2mask(merged, band, n_chans)
+    mask.setflags(write=False)
+    _mask_cache[key] = mask
+    return mask
+
+
+def mask2ranges(mask):
+    """Start and end channel (inclusive) of each flagged run"""
+    steps = np.diff(np.concatenate(([0], np.asarray(mask, dtype=np.int8), [0])))
+    starts = np.flatnonzero(steps == 1)
+    ends = np.flatnonzero(steps == -1) - 1
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def mask2spw(mask, spw='*'):
+    """Shortest channel selection string for a channel mask"""
+    ranges = []
+    for start, end in mask2ranges(mask):
+        if start == end:
+            ranges.append('{}'.format(start))
+        else:
+            ranges.append('{}~{}'.format(start, end))
+    if len(ranges) < 1:
+        return ''
+    return '{}:{}'.format(spw, ';'.join(ranges))
+
+# -fin-
@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+# Point source sensitivity of MeerKAT after flagging
+# The radiometer equation of 1-Fundamentals_of_radio_astronomy/Point_source_sensitivity.ipynb,
+#   sigma_S = SEFD / sqrt(N (N - 1) tau dnu)  [Jy/beam],
+# evaluated over grids of antenna counts, integration times, per channel
+# SEFD (Tsys) curves and bandwidths in one broadcast.
+# Channels flagged by the catalogue rules of flagging_mkat_lband.py are excluded,
+# and channels are combined with inverse variance weights,
+#   sigma_S = 1 / sqrt(N (N - 1) tau dnu_chan sum(1 / SEFD_chan**2))
+# https://www.cv.nrao.edu/~sransom/web/Ch3.html
+
+import mkat_channels
+import numpy as np
+import rfi_bands
+
+K_B = 1.380649e-23  # J/K
+JY = 1e-26  # W/m**2/Hz
+# rule categories of the flagging recipe
+# flagging_mkat_lband.py --bp --lband --gps --glonass --galileo --iridium --inmarsat
+CATEGORIES = ['bp', 'lband', 'aviation',
+              'gps', 'glonass', 'galileo', 'iridium', 'inmarsat']
+
+
+def sefd(tsys, diameter=13.5, eta_a=0.97):
+    """System equivalent flux density [Jy] of a dish for Tsys/eta [K]"""
+    area = eta_a * np.pi * (diameter / 2.) ** 2
+    return 2. * K_B * np.asarray(tsys) / area / JY
+
+
+def usable_channels(band='l',
+                    n_chans=4096,
+                    categories=CATEGORIES,
+                    date=None,
+                    catalogue=None):
+    """Channels not flagged by the catalogue rules, boolean (n_chans, )"""
+    intervals = rfi_bands.select_intervals(categories,
+                                           band=band,
+                                           date=date,
+                                           catalogue=catalogue)
+    return ~rfi_bands.channel_mask(intervals, band, n_chans)
+
+
+def effective_bandwidth(usable, band='l'):
+    """Unflagged bandwidth [Hz] of a channel mask"""
+    _, bandwidth = mkat_channels.band_params(band)
+    return np.count_nonzero(usable) * bandwidth * 1e6 / len(usable)
+
+
+def bandwidth_masks(bandwidths, band='l', n_chans=4096, centre=None):
+    """Channels within bandwidths [MHz] around centre [MHz], (n_bw, n_chans)"""
+    freqs = mkat_channels.channel_freqs(band, n_chans)
+    if centre is None:
+        f_start, bandwidth = mkat_channels.band_params(band)
+        centre = f_start + bandwidth / 2.
+    half = np.asarray(bandwidths, dtype=np.float64).reshape(-1, 1) / 2.
+    return np.abs(freqs - centre) <= half
+
+
+def sigma_s(sefd_jy, n_ants, t_int, bandwidth):
+    """Point source sensitivity [Jy/beam], notebook form, all inputs broadcast"""
+    n_ants = np.asarray(n_ants, dtype=np.float64)
+    return sefd_jy / np.sqrt(n_ants * (n_ants - 1.) * t_int * bandwidth)
+
+
+def continuum_sigma(sefd_curves,
+                    n_ants,
+                    t_int,
+                    usable=None,
+                    band='l',
+                    bandwidths=None,
+                    centre=None):
+    """
+    Continuum point source sensitivity [Jy/beam] over the grid
+    (n_ants, t_int, SEFD curve, bandwidth), of
+      sefd_curves - SEFD [Jy] per channel (n_curves, n_chans), or (n_chans, )
+      n_ants, t_int [s] - 1D arrays of antenna counts and integration times
+      usable - unflagged channels, default all channels
+      bandwidths [MHz] - bandwidths around centre [MHz], default the full band
+    """
+    sefd_curves = np.atleast_2d(np.asarray(sefd_curves, dtype=np.float64))
+    n_chans = sefd_curves.shape[-1]
+    if usable is None:
+        usable = np.ones(n_chans, dtype=bool)
+    if bandwidths is None:
+        selection = usable[np.newaxis, :]
+    else:
+        selection = bandwidth_masks(bandwidths, band, n_chans, centre) & usable
+    _, bandwidth = mkat_channels.band_params(band)
+    chan_width = bandwidth * 1e6 / n_chans
+    # sum(1 / SEFD**2) over the selected channels, (n_curves, n_bw)
+    inv_var = (1. / sefd_curves ** 2).dot(selection.T.astype(np.float64))
+    n_ants = np.asarray(n_ants, dtype=np.float64).reshape(-1, 1, 1, 1)
+    t_int = np.asarray(t_int, dtype=np.float64).reshape(1, -1, 1, 1)
+    with np.errstate(divide='ignore'):
+        return 1. / np.sqrt(n_ants * (n_ants - 1.) * t_int * chan_width * inv_var)
+
+# -fin-
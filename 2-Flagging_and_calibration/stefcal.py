@@ -0,0 +1,417 @@
+#!/usr/bin/python3
+# Quick-look antenna based calibration with NumPy
+# Gains are solved with StEFCal, Salvini & Wijnholds 2014, A&A 571, A97,
+# for all antennas and channels at once; delays are found from the peak of
+# the FFT over frequency of each baseline.
+#
+# Solutions are saved as .npz files with the arrays
+#   type        'K', 'B' or 'G'
+#   antennas    (n_ants,) antenna names
+#   pols        (n_pols,) receptor names
+#   times       (n_sol,) solution times [MJD seconds]
+#   fields      (n_sol,) field name for each solution
+#   freqs       (n_chans,) channel frequencies [Hz], empty for K and G
+#   solutions   (n_sol, n_chans, n_ants, n_pols), complex gains, or delays [ns]
+#   flags       (n_sol, n_chans, n_ants, n_pols)
+# which inspect_cal_solutions.py can display
+
+import numpy as np
+import os
+
+NS_PER_S = 1e9
+
+
+def _table():
+    try:
+        from casatools import table
+    except ImportError:
+        from taskinit import tbtool as table
+    return table()
+
+
+## -- solvers --
+def _antenna_sums(x_1, x_2, ant1, ant2, n_ants):
+    """
+    Sum of baseline values x_1 over the rows of antenna ant1 plus
+    x_2 over the rows of antenna ant2, per antenna
+    """
+    ants = np.concatenate((ant1, ant2))
+    order = np.argsort(ants, kind='stable')
+    present, starts = np.unique(ants[order], return_index=True)
+    values = np.concatenate((x_1, x_2), axis=0)[order]
+    sums = np.zeros((n_ants,) + values.shape[1:], dtype=values.dtype)
+    sums[present] = np.add.reduceat(values, starts, axis=0)
+    return sums
+
+
+def stefcal(vis,
+            model,
+            weight,
+            ant1,
+            ant2,
+            n_ants,
+            combine_chan=False,
+            ref_ant=0,
+            n_iter=100,
+            tol=1e-6):
+    """
+    Antenna gains g with vis_pq = g_p model_pq conj(g_q), for baseline
+    arrays of shape (n_rows, n_chans, n_pols).
+    Gains are solved per channel, or over all channels with combine_chan.
+    Returns the gains (n_ants, n_chans or 1, n_pols), phase referenced to
+    ref_ant, and flags of antennas without data
+    """
+    vis = np.asarray(vis, dtype=np.complex128)
+    model = np.asarray(model, dtype=np.complex128)
+    weight = np.asarray(weight, dtype=np.float64)
+    n_chans = 1 if combine_chan else vis.shape[1]
+    gains = np.ones((n_ants, n_chans, vis.shape[2]), dtype=np.complex128)
+
+    def _sums(values):
+        if combine_chan:
+            values = values.sum(axis=1, keepdims=True)
+        return values
+
+    for it in range(n_iter):
+        h_1 = np.conj(gains[ant2])
+        h_2 = np.conj(gains[ant1])
+        z_1 = model * h_1
+        z_2 = np.conj(model) * h_2
+        num = _antenna_sums(_sums(weight * np.conj(z_1) * vis),
+                            _sums(weight * np.conj(z_2) * np.conj(vis)),
+                            ant1, ant2, n_ants)
+        den = _antenna_sums(_sums(weight * np.abs(z_1) ** 2),
+                            _sums(weight * np.abs(z_2) ** 2),
+                            ant1, ant2, n_ants)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new_gains = np.where(den > 0, num / den, 0.)
+        # averaging every second iteration ensures convergence
+        if it % 2 == 1:
+            new_gains = 0.5 * (new_gains + gains)
+        change = np.abs(new_gains - gains).max()
+        gains = new_gains
+        if change <= tol * max(np.abs(gains).max(), 1e-30):
+            break
+
+    flags = den <= 0
+    ref = gains[ref_ant]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        phasor = np.where(np.abs(ref) > 0, np.conj(ref) / np.abs(ref), 1.)
+    return gains * phasor, flags
+
+
+def fit_delays(vis,
+               weight,
+               ant1,
+               ant2,
+               n_ants,
+               freqs,
+               ref_ant=0,
+               oversample=8,
+               max_mem_mb=512.):
+    """
+    Antenna delays [ns] with vis_pq ~ exp(2 pi i freq (tau_p - tau_q)),
+    from the FFT peak over frequency of each baseline, (n_rows, n_chans, n_pols).
+    The FFT runs per polarisation on blocks of baselines of at most max_mem_mb.
+    Returns delays (n_ants, n_pols) relative to ref_ant and antenna flags
+    """
+    n_rows, n_chans, n_pols = vis.shape
+    n_fft = oversample * int(2 ** np.ceil(np.log2(n_chans)))
+    lags = np.fft.fftfreq(n_fft, d=freqs[1] - freqs[0])
+    # spectrum and its amplitude per baseline, NumPy < 2 computes in complex128
+    block = max(1, int(max_mem_mb * 1024 ** 2 // (n_fft * 24)))
+    tau_bl = np.zeros((n_rows, n_pols))
+    for pol in range(n_pols):
+        for start in range(0, n_rows, block):
+            rows = slice(start, start + block)
+            data = np.where(weight[rows, :, pol] > 0, vis[rows, :, pol], 0.)
+            spectrum = np.fft.fft(data.astype(np.complex64), n=n_fft, axis=1)
+            tau_bl[rows, pol] = lags[np.argmax(np.abs(spectrum), axis=1)]
+    valid = weight.sum(axis=1) > 0
+
+    # least squares tau_p - tau_q = tau_pq, with tau_ref = 0
+    design = np.zeros((n_rows, n_ants))
+    rows = np.arange(n_rows)
+    design[rows, ant1] = 1.
+    design[rows, ant2] = -1.
+    design = np.delete(design, ref_ant, axis=1)
+    delays = np.zeros((n_ants, n_pols))
+    flags = np.ones((n_ants, n_pols), dtype=bool)
+    for pol in range(n_pols):
+        sel = valid[:, pol]
+        solution = np.linalg.lstsq(design[sel], tau_bl[sel, pol], rcond=None)[0]
+        delays[:, pol] = np.insert(solution, ref_ant, 0.)
+        flags[:, pol] = ~_antenna_sums(sel[:, None], sel[:, None],
+                                       ant1, ant2, n_ants)[:, 0]
+        flags[ref_ant, pol] = False
+    return delays * NS_PER_S, flags
+
+
+def delay_phasors(delays_ns, freqs, ant1, ant2):
+    """Baseline phasors exp(2 pi i freq (tau_p - tau_q)), (n_rows, n_chans, n_pols)"""
+    tau = (delays_ns[ant1] - delays_ns[ant2]) / NS_PER_S
+    return np.exp(2j * np.pi * freqs[None, :, None] * tau[:, None, :])
+## -- solvers --
+
+
+## -- data access --
+class BaselineAverage(object):
+    """
+    Weighted average of visibilities per baseline, accumulated chunk by chunk.
+    With combine_chan, channels are averaged as each chunk is added, after
+    its correction, so only (n_bl, 1, n_pols) is kept
+    """
+
+    def __init__(self, n_ants, n_chans, n_pols, combine_chan=False):
+        self.n_ants = n_ants
+        self.combine_chan = combine_chan
+        ant1, ant2 = np.triu_indices(n_ants, k=1)
+        self.ant1 = ant1
+        self.ant2 = ant2
+        # rows with ant1 > ant2 map to the same baseline, conjugated,
+        # autocorrelations stay -1 and are skipped
+        self._index = -np.ones((n_ants, n_ants), dtype=int)
+        self._index[ant1, ant2] = np.arange(len(ant1))
+        self._index[ant2, ant1] = np.arange(len(ant1))
+        shape = (len(ant1), 1 if combine_chan else n_chans, n_pols)
+        self._vis = np.zeros(shape, dtype=np.complex64)
+        self._model = np.zeros(shape, dtype=np.complex64)
+        self._weight = np.zeros(shape, dtype=np.float32)
+
+    def add(self, chunk, correction=None):
+        """Add a chunk of rows, each dump in turn so that baselines are unique"""
+        index = self._index[chunk['ant1'], chunk['ant2']]
+        cross = index >= 0
+        swapped = (chunk['ant1'] > chunk['ant2'])[:, None, None]
+        weight = (~chunk['flag']).astype(np.float32)
+        vis = chunk['vis']
+        if correction is not None:
+            vis = vis * correction(chunk)
+        vis = weight * np.where(swapped, np.conj(vis), vis)
+        model = weight * np.where(swapped, np.conj(chunk['model']), chunk['model'])
+        if self.combine_chan:
+            vis = vis.sum(axis=1, keepdims=True)
+            model = model.sum(axis=1, keepdims=True)
+            weight = weight.sum(axis=1, keepdims=True)
+        for time in np.unique(chunk['time']):
+            rows = (chunk['time'] == time) & cross
+            bls = index[rows]
+            self._vis[bls] += vis[rows]
+            self._model[bls] += model[rows]
+            self._weight[bls] += weight[rows]
+
+    def average(self):
+        """Baseline averaged vis, model and weight, (n_bl, n_chans, n_pols)"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            norm = np.where(self._weight > 0, 1. / self._weight, 0.)
+        return self._vis * norm, self._model * norm, self._weight
+
+
+def ms_info(msfile):
+    """Antenna names, field names and channel frequencies of the first spw"""
+    tb = _table()
+    tb.open(os.path.join(msfile, 'ANTENNA'))
+    antennas = list(tb.getcol('NAME'))
+    tb.close()
+    tb.open(os.path.join(msfile, 'FIELD'))
+    fields = list(tb.getcol('NAME'))
+    tb.close()
+    tb.open(os.path.join(msfile, 'SPECTRAL_WINDOW'))
+    freqs = np.asarray(tb.getcell('CHAN_FREQ', 0))
+    tb.close()
+    return antennas, fields, freqs
+
+
+def read_chunks(msfile,
+                fields,
+                max_mem_mb=512.,
+                datacolumn='DATA',
+                use_model=False):
+    """
+    Cross correlations of the fields in time order, in chunks of rows
+    limited by max_mem_mb. Parallel hands only, arrays (n_rows, n_chans, n_pols)
+    """
+    _, field_names, _ = ms_info(msfile)
+    field_ids = [field_names.index(field) for field in fields]
+    query = 'FIELD_ID IN [{}] && ANTENNA1!=ANTENNA2'.format(
+            ','.join(str(idx) for idx in field_ids))
+
+    tb = _table()
+    tb.open(msfile)
+    subtb = tb.query(query, sortlist='TIME,ANTENNA1,ANTENNA2')
+    try:
+        n_rows = subtb.nrows()
+        if n_rows < 1:
+            return
+        n_pols, n_chans = subtb.getcell('FLAG', 0).shape
+        pols = [0, n_pols - 1]
+        bytes_per_row = n_chans * len(pols) * (8 + 8 + 1)
+        chunk = max(1, int(max_mem_mb * 1024 ** 2 // bytes_per_row))
+        times = subtb.getcol('TIME')
+        # chunk boundaries on dump boundaries
+        boundaries = np.flatnonzero(np.diff(times)) + 1
+        start = 0
+        while start < n_rows:
+            stop = min(start + chunk, n_rows)
+            if stop < n_rows:
+                later = boundaries[boundaries <= stop]
+                if len(later) > 0 and later[-1] > start:
+                    stop = later[-1]
+            nrow = stop - start
+
+            def _getcol(column):
+                return subtb.getcol(column, startrow=start, nrow=nrow)
+
+            # CASA columns are (pol, chan, row)
+            vis = _getcol(datacolumn)[pols].T
+            if use_model:
+                model = _getcol('MODEL_DATA')[pols].T
+            else:
+                model = np.ones_like(vis)
+            yield {'time': times[start:stop],
+                   'field': np.asarray([field_names[idx]
+                                        for idx in _getcol('FIELD_ID')]),
+                   'scan': _getcol('SCAN_NUMBER'),
+                   'ant1': _getcol('ANTENNA1'),
+                   'ant2': _getcol('ANTENNA2'),
+                   'vis': vis,
+                   'model': model,
+                   'flag': _getcol('FLAG')[pols].T,
+                   }
+            start = stop
+    finally:
+        subtb.close()
+        tb.close()
+## -- data access --
+
+
+def save_solutions(filename,
+                   sol_type,
+                   antennas,
+                   solutions,
+                   flags,
+                   times=(),
+                   fields=(),
+                   freqs=(),
+                   pols=('X', 'Y')):
+    np.savez(filename,
+             type=sol_type,
+             antennas=np.asarray(antennas),
+             pols=np.asarray(pols),
+             times=np.asarray(times, dtype=np.float64),
+             fields=np.asarray(fields),
+             freqs=np.asarray(freqs, dtype=np.float64),
+             solutions=solutions,
+             flags=flags)
+    return filename
+
+
+def load_solutions(filename):
+    with np.load(filename) as npz:
+        return dict((key, npz[key]) for key in npz.files)
+
+
+def quicklook(msfile,
+              f_cal,
+              bp_cal,
+              delay_cal,
+              g_cal=None,
+              ref_ant='',
+              prefix=None,
+              max_mem_mb=512.,
+              use_model=False):
+    """
+    Delay, bandpass and per scan gain solutions for the calibrators.
+    Without use_model, calibrators are assumed to be unit point sources at
+    the phase centre, so gain amplitudes are not flux scaled.
+    Returns the names of the K, B and G solution files
+    """
+    if prefix is None:
+        prefix = os.path.splitext(os.path.basename(msfile.rstrip('/')))[0]
+    antennas, _, freqs = ms_info(msfile)
+    n_ants = len(antennas)
+    n_chans = len(freqs)
+    ref = antennas.index(ref_ant) if ref_ant in antennas else 0
+
+    def _average(fields, correction=None):
+        avg = BaselineAverage(n_ants, n_chans, 2)
+        for chunk in read_chunks(msfile, fields,
+                                 max_mem_mb=max_mem_mb, use_model=use_model):
+            avg.add(chunk, correction=correction)
+        return avg
+
+    # delay calibration
+    avg = _average(delay_cal.split(','))
+    vis, model, weight = avg.average()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(np.abs(model) > 0, vis / model, 0.)
+    delays, kflags = fit_delays(ratio, weight, avg.ant1, avg.ant2, n_ants,
+                                freqs, ref_ant=ref, max_mem_mb=max_mem_mb)
+    ktable = save_solutions(prefix + '.K.npz', 'K', antennas,
+                            delays[None, None], kflags[None, None],
+                            fields=[delay_cal])
+
+    def _remove_delays(chunk):
+        return np.conj(delay_phasors(delays, freqs, chunk['ant1'], chunk['ant2']))
+
+    # bandpass calibration, normalised to unit mean amplitude
+    avg = _average(bp_cal.split(','), correction=_remove_delays)
+    vis, model, weight = avg.average()
+    bandpass, bflags = stefcal(vis, model, weight, avg.ant1, avg.ant2, n_ants,
+                               ref_ant=ref)
+    bflags |= bandpass == 0
+    amp = np.where(bflags, np.nan, np.abs(bandpass))
+    with np.errstate(invalid='ignore'):
+        norm = np.nanmean(amp, axis=1, keepdims=True)
+    bandpass = bandpass / np.where(np.isfinite(norm) & (norm > 0), norm, 1.)
+    btable = save_solutions(prefix + '.B.npz', 'B', antennas,
+                            bandpass.transpose(1, 0, 2)[None],
+                            bflags.transpose(1, 0, 2)[None],
+                            fields=[bp_cal], freqs=freqs)
+
+    def _remove_bandpass(chunk):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bp = (bandpass[chunk['ant1']] * np.conj(bandpass[chunk['ant2']]))
+            return _remove_delays(chunk) * np.where(bp != 0, 1. / bp, 0.)
+
+    # gain calibration per field and scan
+    gain_fields = f_cal.split(',')
+    if g_cal:
+        gain_fields += [field for field in g_cal.split(',')
+                        if field not in gain_fields]
+    gains, gflags, times, fields = [], [], [], []
+
+    def _solve(field, avg, scan_times):
+        vis, model, weight = avg.average()
+        gain, flag = stefcal(vis, model, weight, avg.ant1, avg.ant2,
+                             n_ants, combine_chan=True, ref_ant=ref)
+        gains.append(gain.transpose(1, 0, 2))
+        gflags.append(flag.transpose(1, 0, 2))
+        times.append(np.mean(scan_times))
+        fields.append(field)
+
+    for field in gain_fields:
+        # rows are in time order, so a scan is solved and released
+        # as soon as a chunk no longer contains it
+        scans = {}
+        for chunk in read_chunks(msfile, [field],
+                                 max_mem_mb=max_mem_mb, use_model=use_model):
+            chunk_scans = np.unique(chunk['scan'])
+            for scan in sorted(set(scans) - set(chunk_scans)):
+                _solve(field, *scans.pop(scan))
+            for scan in chunk_scans:
+                rows = chunk['scan'] == scan
+                if scan not in scans:
+                    scans[scan] = [BaselineAverage(n_ants, n_chans, 2,
+                                                   combine_chan=True), []]
+                sub = dict((key, value[rows]) for key, value in chunk.items())
+                scans[scan][0].add(sub, correction=_remove_bandpass)
+                scans[scan][1].append(sub['time'].mean())
+        for scan in sorted(scans):
+            _solve(field, *scans.pop(scan))
+    gtable = save_solutions(prefix + '.G.npz', 'G', antennas,
+                            np.asarray(gains), np.asarray(gflags),
+                            times=times, fields=fields)
+    return [ktable, btable, gtable]
+
+# -fin-
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+# Timing and resource use of CASA task invocations
+# Each task is written as a line of JSON to the task log, and optionally
+# collected as complete events in Chrome trace format (chrome://tracing)
+
+import json
+import os
+import resource
+import sys
+import time
+
+# lifetime peak RSS [MB] of the process, kept across resets of the peak
+_process_peak = [0.]
+
+
+def _maxrss_mb(who):
+    """Lifetime peak resident set size [MB], of this process or its children"""
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    if sys.platform == 'darwin':
+        return peak / 1024. ** 2
+    return peak / 1024.
+
+
+def _reset_peak_rss():
+    """Reset the peak RSS of this process, Linux only, True if reset"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fout:
+            fout.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _vmhwm_mb():
+    """Peak RSS of this process since the last reset [MB], Linux only"""
+    with open('/proc/self/status', 'r') as fin:
+        for line in fin:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024.
+    return None
+
+
+def _cpu_time():
+    """User and system time of this process and its children [s]"""
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def measure(func, *args, **kwargs):
+    """
+    Run func(*args, **kwargs) and return its result and timing.
+    peak_rss_mb is the peak RSS of this process during the task, from the
+    reset high-water mark on Linux. Elsewhere it is only known if the task
+    raised the lifetime peak, and None otherwise, as is children_peak_rss_mb
+    for child processes. process_peak_rss_mb is the lifetime peak of the
+    process and its children
+    """
+    self_before = _maxrss_mb(resource.RUSAGE_SELF)
+    children_before = _maxrss_mb(resource.RUSAGE_CHILDREN)
+    reset = _reset_peak_rss()
+    start = time.time()
+    cpu_start = _cpu_time()
+    result = func(*args, **kwargs)
+    wall = time.time() - start
+    cpu = _cpu_time() - cpu_start
+    self_after = _maxrss_mb(resource.RUSAGE_SELF)
+    children_after = _maxrss_mb(resource.RUSAGE_CHILDREN)
+    peak = _vmhwm_mb() if reset else None
+    if peak is None and self_after > self_before:
+        peak = self_after
+    children_peak = children_after if children_after > children_before else None
+    _process_peak[0] = max(_process_peak[0], self_before, self_after,
+                           peak or 0., children_after)
+
+    def _mb(value):
+        return None if value is None else round(value, 1)
+
+    timing = {'start': start,
+              'wall_s': round(wall, 6),
+              'cpu_s': round(cpu, 6),
+              'peak_rss_mb': _mb(peak),
+              'children_peak_rss_mb': _mb(children_peak),
+              'process_peak_rss_mb': _mb(_process_peak[0]),
+              'pid': os.getpid(),
+              }
+    return result, timing
+
+
+class TaskLog(object):
+    """
+    Record wall time, CPU time and peak RSS for every task run through it
+    """
+
+    def __init__(self, logfile=None, tracefile=None):
+        self.logfile = logfile
+        self.tracefile = tracefile
+        self.events = []
+        self._t0 = time.time()
+        if logfile is not None:
+            # start a fresh log for each run of a script
+            open(logfile, 'w').close()
+
+    def run(self, name, func, *args, **kwargs):
+        """Run func(*args, **kwargs) and record it under name"""
+        result, timing = self.measure(func, *args, **kwargs)
+        self.record(name, timing)
+        return result
+
+    def measure(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) and return its result and timing"""
+        return measure(func, *args, **kwargs)
+
+    def record(self, name, timing, extra=None):
+        """Add a task event to the log"""
+        event = {'task': name}
+        event.update(timing)
+        if extra:
+            event.update(extra)
+        self.events.append(event)
+        if self.logfile is not None:
+            with open(self.logfile, 'a') as fout:
+                fout.write(json.dumps(event, sort_keys=True) + '\n')
+        return event
+
+    def close(self):
+        """Write the Chrome trace file"""
+        if self.tracefile is None:
+            return
+        trace = []
+        for event in self.events:
+            args = dict((key, value) for key, value in event.items()
+                        if key not in ('task', 'start', 'wall_s', 'pid'))
+            trace.append({'name': event['task'],
+                          'ph': 'X',
+                          'ts': int((event['start'] - self._t0) * 1e6),
+                          'dur': int(event['wall_s'] * 1e6),
+                          'pid': event.get('pid', os.getpid()),
+                          'tid': 0,
+                          'args': args,
+                          })
+        with open(self.tracefile, 'w') as fout:
+            json.dump({'traceEvents': trace,
+                       'displayTimeUnit': 'ms'}, fout)
+
+# -fin-
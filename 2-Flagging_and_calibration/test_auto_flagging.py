@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+# Tests of the SumThreshold detector on synthetic visibility cubes with injected RFI
+# Run from this directory: python -m pytest test_auto_flagging.py
+
+import auto_flagging
+import numpy as np
+
+N_DUMPS = 200
+N_CHANS = 256
+N_POLS = 2
+
+
+def _noise(rng, amp=10.):
+    """Complex noise around a smooth bandpass, (time, freq, pol)"""
+    bandpass = 1. + 0.3 * np.sin(np.arange(N_CHANS) / 40.)
+    shape = (N_DUMPS, N_CHANS, N_POLS)
+    return (amp * bandpass[np.newaxis, :, np.newaxis] +
+            rng.standard_normal(shape) + 1j * rng.standard_normal(shape))
+
+
+def _rfi_cube(rng):
+    """Noise with a narrowband channel, a broadband dump, a patch and a spike"""
+    vis = _noise(rng)
+    rfi = np.zeros(vis.shape, dtype=bool)
+    for index, power in (((slice(None), 100), 8.),
+                         ((50, slice(None)), 8.),
+                         ((slice(120, 125), slice(180, 190)), 5.),
+                         ((30, 30), 15.)):
+        vis[index] += power
+        rfi[index] = True
+    return vis, rfi
+
+
+def test_sumthreshold_windows():
+    values = np.zeros((1, 64))
+    # a single strong sample
+    values[0, 10] = 7.
+    # a run of 8 weak samples, each below chi_1 but above chi_8 = 6 / 1.5**3
+    values[0, 30:38] = 2.
+    flags = auto_flagging.sumthreshold(values, np.zeros(values.shape, dtype=bool),
+                                       axes=(1,))
+    assert flags[0, 10] and flags[0, 30:38].all()
+    assert flags.sum() == 9
+
+
+def test_sumthreshold_noise():
+    rng = np.random.RandomState(1)
+    values = rng.standard_normal((N_DUMPS, N_CHANS))
+    flags = auto_flagging.sumthreshold(values, np.zeros(values.shape, dtype=bool))
+    # noise excursions in the longest windows
+    assert flags.mean() < 5e-3
+
+
+def test_dilate():
+    flags = np.zeros((5, 9), dtype=bool)
+    flags[2, 0] = True
+    dilated = auto_flagging.dilate(flags, 2, axis=1)
+    np.testing.assert_array_equal(np.flatnonzero(dilated[2]), [0, 1, 2])
+    assert not np.delete(dilated, 2, axis=0).any()
+    dilated = auto_flagging.dilate(flags, 1, axis=0)
+    np.testing.assert_array_equal(np.flatnonzero(dilated[:, 0]), [1, 2, 3])
+    assert auto_flagging.dilate(flags, 0, axis=0) is flags
+
+
+def test_flag_cube_detection():
+    rng = np.random.RandomState(2)
+    vis, rfi = _rfi_cube(rng)
+    flags = auto_flagging.flag_cube(vis)
+    assert flags[rfi].mean() > 0.99
+    # false positives outside the dilation of the injected RFI
+    near = auto_flagging.dilate(auto_flagging.dilate(rfi, 1, axis=0), 2, axis=1)
+    assert flags[~near].mean() < 0.02
+    # flags are combined over polarisations
+    np.testing.assert_array_equal(flags[..., 0], flags[..., 1])
+
+
+def test_flag_cube_clean():
+    rng = np.random.RandomState(3)
+    vis = _noise(rng)
+    detected = auto_flagging.flag_cube(vis, dilate_time=0, dilate_freq=0,
+                                       combine_pols=False)
+    assert detected.mean() < 5e-3
+    # each detection grows to 3 x 5 samples in both polarisations
+    assert auto_flagging.flag_cube(vis).mean() < 0.02
+
+
+def test_flag_cube_keeps_flags():
+    rng = np.random.RandomState(4)
+    vis = _noise(rng)
+    vis[7, 3, 1] = np.nan
+    prior = np.zeros(vis.shape, dtype=bool)
+    prior[:, 200] = True
+    flags = auto_flagging.flag_cube(vis, prior)
+    assert flags[:, 200].all() and flags[7, 3, 1]
+
+
+def test_baseline_row_ranges():
+    ant1 = [0, 0, 0, 0, 1, 1, 1]
+    ant2 = [0, 1, 1, 2, 1, 2, 2]
+    # autocorrelations are skipped
+    assert auto_flagging.baseline_row_ranges(ant1, ant2) == [(1, 3), (3, 4), (5, 7)]
+
+# -fin-
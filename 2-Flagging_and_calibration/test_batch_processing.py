@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+# Tests of the batch scheduler with stub steps that sleep and allocate memory
+# Run from this directory: python -m pytest test_batch_processing.py
+
+import batch_processing
+import os
+import sys
+
+POLL = 0.02
+
+
+def _step(seconds, alloc_mb=1, returncode=0):
+    """Command line of a stub step"""
+    code = ('import sys, time; buf = bytearray({} * 1024 ** 2); '
+            'time.sleep({}); sys.exit({})'.format(alloc_mb, seconds, returncode))
+    return [sys.executable, '-c', code]
+
+
+def _job(tmpdir, name, seconds=0.2, steps=None, **kwargs):
+    if steps is None:
+        steps = [_step(seconds)]
+    return batch_processing.Job(name, steps,
+                                workdir=os.path.join(tmpdir, name),
+                                **kwargs)
+
+
+def _run(tmpdir, jobs, **kwargs):
+    scheduler = batch_processing.Scheduler(jobs,
+                                           log_dir=os.path.join(tmpdir, 'logs'),
+                                           poll=POLL,
+                                           **kwargs)
+    return scheduler.run()
+
+
+def _max_concurrent(jobs):
+    events = sorted([(job.start, 1) for job in jobs] +
+                    [(job.end, -1) for job in jobs])
+    running = 0
+    peak = 0
+    for _, change in events:
+        running += change
+        peak = max(peak, running)
+    return peak
+
+
+def test_max_jobs(tmp_path):
+    tmpdir = str(tmp_path)
+    jobs = [_job(tmpdir, 'obs{}'.format(idx)) for idx in range(5)]
+    status = _run(tmpdir, jobs, max_jobs=2)
+    assert all(job['status'] == 'done' for job in status.values())
+    assert _max_concurrent(jobs) == 2
+
+
+def test_max_mem(tmp_path):
+    tmpdir = str(tmp_path)
+    jobs = [_job(tmpdir, 'obs{}'.format(idx), memory_gb=3.) for idx in range(3)]
+    _run(tmpdir, jobs, max_jobs=4, max_mem_gb=5.)
+    assert _max_concurrent(jobs) == 1
+
+
+def test_priority_order(tmp_path):
+    tmpdir = str(tmp_path)
+    jobs = [_job(tmpdir, name, seconds=0.05, priority=priority)
+            for name, priority in (('low', 0), ('high', 10), ('mid', 5),
+                                   ('mid2', 5))]
+    _run(tmpdir, jobs, max_jobs=1)
+    order = [job.name for job in sorted(jobs, key=lambda job: job.start)]
+    # manifest order within a priority
+    assert order == ['high', 'mid', 'mid2', 'low']
+
+
+def test_failed_step(tmp_path):
+    tmpdir = str(tmp_path)
+    marker = str(tmp_path / 'step3')
+    steps = [_step(0.05),
+             _step(0.05, returncode=3),
+             [sys.executable, '-c', 'open({!r}, "w").close()'.format(marker)]]
+    jobs = [_job(tmpdir, 'failing', steps=steps), _job(tmpdir, 'other')]
+    status = _run(tmpdir, jobs)
+    assert status['failing']['status'] == 'failed'
+    assert status['failing']['failed_step'] == 2
+    assert status['failing']['returncode'] == 3
+    # the job stops at the failed step, other jobs are not affected
+    assert not os.path.exists(marker)
+    assert status['other']['status'] == 'done'
+    with open(status['failing']['log'], 'r') as fin:
+        log = fin.read()
+    assert '### step 2' in log and '### step 3' not in log
+
+
+def test_rejected(tmp_path):
+    tmpdir = str(tmp_path)
+    jobs = [_job(tmpdir, 'large', memory_gb=100.), _job(tmpdir, 'small')]
+    status = _run(tmpdir, jobs, max_mem_gb=64.)
+    assert status['large']['status'] == 'rejected'
+    # a job that never started has no log
+    assert status['large']['log'] is None
+    assert status['small']['status'] == 'done'
+    assert os.path.isfile(status['small']['log'])
+
+
+def test_no_starvation(tmp_path):
+    tmpdir = str(tmp_path)
+    first = _job(tmpdir, 'first', seconds=0.1, priority=10, memory_gb=2.)
+    large = _job(tmpdir, 'large', seconds=0.05, priority=5, memory_gb=4.)
+    # staggered, so that a small job is always running
+    small = [_job(tmpdir, 'small{}'.format(idx), seconds=0.25, memory_gb=2.)
+             for idx in range(6)]
+    _run(tmpdir, [first, large] + small, max_mem_gb=4., max_wait=3)
+    # small jobs fill in while the large job waits, then stop starting
+    # until it has run
+    assert min(job.start for job in small) < large.start
+    assert large.start < max(job.start for job in small)
+    assert all(job.start >= large.end for job in small
+               if job.start > large.start)
+
+# -fin-
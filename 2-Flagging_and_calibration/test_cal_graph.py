@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+# Tests of the calibration graph and scheduler with the placeholder backend
+# Run from this directory: python -m pytest test_cal_graph.py
+
+import cal_graph
+import json
+import os
+import time
+
+
+def _backend(task, params):
+    """Placeholder backend that logs the start and end of each task"""
+    start = time.time()
+    time.sleep(params.get('sleep', 0.))
+    cal_graph.placeholder_backend(task, params)
+    # rmtables before re-solving is not logged
+    if 'log' not in params:
+        return
+    with open(params['log'], 'a') as fout:
+        fout.write(json.dumps([params['name'], start, time.time()]) + '\n')
+
+
+def _intervals(log):
+    with open(log, 'r') as fin:
+        return dict((name, (start, end))
+                    for name, start, end in (json.loads(line) for line in fin))
+
+
+def _solve_graph(tmpdir, sleep=0.):
+    """Delay, bandpass and gain solves with plots, as in calibrating_mkat_lband.py"""
+    log = os.path.join(tmpdir, 'tasks.log')
+    ms = os.path.join(tmpdir, 'obs.ms')
+    ktable, btable, gtable = [os.path.join(tmpdir, 'obs' + ext)
+                              for ext in ('.K', '.B', '.G')]
+    graph = cal_graph.Graph()
+
+    def _node(name, task, inputs=(), outputs=(), modifies=(), **params):
+        params.update(name=name, log=log, sleep=sleep)
+        return graph.add(cal_graph.Node(name, task, params,
+                                        inputs=inputs,
+                                        outputs=outputs,
+                                        modifies=modifies))
+
+    _node('setjy', 'setjy', vis=ms,
+          inputs=[ms], modifies=[ms + '::MODEL_DATA'])
+    _node('delay', 'gaincal', vis=ms, caltable=ktable,
+          inputs=[ms, ms + '::MODEL_DATA'], outputs=[ktable])
+    _node('bandpass', 'bandpass', vis=ms, caltable=btable,
+          inputs=[ms, ms + '::MODEL_DATA', ktable], outputs=[btable])
+    _node('gain', 'gaincal', vis=ms, caltable=gtable,
+          inputs=[ms, ms + '::MODEL_DATA', ktable, btable], outputs=[gtable])
+    for name, table in (('plot delay', ktable), ('plot bandpass', btable)):
+        _node(name, 'plotcal', caltable=table,
+              figfile=os.path.join(tmpdir, name.replace(' ', '_') + '.png'),
+              inputs=[table],
+              outputs=[os.path.join(tmpdir, name.replace(' ', '_') + '.png')])
+    return graph, log
+
+
+def test_dependencies(tmp_path):
+    graph, _ = _solve_graph(str(tmp_path))
+    assert graph['delay'].deps == ['setjy']
+    assert graph['bandpass'].deps == ['setjy', 'delay']
+    assert graph['gain'].deps == ['setjy', 'delay', 'bandpass']
+    assert graph['plot bandpass'].deps == ['bandpass']
+    assert graph.downstream(['bandpass']) == set(['bandpass', 'gain',
+                                                  'plot bandpass'])
+
+
+def test_order_and_concurrency(tmp_path):
+    graph, log = _solve_graph(str(tmp_path), sleep=0.2)
+    completed = cal_graph.run(graph, backend=_backend, workers=3)
+    assert sorted(name for name, _ in completed) == sorted(
+            node.name for node in graph.nodes)
+    intervals = _intervals(log)
+    # every node starts after its dependencies have finished
+    for node in graph.nodes:
+        for dep in node.deps:
+            assert intervals[node.name][0] >= intervals[dep][1]
+    # independent nodes run at the same time
+    assert intervals['plot delay'][0] < intervals['bandpass'][1]
+    assert intervals['bandpass'][0] < intervals['plot delay'][1]
+
+
+def test_same_table_writers_serialized(tmp_path):
+    log = str(tmp_path / 'tasks.log')
+    graph = cal_graph.Graph()
+    for vis in ('a.ms', 'b.ms'):
+        for field in ('f1', 'f2', 'f3'):
+            name = 'applycal {} {}'.format(field, vis)
+            graph.add(cal_graph.Node(
+                name, 'applycal',
+                dict(vis=vis, field=field, name=name, log=log, sleep=0.1),
+                inputs=[vis],
+                modifies=['{}::CORRECTED_DATA::{}'.format(vis, field)]))
+    cal_graph.run(graph, backend=_backend, workers=4)
+    intervals = _intervals(log)
+    for vis in ('a.ms', 'b.ms'):
+        spans = sorted(span for name, span in intervals.items()
+                       if name.endswith(vis))
+        assert len(spans) == 3
+        for first, second in zip(spans[:-1], spans[1:]):
+            assert first[1] <= second[0]
+    # different tables are applied concurrently
+    a_spans = [span for name, span in intervals.items() if name.endswith('a.ms')]
+    b_spans = [span for name, span in intervals.items() if name.endswith('b.ms')]
+    assert any(a[0] < b[1] and b[0] < a[1] for a in a_spans for b in b_spans)
+
+
+def test_skip_completed(tmp_path):
+    statefile = str(tmp_path / 'obs.calgraph.json')
+    graph, _ = _solve_graph(str(tmp_path))
+    first = cal_graph.run(graph, backend=_backend, statefile=statefile)
+    assert len(first) == len(graph.nodes)
+    # nothing to do while the tables are unchanged
+    graph, _ = _solve_graph(str(tmp_path))
+    assert cal_graph.run(graph, backend=_backend, statefile=statefile) == []
+    # a missing table re-runs its node and everything downstream of it
+    os.rmdir(str(tmp_path / 'obs.B'))
+    graph, _ = _solve_graph(str(tmp_path))
+    rerun = cal_graph.run(graph, backend=_backend, statefile=statefile)
+    assert set(name for name, _ in rerun) == set(['bandpass', 'gain',
+                                                   'plot bandpass'])
+    # force re-runs all nodes
+    graph, _ = _solve_graph(str(tmp_path))
+    forced = cal_graph.run(graph, backend=_backend, statefile=statefile,
+                           force=True)
+    assert len(forced) == len(graph.nodes)
+
+
+def test_changed_parameters(tmp_path):
+    statefile = str(tmp_path / 'obs.calgraph.json')
+    graph, _ = _solve_graph(str(tmp_path))
+    cal_graph.run(graph, backend=_backend, statefile=statefile)
+    graph, _ = _solve_graph(str(tmp_path))
+    graph['gain'].params['solint'] = 'inf'
+    rerun = cal_graph.run(graph, backend=_backend, statefile=statefile)
+    assert [name for name, _ in rerun] == ['gain']
+
+# -fin-
@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+# Tests of the partition scheduling with a flagdata stub that records its calls
+# Run from this directory: python -m pytest test_parallel_flagging.py
+
+import json
+import os
+import parallel_flagging
+import time
+
+# seconds of flagging per kB of partition
+SECONDS_PER_KB = 0.2
+
+
+def _flagdata(vis, mode, inpfile=None, flagbackup=True):
+    """
+    Stub of the CASA task, flagging takes time in proportion to the size
+    of the partition and each command list flags one sample
+    """
+    start = time.time()
+    if mode == 'list':
+        time.sleep(SECONDS_PER_KB * parallel_flagging._du(vis) / 1024.)
+    with open(os.path.join(vis, 'calls.log'), 'a') as fout:
+        fout.write(json.dumps([mode, inpfile, flagbackup, os.getpid(),
+                               start, time.time()]) + '\n')
+    if mode != 'summary':
+        return None
+    n_flagged = len([call for call in _calls(vis) if call[0] == 'list'])
+    return {'name': 'Summary',
+            'type': 'summary',
+            'flagged': float(n_flagged),
+            'total': 100.,
+            'antenna': {'m000': {'flagged': float(n_flagged), 'total': 50.},
+                        'm001': {'flagged': 0., 'total': 50.}},
+            }
+
+
+def _calls(vis):
+    with open(os.path.join(vis, 'calls.log'), 'r') as fin:
+        return [json.loads(line) for line in fin]
+
+
+def _partitions(tmpdir, sizes_kb):
+    """Sub-MS directories of the given sizes in kB"""
+    partitions = []
+    for idx, size in enumerate(sizes_kb):
+        part = parallel_flagging.sub_ms_name(os.path.join(tmpdir, 'obs.mms'), idx)
+        os.makedirs(part)
+        with open(os.path.join(part, 'table.f0'), 'wb') as fout:
+            fout.write(b'\0' * size * 1024)
+        partitions.append(part)
+    return partitions
+
+
+def test_sub_ms(tmp_path):
+    mms = str(tmp_path / 'obs.mms')
+    partitions = _partitions(str(tmp_path), [1, 1, 1])
+    assert parallel_flagging.is_mms(mms)
+    assert parallel_flagging.sub_ms(mms) == partitions
+    assert os.path.basename(partitions[2]) == 'obs.mms.0002.ms'
+    assert parallel_flagging.sub_ms(str(tmp_path)) == [str(tmp_path)]
+
+
+def test_calls_per_partition(tmp_path):
+    partitions = _partitions(str(tmp_path), [1, 2, 1])
+    cmds = ["mode='manual' antenna='m000'", "mode='quack' quackinterval=8."]
+    merged, per_partition = parallel_flagging.parallel_flagging(
+            partitions, cmds, 2, flagdata=_flagdata)
+    assert sorted(per_partition) == sorted(partitions)
+    for part in partitions:
+        calls = _calls(part)
+        # the command list once without flag backups, then the summary
+        assert [call[:3] for call in calls] == [['list', cmds, False],
+                                                ['summary', None, True]]
+    # counts are summed over the partitions, other values kept
+    assert merged['flagged'] == 3. and merged['total'] == 300.
+    assert merged['antenna']['m000'] == {'flagged': 3., 'total': 150.}
+    assert merged['antenna']['m001'] == {'flagged': 0., 'total': 150.}
+    assert merged['type'] == 'summary'
+
+
+def test_no_commands(tmp_path):
+    partitions = _partitions(str(tmp_path), [1])
+    merged, _ = parallel_flagging.parallel_flagging(partitions, [], 1,
+                                                    flagdata=_flagdata)
+    assert [call[0] for call in _calls(partitions[0])] == ['summary']
+    assert merged['flagged'] == 0.
+
+
+def test_load_balancing(tmp_path):
+    sizes_kb = [1, 1, 4, 3, 3]
+    partitions = _partitions(str(tmp_path), sizes_kb)
+    start = time.time()
+    parallel_flagging.parallel_flagging(partitions, ['mode="manual"'], 2,
+                                        flagdata=_flagdata)
+    elapsed = time.time() - start
+    flagging = dict((part, _calls(part)[0]) for part in partitions)
+    pids = set(call[3] for call in flagging.values())
+    assert len(pids) == 2 and os.getpid() not in pids
+    # the two largest partitions start first, one per worker
+    first = sorted(partitions, key=lambda part: flagging[part][4])[:2]
+    assert partitions[2] in first
+    assert partitions[3] in first or partitions[4] in first
+    # largest first on two workers takes 6 of the 12 kB of serial flagging
+    # time, submission in the given order would take 7
+    serial = SECONDS_PER_KB * sum(sizes_kb)
+    assert elapsed < 6.5 / 12. * serial
+
+
+def test_merge_summaries():
+    merged = parallel_flagging.merge_summaries(
+            [{'flagged': 1, 'total': 4, 'spw': {'0': {'flagged': 1}}},
+             None,
+             {'flagged': 2., 'total': 4, 'spw': {'1': {'flagged': 2}}}])
+    assert merged == {'flagged': 3., 'total': 8,
+                      'spw': {'0': {'flagged': 1}, '1': {'flagged': 2}}}
+
+# -fin-
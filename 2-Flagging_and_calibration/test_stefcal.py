@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+# Tests of the quick-look solvers on synthetic visibilities with known gains
+# Run from this directory: python -m pytest test_stefcal.py
+
+import numpy as np
+import stefcal
+
+N_ANTS = 7
+N_CHANS = 64
+FREQS = 0.9e9 + np.arange(N_CHANS) * 1e6
+
+
+def _gains(rng, n_chans=N_CHANS):
+    amp = 1. + 0.2 * rng.rand(N_ANTS, n_chans, 2)
+    return amp * np.exp(1j * rng.uniform(-np.pi, np.pi, (N_ANTS, n_chans, 2)))
+
+
+def _baselines():
+    ant1, ant2 = np.triu_indices(N_ANTS, k=1)
+    return ant1, ant2
+
+
+def _closure(gains, ant1, ant2):
+    """Baseline gain products, independent of the phase reference"""
+    return gains[ant1] * np.conj(gains[ant2])
+
+
+def test_stefcal_gains():
+    rng = np.random.RandomState(1)
+    gains = _gains(rng)
+    ant1, ant2 = _baselines()
+    model = np.ones((len(ant1), N_CHANS, 2), dtype=np.complex128)
+    vis = _closure(gains, ant1, ant2) * model
+    weight = np.ones(vis.shape)
+    solved, flags = stefcal.stefcal(vis, model, weight, ant1, ant2, N_ANTS)
+    assert not flags.any()
+    np.testing.assert_allclose(_closure(solved, ant1, ant2), vis, atol=1e-6)
+    # phase referenced to antenna 0
+    np.testing.assert_allclose(np.angle(solved[0]), 0., atol=1e-9)
+
+
+def test_stefcal_flagged_antenna():
+    rng = np.random.RandomState(2)
+    gains = _gains(rng, n_chans=1)
+    ant1, ant2 = _baselines()
+    model = np.ones((len(ant1), 1, 2), dtype=np.complex128)
+    vis = _closure(gains, ant1, ant2)
+    weight = np.ones(vis.shape)
+    weight[(ant1 == 3) | (ant2 == 3)] = 0.
+    solved, flags = stefcal.stefcal(vis, model, weight, ant1, ant2, N_ANTS)
+    assert flags[3].all() and not np.delete(flags, 3, axis=0).any()
+    good = (ant1 != 3) & (ant2 != 3)
+    np.testing.assert_allclose(_closure(solved, ant1, ant2)[good], vis[good],
+                               atol=1e-6)
+
+
+def test_fit_delays():
+    rng = np.random.RandomState(3)
+    delays = rng.uniform(-20., 20., (N_ANTS, 2))
+    delays[0] = 0.
+    ant1, ant2 = _baselines()
+    vis = stefcal.delay_phasors(delays, FREQS, ant1, ant2)
+    weight = np.ones(vis.shape)
+    solved, flags = stefcal.fit_delays(vis, weight, ant1, ant2, N_ANTS, FREQS)
+    assert not flags.any()
+    # within the lag resolution of the oversampled FFT
+    resolution = 1e9 / (8 * 64 * (FREQS[1] - FREQS[0]))
+    assert np.abs(solved - delays).max() < resolution
+    # the FFT over blocks of a few baselines finds the same peaks
+    blocked, _ = stefcal.fit_delays(vis, weight, ant1, ant2, N_ANTS, FREQS,
+                                    max_mem_mb=0.05)
+    np.testing.assert_array_equal(blocked, solved)
+
+
+def test_baseline_average_orientation():
+    rng = np.random.RandomState(4)
+    gains = _gains(rng)
+    ant1, ant2 = _baselines()
+    vis = _closure(gains, ant1, ant2)
+    # swapped baselines are conjugated, autocorrelations are skipped
+    swap = np.arange(len(ant1)) % 3 == 0
+    rows_1 = np.concatenate((np.where(swap, ant2, ant1), [2]))
+    rows_2 = np.concatenate((np.where(swap, ant1, ant2), [2]))
+    rows_vis = np.concatenate((np.where(swap[:, None, None], np.conj(vis), vis),
+                               100. * np.ones((1, N_CHANS, 2))))
+    chunk = {'time': np.zeros(len(rows_1)),
+             'ant1': rows_1,
+             'ant2': rows_2,
+             'vis': rows_vis,
+             'model': np.ones(rows_vis.shape, dtype=np.complex128),
+             'flag': np.zeros(rows_vis.shape, dtype=bool),
+             }
+    avg = stefcal.BaselineAverage(N_ANTS, N_CHANS, 2)
+    avg.add(chunk)
+    averaged, _, weight = avg.average()
+    np.testing.assert_allclose(averaged, vis, atol=1e-5)
+    assert (weight == 1.).all()
+
+    combined = stefcal.BaselineAverage(N_ANTS, N_CHANS, 2, combine_chan=True)
+    combined.add(chunk)
+    averaged, _, weight = combined.average()
+    np.testing.assert_allclose(averaged[:, 0], vis.mean(axis=1), atol=1e-5)
+    assert (weight == N_CHANS).all()
+
+
+def test_quicklook(tmp_path, monkeypatch):
+    """Delays, bandpass and per scan gains of a synthetic observation"""
+    rng = np.random.RandomState(5)
+    antennas = ['m{:03d}'.format(ant) for ant in range(N_ANTS)]
+    delays = rng.uniform(-20., 20., (N_ANTS, 2))
+    delays[0] = 0.
+    # smooth bandpass, so that the delays dominate the phase slope
+    bandpass = ((0.5 + 0.05 * rng.randn(N_ANTS, N_CHANS, 2)) *
+                np.exp(0.2j * rng.randn(N_ANTS, N_CHANS, 2)))
+    scan_gains = dict((scan, _gains(rng, n_chans=1)) for scan in (1, 2, 3, 4))
+    ant1, ant2 = _baselines()
+
+    def _scan(field, scan, start, n_dumps):
+        gains = (bandpass * scan_gains[scan] *
+                 np.exp(2j * np.pi * FREQS[None, :, None] * delays[:, None, :] * 1e-9))
+        vis = _closure(gains, ant1, ant2)
+        return [{'time': np.full(len(ant1), start + 8. * dump),
+                 'field': np.array([field] * len(ant1)),
+                 'scan': np.full(len(ant1), scan),
+                 'ant1': ant1,
+                 'ant2': ant2,
+                 'vis': vis,
+                 'model': np.ones_like(vis),
+                 'flag': np.zeros(vis.shape, dtype=bool),
+                 } for dump in range(n_dumps)]
+
+    data = {'bpcal': _scan('bpcal', 1, 0., 2),
+            'cal': _scan('cal', 2, 100., 2) + _scan('cal', 3, 200., 2),
+            'gcal': _scan('gcal', 4, 300., 2),
+            }
+
+    def _read_chunks(msfile, fields, max_mem_mb=512., datacolumn='DATA',
+                     use_model=False):
+        for field in fields:
+            for chunk in data[field]:
+                yield chunk
+
+    monkeypatch.setattr(stefcal, 'ms_info',
+                        lambda msfile: (antennas, sorted(data), FREQS))
+    monkeypatch.setattr(stefcal, 'read_chunks', _read_chunks)
+    ktable, btable, gtable = stefcal.quicklook('obs.ms', 'cal', 'bpcal',
+                                               'bpcal',
+                                               g_cal='gcal',
+                                               prefix=str(tmp_path / 'obs'))
+    ksols = stefcal.load_solutions(ktable)
+    gsols = stefcal.load_solutions(gtable)
+    resolution = 1e9 / (8 * 64 * (FREQS[1] - FREQS[0]))
+    assert np.abs(ksols['solutions'][0, 0] - delays).max() < resolution
+    assert list(gsols['fields']) == ['cal', 'cal', 'gcal']
+    np.testing.assert_allclose(gsols['times'], [104., 204., 304.])
+    # the bandpass absorbs the gains of its scan, so the gains relative to
+    # the first gain scan follow the injected gains
+    solved = gsols['solutions'][:, 0]
+    for idx, scan in enumerate((3, 4)):
+        ratio = (_closure(solved[idx + 1], ant1, ant2) /
+                 _closure(solved[0], ant1, ant2))
+        truth = (_closure(scan_gains[scan][:, 0], ant1, ant2) /
+                 _closure(scan_gains[2][:, 0], ant1, ant2))
+        np.testing.assert_allclose(ratio, truth, rtol=1e-3)
+
+# -fin-
@@ -0,0 +1,311 @@
+#!/usr/bin/python3
+# Streaming reader of pulsar fold-mode archives in bounded memory
+# ARIWS_timedomain_tutorial_wget.ipynb loads an archive with psrchive.Archive_load
+# and get_data() returns the whole (subint, pol, chan, bin) cube. Here archives
+# are read as blocks of sub-integrations, memory mapped views of at most
+# max_mem_mb, with baseline removal and time, frequency and polarisation
+# scrunching applied per block and accumulated into the (much smaller) output.
+# The output cube can be spilled to a .npy file on local disk and memory mapped
+# again for repeated analysis.
+#
+# Archives use a simple binary format standing in for psrchive files:
+#   magic b'ARIWSAR1', uint64 header length, JSON header, zero padding to
+#   DATA_ALIGN bytes, float32 data (nsubint, npol, nchan, nbin) and
+#   float32 weights (nsubint, nchan), little endian
+# The header holds nsubint, npol, nchan, nbin, tsubint [s], period [s],
+# dm [pc cm^-3], state ('Coherence' AA, BB, ... or 'Intensity'), freqs [MHz]
+
+import json
+import numpy as np
+import struct
+
+MAGIC = b'ARIWSAR1'
+DATA_ALIGN = 4096
+DTYPE = np.dtype('<f4')
+# dispersion constant [s MHz**2 cm**3 / pc]
+DM_CONST = 4.148808e3
+
+
+## -- archive format --
+def _data_offset(header_bytes):
+    offset = len(MAGIC) + 8 + len(header_bytes)
+    return offset + (-offset) % DATA_ALIGN
+
+
+def write_header(fout, header):
+    """Write the magic, header and padding, returns the data offset"""
+    header_bytes = json.dumps(header, sort_keys=True).encode('utf-8')
+    offset = _data_offset(header_bytes)
+    fout.write(MAGIC)
+    fout.write(struct.pack('<Q', len(header_bytes)))
+    fout.write(header_bytes)
+    fout.write(b'\0' * (offset - fout.tell()))
+    return offset
+
+
+def write_archive(filename, header, blocks, weights=None):
+    """
+    Write an archive from an iterable of data blocks (n, npol, nchan, nbin),
+    with weights (nsubint, nchan), default 1
+    """
+    shape = (header['nsubint'], header['npol'], header['nchan'], header['nbin'])
+    n_written = 0
+    with open(filename, 'wb') as fout:
+        write_header(fout, header)
+        for block in blocks:
+            block = np.ascontiguousarray(block, dtype=DTYPE)
+            if block.shape[1:] != shape[1:]:
+                raise ValueError('Block shape {} does not match archive {}'.format(
+                    block.shape, shape))
+            fout.write(block.tobytes())
+            n_written += len(block)
+        if n_written != shape[0]:
+            raise ValueError('Wrote {} of {} sub-integrations'.format(n_written,
+                                                                      shape[0]))
+        if weights is None:
+            weights = np.ones((shape[0], shape[2]), dtype=DTYPE)
+        fout.write(np.ascontiguousarray(weights, dtype=DTYPE).tobytes())
+
+
+def synthetic_archive(filename,
+                      nsubint=64,
+                      npol=2,
+                      nchan=1024,
+                      nbin=1024,
+                      tsubint=8.,
+                      period=0.25,
+                      dm=50.,
+                      f_start=856.,
+                      bandwidth=856.,
+                      snr=20.,
+                      rfi_chans=(),
+                      baseline=10.,
+                      seed=1,
+                      max_mem_mb=64.):
+    """
+    Write a synthetic archive of a dispersed Gaussian pulse in noise, with a
+    baseline offset and RFI in rfi_chans, generated in blocks of max_mem_mb
+    """
+    freqs = f_start + (np.arange(nchan) + 0.5) * bandwidth / nchan
+    header = {'nsubint': nsubint, 'npol': npol, 'nchan': nchan, 'nbin': nbin,
+              'tsubint': tsubint, 'period': period, 'dm': dm,
+              'state': 'Coherence' if npol > 1 else 'Intensity',
+              'freqs': freqs.tolist(),
+              }
+    phase = np.arange(nbin) / float(nbin)
+    delay = DM_CONST * dm * (freqs ** -2 - freqs.max() ** -2) / period
+    centre = np.mod(0.3 + delay, 1.)[:, np.newaxis]
+    offset = np.abs(phase - centre)
+    offset = np.minimum(offset, 1. - offset)
+    pulse = (snr * np.exp(-0.5 * (offset / 0.01) ** 2)).astype(DTYPE)
+    rng = np.random.RandomState(seed)
+    n_block = _block_subints(header, max_mem_mb)
+
+    def _blocks():
+        for start in range(0, nsubint, n_block):
+            n = min(n_block, nsubint - start)
+            block = rng.standard_normal((n, npol, nchan, nbin)).astype(DTYPE)
+            block += pulse / np.sqrt(nchan)
+            block += baseline
+            if len(rfi_chans):
+                block[:, :, list(rfi_chans), :] += 50.
+            yield block
+
+    write_archive(filename, header, _blocks())
+    return header
+
+
+def _block_subints(header, max_mem_mb, multiple=1):
+    """Sub-integrations per block of at most max_mem_mb, a multiple of multiple"""
+    subint_bytes = header['npol'] * header['nchan'] * header['nbin'] * DTYPE.itemsize
+    n_block = int(max_mem_mb * 1024 ** 2 // subint_bytes)
+    return max(multiple, n_block - n_block % multiple)
+
+
+class Archive(object):
+    """Memory mapped archive, with the psrchive Archive accessors of the notebook"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fin:
+            if fin.read(len(MAGIC)) != MAGIC:
+                raise IOError('{} is not an archive'.format(filename))
+            n_bytes, = struct.unpack('<Q', fin.read(8))
+            header_bytes = fin.read(n_bytes)
+        self.header = json.loads(header_bytes.decode('utf-8'))
+        self.shape = (self.header['nsubint'], self.header['npol'],
+                      self.header['nchan'], self.header['nbin'])
+        offset = _data_offset(header_bytes)
+        self._data = np.memmap(filename, dtype=DTYPE, mode='r',
+                               offset=offset, shape=self.shape)
+        self._weights = np.memmap(filename, dtype=DTYPE, mode='r',
+                                  offset=offset + self._data.nbytes,
+                                  shape=(self.shape[0], self.shape[2]))
+
+    def get_nsubint(self):
+        return self.shape[0]
+
+    def get_npol(self):
+        return self.shape[1]
+
+    def get_nchan(self):
+        return self.shape[2]
+
+    def get_nbin(self):
+        return self.shape[3]
+
+    def get_frequencies(self):
+        return np.array(self.header['freqs'])
+
+    def integration_length(self):
+        return self.shape[0] * self.header['tsubint']
+
+    def get_weights(self):
+        return self._weights
+
+    def blocks(self, max_mem_mb=64., multiple=1):
+        """
+        Blocks of sub-integrations as read-only views (n, npol, nchan, nbin),
+        yields (first sub-integration, data, weights (n, nchan))
+        """
+        n_block = _block_subints(self.header, max_mem_mb, multiple)
+        for start in range(0, self.shape[0], n_block):
+            stop = min(start + n_block, self.shape[0])
+            yield start, self._data[start:stop], self._weights[start:stop]
+## -- archive format --
+
+
+## -- block operations --
+def baseline_window(profile, duty=0.15):
+    """First bin of the off-pulse window, the duty cycle with the lowest mean"""
+    nbin = profile.shape[-1]
+    width = max(1, int(round(duty * nbin)))
+    wrapped = np.concatenate((profile, profile[..., :width]), axis=-1)
+    csum = np.cumsum(wrapped, axis=-1, dtype=np.float64)
+    csum = np.concatenate((np.zeros(profile.shape[:-1] + (1, )), csum), axis=-1)
+    window_sums = csum[..., width:width + nbin] - csum[..., :nbin]
+    return np.argmin(window_sums, axis=-1), width
+
+
+def remove_baseline(block, duty=0.15):
+    """
+    Subtract the mean of the off-pulse window of the block total profile
+    from each profile, as psrchive Archive.remove_baseline, returns a new array
+    """
+    start, width = baseline_window(block.sum(axis=(0, 1, 2)), duty=duty)
+    window = np.arange(start, start + width) % block.shape[-1]
+    return block - block[..., window].mean(axis=-1, keepdims=True)
+
+
+def pscrunch(block, state='Coherence'):
+    """Total intensity, AA + BB of coherence products, (n, 1, nchan, nbin)"""
+    if block.shape[1] == 1:
+        return block
+    if state == 'Coherence':
+        return block[:, :2].sum(axis=1, keepdims=True)
+    return block[:, :1]
+
+
+def fscrunch(block, weights, factor):
+    """Weighted mean over groups of factor channels"""
+    n, npol, nchan, nbin = block.shape
+    n_out = nchan // factor
+    data = (block[:, :, :n_out * factor] *
+            weights[:, np.newaxis, :n_out * factor, np.newaxis])
+    data = data.reshape(n, npol, n_out, factor, nbin).sum(axis=3)
+    wsum = weights[:, :n_out * factor].reshape(n, n_out, factor).sum(axis=2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        data = np.where(wsum[:, np.newaxis, :, np.newaxis] > 0,
+                        data / wsum[:, np.newaxis, :, np.newaxis], 0.)
+    return data.astype(DTYPE), wsum.astype(DTYPE)
+
+
+def tscrunch(block, weights, factor, start=0):
+    """
+    Weighted sum over groups of factor sub-integrations, for a block starting
+    at sub-integration start, the first group may be partial
+    """
+    first = start - start % factor
+    edges = np.arange(first, start + len(block), factor)
+    edges = np.maximum(edges, start) - start
+    data = np.add.reduceat(block * weights[:, np.newaxis, :, np.newaxis],
+                           edges, axis=0, dtype=np.float64)
+    wsum = np.add.reduceat(weights, edges, axis=0, dtype=np.float64)
+    return data, wsum
+
+
+def dedisperse(block, freqs, dm, period, ref_freq=None):
+    """Rotate each channel by its dispersion delay relative to ref_freq"""
+    nbin = block.shape[-1]
+    if ref_freq is None:
+        ref_freq = np.median(freqs)
+    delay = DM_CONST * dm * (freqs ** -2 - ref_freq ** -2)
+    shifts = np.rint(delay / period * nbin).astype(int) % nbin
+    index = (np.arange(nbin)[np.newaxis, :] + shifts[:, np.newaxis]) % nbin
+    return np.take_along_axis(block, np.broadcast_to(index, block.shape), axis=-1)
+## -- block operations --
+
+
+def reduce(archive,
+           tfactor=None,
+           ffactor=1,
+           pol=True,
+           baseline=True,
+           dedisp=False,
+           max_mem_mb=64.,
+           spill=None):
+    """
+    Scrunched cube (nsubint / tfactor, npol, nchan / ffactor, nbin) of an archive,
+    read one block at a time. tfactor None adds all sub-integrations (tscrunch),
+    pol sums the polarisations (pscrunch), baseline removes the off-pulse mean
+    per block. With spill, the cube is written to a memory mapped .npy file.
+    Returns the cube and the summed weights (nsubint / tfactor, nchan / ffactor)
+    """
+    if isinstance(archive, str):
+        archive = Archive(archive)
+    nsubint, npol, nchan, nbin = archive.shape
+    if tfactor is None:
+        tfactor = nsubint
+    n_out = int(np.ceil(nsubint / float(tfactor)))
+    shape = (n_out, 1 if pol else npol, nchan // ffactor, nbin)
+    if spill is None:
+        cube = np.zeros(shape, dtype=np.float64)
+    else:
+        cube = np.lib.format.open_memmap(spill, mode='w+', dtype=DTYPE, shape=shape)
+    wsum = np.zeros((n_out, shape[2]), dtype=np.float64)
+    freqs = archive.get_frequencies()
+
+    # whole groups of tfactor sub-integrations per block, if they fit
+    multiple = min(tfactor, _block_subints(archive.header, max_mem_mb))
+    for start, data, weights in archive.blocks(max_mem_mb, multiple=multiple):
+        block = np.asarray(data)
+        if baseline:
+            block = remove_baseline(block)
+        if pol:
+            block = pscrunch(block, archive.header.get('state', 'Coherence'))
+        if dedisp:
+            block = dedisperse(block, freqs, archive.header['dm'],
+                               archive.header['period'])
+        block_w = np.asarray(weights)
+        if ffactor > 1:
+            block, block_w = fscrunch(block, block_w, ffactor)
+        block, block_w = tscrunch(block, block_w, tfactor, start=start)
+        first = start // tfactor
+        stop = first + len(block)
+        cube[first:stop] += block
+        wsum[first:stop] += block_w
+
+    # weighted mean of each output sub-integration
+    with np.errstate(invalid='ignore', divide='ignore'):
+        norm = np.where(wsum > 0, 1. / wsum, 0.)[:, np.newaxis, :, np.newaxis]
+    cube *= norm
+    if spill is not None:
+        cube.flush()
+    return cube, wsum
+
+
+def load_cube(filename):
+    """Memory mapped cube spilled by reduce"""
+    return np.load(filename, mmap_mode='r')
+
+# -fin-
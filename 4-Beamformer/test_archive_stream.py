@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+# Tests of the streaming archive reader on synthetic archives
+# Run from this directory: python -m pytest test_archive_stream.py
+
+import archive_stream
+import numpy as np
+import pytest
+
+NSUBINT = 10
+NPOL = 2
+NCHAN = 16
+NBIN = 64
+# three sub-integrations per block
+SUBINT_MB = NPOL * NCHAN * NBIN * archive_stream.DTYPE.itemsize / 1024. ** 2
+
+
+def _weighted_archive(filename, seed=2):
+    """Random archive with random weights and a zero weighted channel"""
+    rng = np.random.RandomState(seed)
+    header = {'nsubint': NSUBINT, 'npol': NPOL, 'nchan': NCHAN, 'nbin': NBIN,
+              'tsubint': 8., 'period': 0.25, 'dm': 0., 'state': 'Coherence',
+              'freqs': (856. + np.arange(NCHAN) * 53.5).tolist(),
+              }
+    data = rng.standard_normal((NSUBINT, NPOL, NCHAN, NBIN)).astype(
+            archive_stream.DTYPE)
+    weights = rng.uniform(0.5, 1.5, (NSUBINT, NCHAN)).astype(archive_stream.DTYPE)
+    weights[:, 5] = 0.
+    archive_stream.write_archive(filename, header, [data[:4], data[4:]],
+                                 weights=weights)
+    return data, weights
+
+
+def _reference(data, weights, tfactor, ffactor, pol):
+    """Weighted mean over groups of sub-integrations and channels in memory"""
+    if pol:
+        data = data[:, :2].sum(axis=1, keepdims=True)
+    nsubint, npol, nchan, nbin = data.shape
+    n_out = int(np.ceil(nsubint / float(tfactor)))
+    cube = np.zeros((n_out, npol, nchan // ffactor, nbin))
+    wsum = np.zeros((n_out, nchan // ffactor))
+    for sub in range(nsubint):
+        for chan in range(nchan // ffactor * ffactor):
+            weight = weights[sub, chan]
+            cube[sub // tfactor, :, chan // ffactor] += weight * data[sub, :, chan]
+            wsum[sub // tfactor, chan // ffactor] += weight
+    with np.errstate(invalid='ignore', divide='ignore'):
+        norm = np.where(wsum > 0, 1. / wsum, 0.)
+    return cube * norm[:, np.newaxis, :, np.newaxis], wsum
+
+
+def test_header(tmp_path):
+    filename = str(tmp_path / 'test.ar')
+    header = archive_stream.synthetic_archive(filename, nsubint=NSUBINT,
+                                              nchan=NCHAN, nbin=NBIN)
+    archive = archive_stream.Archive(filename)
+    assert archive.shape == (NSUBINT, NPOL, NCHAN, NBIN)
+    assert archive.get_nsubint() == NSUBINT
+    assert archive.get_npol() == NPOL
+    assert archive.get_nchan() == NCHAN
+    assert archive.get_nbin() == NBIN
+    assert archive.integration_length() == NSUBINT * header['tsubint']
+    np.testing.assert_allclose(archive.get_frequencies(), header['freqs'])
+    assert (np.asarray(archive.get_weights()) == 1.).all()
+
+
+def test_not_an_archive(tmp_path):
+    filename = str(tmp_path / 'test.npy')
+    np.save(filename, np.zeros(4))
+    with pytest.raises(IOError):
+        archive_stream.Archive(filename)
+
+
+def test_blocks(tmp_path):
+    filename = str(tmp_path / 'test.ar')
+    data, weights = _weighted_archive(filename)
+    archive = archive_stream.Archive(filename)
+    starts = []
+    for start, block, block_w in archive.blocks(max_mem_mb=3 * SUBINT_MB):
+        assert len(block) <= 3
+        np.testing.assert_array_equal(block, data[start:start + len(block)])
+        np.testing.assert_array_equal(block_w, weights[start:start + len(block)])
+        starts.append(start)
+    assert starts == [0, 3, 6, 9]
+
+
+@pytest.mark.parametrize('tfactor, ffactor, pol', [
+        (None, 1, True),
+        (1, 1, False),
+        (4, 1, True),
+        (3, 4, False),
+        (4, 3, True),
+        ])
+def test_reduce_matches_memory(tmp_path, tfactor, ffactor, pol):
+    filename = str(tmp_path / 'test.ar')
+    data, weights = _weighted_archive(filename)
+    cube, wsum = archive_stream.reduce(filename, tfactor=tfactor,
+                                       ffactor=ffactor, pol=pol,
+                                       baseline=False,
+                                       max_mem_mb=3 * SUBINT_MB)
+    ref_cube, ref_wsum = _reference(data, weights, tfactor or NSUBINT,
+                                    ffactor, pol)
+    assert cube.shape == ref_cube.shape
+    np.testing.assert_allclose(wsum, ref_wsum, rtol=1e-5)
+    np.testing.assert_allclose(cube, ref_cube, rtol=1e-4, atol=1e-5)
+
+
+def test_spill(tmp_path):
+    filename = str(tmp_path / 'test.ar')
+    spill = str(tmp_path / 'cube.npy')
+    _weighted_archive(filename)
+    cube, _ = archive_stream.reduce(filename, tfactor=4, ffactor=2,
+                                    baseline=False, max_mem_mb=3 * SUBINT_MB)
+    archive_stream.reduce(filename, tfactor=4, ffactor=2, baseline=False,
+                          max_mem_mb=3 * SUBINT_MB, spill=spill)
+    loaded = archive_stream.load_cube(spill)
+    assert isinstance(loaded, np.memmap)
+    assert loaded.dtype == archive_stream.DTYPE
+    np.testing.assert_allclose(loaded, cube, rtol=1e-5, atol=1e-6)
+
+
+def test_dedispersed_profile(tmp_path):
+    filename = str(tmp_path / 'test.ar')
+    archive_stream.synthetic_archive(filename, nsubint=16, nchan=128, nbin=256,
+                                     dm=50., baseline=10., max_mem_mb=1.)
+    cube, _ = archive_stream.reduce(filename, ffactor=128, dedisp=True,
+                                    max_mem_mb=1.)
+    profile = cube[0, 0, 0]
+    # baseline removed
+    start, width = archive_stream.baseline_window(profile)
+    window = np.arange(start, start + width) % len(profile)
+    assert abs(np.median(profile)) < 0.1 * profile.max()
+    off_pulse = profile[window]
+    snr = (profile.max() - off_pulse.mean()) / off_pulse.std()
+    assert snr > 20.
+
+    # without dedispersion the pulse is smeared across the profile
+    smeared, _ = archive_stream.reduce(filename, ffactor=128, max_mem_mb=1.)
+    assert smeared[0, 0, 0].max() < 0.5 * profile.max()
+
+# -fin-